@@ -0,0 +1,206 @@
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+import ingest
+import plotting
+from smart_sensor import algorithms, input_dataset_csv
+
+# Batch runner: fans (recording x algorithm) jobs across a process pool.
+# Each recording is loaded once into shared memory and workers attach to it
+# instead of receiving a pickled copy. Results are streamed to a CSV (or
+# Parquet, when pyarrow is installed) table as jobs finish.
+
+result_columns = ['dataset', 'algorithm', 'sampling_rate', 'heart_rate', 'breathing_rate', 'seconds', 'status', 'error']
+parquet_batch_size = 1000
+
+# Reads an (N, 3) recording, with or without a header row, through the ingest cache
+def read_recording(path, sampling_rate=None):
+  data, metadata = ingest.load(path, sampling_rate)
+  return np.ascontiguousarray(data, dtype=np.float64)
+
+# Returns [(path, sampling rate)] from a manifest CSV with path and sampling_rate columns
+def read_manifest(path):
+  manifest = pd.read_csv(path)
+  base = os.path.dirname(path)
+  return [(p if os.path.isabs(p) or os.path.exists(p) else os.path.join(base, p), float(fs))
+    for p, fs in zip(manifest['path'], manifest['sampling_rate'])]
+
+def expand_globs(patterns, sampling_rate):
+  recordings = []
+  for pattern in patterns:
+    for path in sorted(glob.glob(pattern)):
+      recordings.append((path, sampling_rate))
+  return recordings
+
+def init_worker():
+  plotting.set_mode('headless')
+  sys.stdout = open(os.devnull, 'w')
+
+# Runs one algorithm on a recording held in shared memory, never raises
+def run_job(shm_name, shape, dataset, algorithm, sampling_rate):
+  result = {'dataset': dataset, 'algorithm': algorithm, 'sampling_rate': sampling_rate,
+    'heart_rate': np.nan, 'breathing_rate': np.nan, 'seconds': 0.0, 'status': 'ok', 'error': ''}
+  start = time.perf_counter()
+  shm = shared_memory.SharedMemory(name=shm_name)
+  try:
+    data = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    data.flags.writeable = False
+    hr, br = algorithms[algorithm](data, sampling_rate)
+    result['heart_rate'] = float(hr)
+    result['breathing_rate'] = float(br)
+  except Exception as e:
+    result['status'] = 'error'
+    result['error'] = '%s: %s' % (type(e).__name__, e)
+  finally:
+    data = None
+    shm.close()
+  result['seconds'] = time.perf_counter() - start
+  return result
+
+class ResultWriter:
+  def __init__(self, path):
+    self.path = path
+    self.rows = []
+    self.parquet_writer = None
+    self.csv_file = None
+    if path is None:
+      return
+    if path.endswith('.parquet'):
+      try:
+        import pyarrow
+        import pyarrow.parquet
+      except ImportError:
+        raise SystemExit('Writing Parquet output requires pyarrow, use a .csv output instead')
+      self.pyarrow = pyarrow
+      self.parquet = pyarrow.parquet
+    else:
+      self.csv_file = open(path, 'w', newline='')
+      self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=result_columns)
+      self.csv_writer.writeheader()
+
+  def write(self, result):
+    if self.csv_file is not None:
+      self.csv_writer.writerow(result)
+      self.csv_file.flush()
+    elif self.path is not None:
+      self.rows.append(result)
+      if len(self.rows) >= parquet_batch_size:
+        self.write_parquet_batch()
+
+  def write_parquet_batch(self):
+    table = self.pyarrow.Table.from_pylist(self.rows)
+    if self.parquet_writer is None:
+      self.parquet_writer = self.parquet.ParquetWriter(self.path, table.schema)
+    self.parquet_writer.write_table(table)
+    self.rows = []
+
+  def close(self):
+    if self.csv_file is not None:
+      self.csv_file.close()
+    elif self.path is not None:
+      if self.rows or self.parquet_writer is None:
+        self.write_parquet_batch()
+      self.parquet_writer.close()
+
+def failed_result(dataset, algorithm, sampling_rate, error):
+  return {'dataset': dataset, 'algorithm': algorithm, 'sampling_rate': sampling_rate,
+    'heart_rate': np.nan, 'breathing_rate': np.nan, 'seconds': 0.0, 'status': 'error', 'error': error}
+
+# Runs every algorithm on every recording and returns the results sorted by
+# dataset, sampling rate and algorithm. At most max_loaded recordings are held in
+# shared memory, tracked by their position in recordings since a path may repeat.
+def run(recordings, algorithm_names, workers=None, output=None, max_loaded=None):
+  workers = workers or os.cpu_count()
+  max_loaded = max_loaded or 2 * workers
+  writer = ResultWriter(output)
+  results = []
+  loaded = {} # recording index -> (shared memory, pending job count)
+  pending = {}
+
+  def collect(done):
+    for future in done:
+      index, dataset, algorithm, sampling_rate = pending.pop(future)
+      try:
+        result = future.result()
+      except Exception as e:
+        result = failed_result(dataset, algorithm, sampling_rate, '%s: %s' % (type(e).__name__, e))
+      results.append(result)
+      writer.write(result)
+      shm, count = loaded[index]
+      if count == 1:
+        del loaded[index]
+        shm.close()
+        shm.unlink()
+      else:
+        loaded[index] = (shm, count - 1)
+
+  try:
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+      for index, (dataset, sampling_rate) in enumerate(recordings):
+        while len(loaded) >= max_loaded:
+          done, _ = wait(pending, return_when=FIRST_COMPLETED)
+          collect(done)
+        try:
+          data = read_recording(dataset, sampling_rate)
+        except Exception as e:
+          for algorithm in algorithm_names:
+            result = failed_result(dataset, algorithm, sampling_rate, '%s: %s' % (type(e).__name__, e))
+            results.append(result)
+            writer.write(result)
+          continue
+        shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data
+        loaded[index] = (shm, len(algorithm_names))
+        for algorithm in algorithm_names:
+          future = executor.submit(run_job, shm.name, data.shape, dataset, algorithm, sampling_rate)
+          pending[future] = (index, dataset, algorithm, sampling_rate)
+        del data
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+  finally:
+    writer.close()
+    for shm, count in loaded.values():
+      shm.close()
+      shm.unlink()
+  return sorted(results, key=lambda r: (r['dataset'], r['sampling_rate'], r['algorithm']))
+
+def print_summary(results):
+  table = pd.DataFrame(results, columns=result_columns)
+  for (dataset, sampling_rate), rows in table.groupby(['dataset', 'sampling_rate'], sort=True):
+    print("\nDataset: %s (%g Hz)" % (dataset, sampling_rate))
+    print(rows.set_index('algorithm')[['heart_rate', 'breathing_rate', 'seconds', 'status']].sort_index())
+  failed = table[table['status'] != 'ok']
+  print("\n%d jobs, %d failed" % (len(table), len(failed)))
+  for _, row in failed.iterrows():
+    print("%s / %s: %s" % (row['dataset'], row['algorithm'], row['error']))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run the HR/BR algorithms on many recordings in parallel.')
+  parser.add_argument('patterns', nargs='*', help='glob patterns of recording CSV files (default: the bundled datasets)')
+  parser.add_argument('--sampling-rate', type=float, default=50, help='sampling rate (Hz) of files given as patterns')
+  parser.add_argument('--manifest', help='CSV file with path and sampling_rate columns')
+  parser.add_argument('--algorithms', nargs='+', choices=sorted(algorithms.keys()), default=sorted(algorithms.keys()))
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--output', help='stream results to this .csv or .parquet file')
+  args = parser.parse_args()
+
+  recordings = []
+  if args.manifest:
+    recordings += read_manifest(args.manifest)
+  recordings += expand_globs(args.patterns, args.sampling_rate)
+  if not args.manifest and not args.patterns:
+    recordings = sorted(input_dataset_csv.items())
+
+  start = time.perf_counter()
+  results = run(recordings, args.algorithms, args.workers, args.output)
+  print_summary(results)
+  print("Total time: %.3f s" % (time.perf_counter() - start))
@@ -0,0 +1,387 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+import numpy as np
+from scipy.signal import fftconvolve
+
+import pipeline
+import plotting
+from quality import SignalQuality
+from bio_watch import BioWatch
+from seismotracker import SeismoTracker
+from sleep_monitor import SleepMonitor
+from smart_sensor import algorithms
+
+# Speed and accuracy benchmark of the three algorithms on synthetic recordings
+# with known heart and breathing rates. Every (duration, sampling rate, noise)
+# case of the grid is generated once and run through each algorithm, reporting
+# wall time, peak memory (a separate traced run, so tracing does not slow the
+# timed one), throughput and absolute rate errors. Results are saved as JSON and
+# can be compared against a stored baseline to flag regressions.
+
+gravity = 9.81 # m/s^2
+bcg_frequency = 7 # Hz, ringing of the ballistocardiographic pulse, inside the 4-11 Hz BCG band
+bcg_decay = 0.08 # s
+bcg_duration = 0.5 # s
+motion_burst_seconds = 5
+saturation = 2 * gravity # m/s^2, full scale of a +-2 g sensor
+
+# Algorithms that do not estimate heart rate, their heart rate error is not reported
+breathing_only = {'Sleep Monitor'}
+estimators = {'Bio Watch': BioWatch, 'SeismoTracker': SeismoTracker, 'Sleep Monitor': SleepMonitor}
+
+default_durations = [5, 60] # minutes
+default_rates = [32, 50, 100] # Hz
+default_noise = [0.02] # m/s^2
+
+# Regression thresholds of the comparison mode
+time_tolerance = 0.25 # relative increase of wall time
+time_slack = 0.05 # seconds, smaller increases are timing noise
+memory_tolerance = 0.25 # relative increase of peak memory
+error_tolerance = 1.0 # increase of absolute rate error, bpm
+
+# Returns an (N, 3) recording of a sensor lying still, with gravity on a fixed
+# orientation, breathing as a slow tilt of every axis, heart beats as damped
+# oscillations (with a little beat to beat variability), white noise, a slow
+# random drift and motion bursts of a few seconds.
+def synthetic_recording(duration, fs, heart_rate=62, breathing_rate=15, noise=0.02, drift=0.05,
+    breathing_amplitude=0.05, bcg_amplitude=0.02, motion_bursts_per_hour=2, motion_amplitude=4, seed=0):
+  rng = np.random.default_rng(seed)
+  n = int(duration * fs)
+  t = np.arange(n) / fs
+
+  orientation = rng.normal(size=3)
+  orientation[2] += 3 # mostly along z, as a sensor lying flat
+  orientation /= np.linalg.norm(orientation)
+  data = np.tile(gravity * orientation, (n, 1))
+
+  phases = rng.uniform(0, 2 * np.pi, 3)
+  gains = breathing_amplitude * rng.uniform(0.5, 1.5, 3)
+  data += gains * np.sin(2 * np.pi * breathing_rate / 60 * t[:,None] + phases)
+
+  intervals = 60 / heart_rate * (1 + 0.03 * rng.standard_normal(int(duration * heart_rate / 60) + 2))
+  beats = np.cumsum(intervals)
+  beats = (beats[beats < duration] * fs).astype(np.intp)
+  impulses = np.zeros(n)
+  impulses[beats] = 1
+  kernel_t = np.arange(int(bcg_duration * fs)) / fs
+  kernel = np.exp(-kernel_t / bcg_decay) * np.sin(2 * np.pi * bcg_frequency * kernel_t)
+  pulse = fftconvolve(impulses, kernel)[:n]
+  data += bcg_amplitude * rng.uniform(0.5, 1.5, 3) * pulse[:,None]
+
+  data += noise * rng.standard_normal((n, 3))
+  data += drift * np.cumsum(rng.standard_normal((n, 3)), axis=0) / np.sqrt(max(n, 1))
+
+  n_bursts = rng.poisson(motion_bursts_per_hour * duration / 3600)
+  burst_size = int(motion_burst_seconds * fs)
+  for start in rng.integers(0, max(n - burst_size, 1), n_bursts):
+    data[start:start+burst_size] += motion_amplitude * rng.standard_normal((len(data[start:start+burst_size]), 3))
+  return data
+
+def grid(durations, rates, noise_levels):
+  return [{'duration_minutes': d, 'sampling_rate': fs, 'noise': noise} for d in durations for fs in rates for noise in noise_levels]
+
+# Runs an algorithm with its diagnostic output discarded
+def run_quietly(algorithm, data, fs):
+  with contextlib.redirect_stdout(io.StringIO()):
+    return algorithms[algorithm](data, fs)
+
+def best_time(algorithm, data, fs, repeats):
+  seconds = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    hr, br = run_quietly(algorithm, data, fs)
+    seconds.append(time.perf_counter() - start)
+  return min(seconds), hr, br
+
+def peak_memory(algorithm, data, fs):
+  tracemalloc.start()
+  try:
+    run_quietly(algorithm, data, fs)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+def run(cases, algorithm_names, heart_rate=62, breathing_rate=15, repeats=1, measure_memory=True, seed=0):
+  plotting.set_mode('headless')
+  results = []
+  for case in cases:
+    fs = case['sampling_rate']
+    data = synthetic_recording(case['duration_minutes'] * 60, fs, heart_rate, breathing_rate, case['noise'], seed=seed)
+    for algorithm in algorithm_names:
+      seconds, hr, br = best_time(algorithm, data, fs, repeats)
+      result = dict(case, algorithm=algorithm, samples=len(data), seconds=seconds,
+        samples_per_second=len(data) / seconds if seconds > 0 else float('inf'),
+        peak_memory_bytes=peak_memory(algorithm, data, fs) if measure_memory else None,
+        heart_rate=float(hr), breathing_rate=float(br), true_heart_rate=heart_rate, true_breathing_rate=breathing_rate,
+        heart_rate_error=None if algorithm in breathing_only else abs(float(hr) - heart_rate),
+        breathing_rate_error=abs(float(br) - breathing_rate))
+      results.append(result)
+      print_result(result)
+  return results
+
+# Compares BioWatch on a batch of equal length windows, one estimate() call per window
+# against a single estimate_batch() call. Subjects get rates spread over the HR/BR bands.
+def bio_watch_batch_throughput(subjects=1000, seconds=30, fs=50, seed=0):
+  plotting.set_mode('headless')
+  rng = np.random.default_rng(seed)
+  heart_rates = rng.uniform(50, 90, subjects)
+  breathing_rates = rng.uniform(10, 20, subjects)
+  batch = np.stack([synthetic_recording(seconds, fs, hr, br, motion_bursts_per_hour=0, seed=seed + i)
+    for i, (hr, br) in enumerate(zip(heart_rates, breathing_rates))])
+  estimator = BioWatch(fs)
+
+  start = time.perf_counter()
+  loop_rates = np.array([estimator.estimate(window) for window in batch])
+  loop_seconds = time.perf_counter() - start
+  start = time.perf_counter()
+  batch_hr, batch_br = estimator.estimate_batch(batch)
+  batch_seconds = time.perf_counter() - start
+
+  print("BioWatch on %d windows of %g s at %g Hz" % (subjects, seconds, fs))
+  print("  per-call loop: %8.3f s  %10.1f windows/s" % (loop_seconds, subjects / loop_seconds))
+  print("  batch:         %8.3f s  %10.1f windows/s  speedup %.1fx" % (batch_seconds, subjects / batch_seconds, loop_seconds / batch_seconds))
+  print("  largest difference to the loop: HR %.2e bpm, BR %.2e bpm" % (np.max(np.abs(batch_hr - loop_rates[:,0])), np.max(np.abs(batch_br - loop_rates[:,1]))))
+  print("  mean absolute error: HR %.2f bpm, BR %.2f bpm" % (np.mean(np.abs(batch_hr - heart_rates)), np.mean(np.abs(batch_br - breathing_rates))))
+  return {'subjects': subjects, 'seconds': seconds, 'sampling_rate': fs, 'loop_seconds': loop_seconds, 'batch_seconds': batch_seconds}
+
+# Runs variants of each algorithm on one recording, differing in their rate resolution (the
+# first one has none), each on its own and then sharing their common stages through one memo
+def shared_variants(algorithm_names, variants=4, minutes=60, fs=50, seed=0):
+  plotting.set_mode('headless')
+  data = synthetic_recording(minutes * 60, fs, seed=seed)
+  resolutions = [None] + [2.0 ** -i for i in range(variants - 1)]
+  print("%d variants on %g min at %g Hz, rate resolutions %s bpm" % (variants, minutes, fs, resolutions))
+  results = []
+  for algorithm in algorithm_names:
+    estimator_variants = [replace(estimators[algorithm](fs), rate_resolution=r) for r in resolutions]
+    with contextlib.redirect_stdout(io.StringIO()):
+      start = time.perf_counter()
+      separate = [e.estimate(data) for e in estimator_variants]
+      separate_seconds = time.perf_counter() - start
+      memo = pipeline.Memo()
+      start = time.perf_counter()
+      source = pipeline.source(data, memo)
+      shared = [e.estimate(source) for e in estimator_variants]
+      shared_seconds = time.perf_counter() - start
+    stats = memo.stats()
+    result = {'algorithm': algorithm, 'variants': variants, 'separate_seconds': separate_seconds, 'shared_seconds': shared_seconds,
+      'hits': stats['hits'], 'misses': stats['misses'], 'memo_bytes': stats['bytes'],
+      'largest_difference': float(np.max(np.abs(np.array(separate, dtype=float) - np.array(shared, dtype=float))))}
+    results.append(result)
+    print("  %-14s separate %7.3f s  shared %7.3f s  speedup %.1fx  %d hits, %d misses, %.1f MB held, largest difference %.2e bpm" % (
+      algorithm, separate_seconds, shared_seconds, separate_seconds / shared_seconds, stats['hits'], stats['misses'],
+      stats['bytes'] / 1e6, result['largest_difference']))
+  return results
+
+# Corrupts a share of the windows of window_seconds of a recording, in turn by motion, by
+# saturation (motion beyond full scale, clipped) and by a stuck sensor (a constant value)
+def corrupt(data, fs, share, window_seconds=30, seed=0):
+  rng = np.random.default_rng(seed)
+  data = data.copy()
+  window = int(window_seconds * fs)
+  n_windows = len(data) // window
+  for i, w in enumerate(rng.choice(n_windows, int(round(share * n_windows)), replace=False)):
+    span = data[w*window:(w+1)*window]
+    if i % 3 == 0:
+      span += 4 * rng.standard_normal(span.shape)
+    elif i % 3 == 1:
+      span[...] = np.clip(span + 4 * saturation * rng.standard_normal(span.shape), -saturation, saturation)
+    else:
+      span[...] = span[0]
+  return data
+
+# Runs each algorithm on a recording with a share of corrupted windows, on every sample and
+# gated by the default signal quality, with the wall time and rate errors of each
+def quality_gate_throughput(algorithm_names, share=0.5, minutes=60, fs=50, heart_rate=62, breathing_rate=15, seed=0):
+  plotting.set_mode('headless')
+  data = corrupt(synthetic_recording(minutes * 60, fs, heart_rate, breathing_rate, seed=seed), fs, share, seed=seed)
+  print("%g min at %g Hz, %.0f%% of the windows corrupted" % (minutes, fs, 100 * share))
+  results = []
+  for algorithm in algorithm_names:
+    result = {'algorithm': algorithm, 'share': share}
+    for name, signal_quality in [('every_sample', None), ('gated', SignalQuality())]:
+      estimator = replace(estimators[algorithm](fs), signal_quality=signal_quality)
+      with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        hr, br = estimator.estimate(data)
+        result[name + '_seconds'] = time.perf_counter() - start
+      result[name + '_heart_rate_error'] = None if algorithm in breathing_only else abs(float(hr) - heart_rate)
+      result[name + '_breathing_rate_error'] = abs(float(br) - breathing_rate)
+    results.append(result)
+    print("  %-14s every sample %7.3f s  gated %7.3f s  speedup %.1fx  BR error %.2f -> %.2f bpm%s" % (
+      algorithm, result['every_sample_seconds'], result['gated_seconds'], result['every_sample_seconds'] / result['gated_seconds'],
+      result['every_sample_breathing_rate_error'], result['gated_breathing_rate_error'],
+      '' if algorithm in breathing_only else '  HR error %.2f -> %.2f bpm' % (result['every_sample_heart_rate_error'], result['gated_heart_rate_error'])))
+  return results
+
+# Compares the rate errors of each algorithm having a multirate front-end with and without it on
+# recordings of each breathing rate and amplitude (m/s^2). Returns the mean errors of both paths
+# and the algorithms running multirate by default whose mean error is error_tolerance above the
+# one of the full-rate path.
+def multirate_accuracy(algorithm_names, minutes=10, fs=50, heart_rate=62, breathing_rates=(12, 18, 24), amplitudes=(0.02, 0.05, 0.1), seed=0):
+  plotting.set_mode('headless')
+  algorithm_names = [algorithm for algorithm in algorithm_names if hasattr(estimators[algorithm], 'multirate')]
+  print("%g min at %g Hz, breathing at %s bpm with amplitudes %s m/s^2" % (minutes, fs, breathing_rates, amplitudes))
+  cases = [(br, amplitude, synthetic_recording(minutes * 60, fs, heart_rate, br, breathing_amplitude=amplitude, seed=seed))
+    for br in breathing_rates for amplitude in amplitudes]
+  results, regressions = [], []
+  for algorithm in algorithm_names:
+    result = {'algorithm': algorithm, 'sampling_rate': fs}
+    for name, multirate in [('full_rate', False), ('multirate', True)]:
+      estimator = replace(estimators[algorithm](fs), multirate=multirate)
+      with contextlib.redirect_stdout(io.StringIO()):
+        rates = [(br, estimator.estimate(data)) for br, amplitude, data in cases]
+      result[name + '_breathing_rates'] = [float(b) for _, (h, b) in rates]
+      result[name + '_breathing_rate_error'] = float(np.mean([abs(b - br) for br, (h, b) in rates]))
+      result[name + '_heart_rate_error'] = None if algorithm in breathing_only else float(np.mean([abs(h - heart_rate) for br, (h, b) in rates]))
+    results.append(result)
+    print("  %-14s BR error full rate %.2f bpm, multirate %.2f bpm%s" % (algorithm, result['full_rate_breathing_rate_error'],
+      result['multirate_breathing_rate_error'], '' if algorithm in breathing_only else '  HR error %.2f -> %.2f bpm' % (
+      result['full_rate_heart_rate_error'], result['multirate_heart_rate_error'])))
+    for measure in ['breathing_rate_error', 'heart_rate_error']:
+      if estimators[algorithm].multirate and result['full_rate_' + measure] is not None \
+          and result['multirate_' + measure] > result['full_rate_' + measure] + error_tolerance:
+        regressions.append('%s %s at %g Hz: %.2f bpm multirate, %.2f bpm at full rate' % (
+          algorithm, measure, fs, result['multirate_' + measure], result['full_rate_' + measure]))
+  return results, regressions
+
+# Runs an algorithm on a recording read from an .npy file and returns the peak resident
+# memory (bytes) of the process before and after the run, with the estimated rates
+def rss_run(algorithm, path, fs):
+  plotting.set_mode('headless')
+  data = np.load(path)
+  loaded = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+  hr, br = run_quietly(algorithm, data, fs)
+  return loaded, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, float(hr), float(br)
+
+def write_recording(path, hours, fs, dtype, seed):
+  data = synthetic_recording(hours * 3600, fs, seed=seed).astype(dtype)
+  np.save(path, data)
+  return data.nbytes
+
+# Peak resident memory of each algorithm on one long synthetic recording. The recording
+# is generated and every run made in a fresh process, as a process inherits the peak
+# memory of its parent.
+def peak_rss(algorithm_names, hours=24, fs=50, dtype=np.float64, seed=0):
+  context = multiprocessing.get_context('spawn')
+  results = []
+  with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, 'recording.npy')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+      nbytes = pool.submit(write_recording, path, hours, fs, dtype, seed).result()
+    print("%g h at %g Hz, %s: %.1f MB of input" % (hours, fs, np.dtype(dtype).name, nbytes / 1e6))
+    for algorithm in algorithm_names:
+      with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        loaded, peak, hr, br = pool.submit(rss_run, algorithm, path, fs).result()
+      result = {'algorithm': algorithm, 'hours': hours, 'sampling_rate': fs, 'dtype': np.dtype(dtype).name,
+        'loaded_rss_bytes': loaded, 'peak_rss_bytes': peak, 'heart_rate': hr, 'breathing_rate': br}
+      results.append(result)
+      print("  %-14s peak RSS %8.1f MB (%8.1f MB above the loaded input)  HR %.2f  BR %.2f" % (
+        algorithm, peak / 1e6, (peak - loaded) / 1e6, hr, br))
+  return results
+
+def print_result(r):
+  memory = '-' if r['peak_memory_bytes'] is None else '%.1f MB' % (r['peak_memory_bytes'] / 1e6)
+  hr_error = '-' if r['heart_rate_error'] is None else '%.2f' % r['heart_rate_error']
+  print("%6g min %5g Hz noise %-5g %-14s %8.3f s %10.0f samples/s %10s  HR error %6s  BR error %.2f" % (
+    r['duration_minutes'], r['sampling_rate'], r['noise'], r['algorithm'], r['seconds'], r['samples_per_second'],
+    memory, hr_error, r['breathing_rate_error']))
+
+def result_key(r):
+  return (r['algorithm'], r['duration_minutes'], r['sampling_rate'], r['noise'])
+
+# Returns a description of every metric that got worse than the baseline beyond its tolerance
+def compare(results, baseline):
+  baseline = {result_key(r): r for r in baseline}
+  regressions = []
+  for r in results:
+    b = baseline.get(result_key(r))
+    if b is None:
+      continue
+    name = "%s, %g min at %g Hz, noise %g" % result_key(r)
+    if r['seconds'] > b['seconds'] * (1 + time_tolerance) and r['seconds'] - b['seconds'] > time_slack:
+      regressions.append("%s: wall time %.3f s, baseline %.3f s" % (name, r['seconds'], b['seconds']))
+    if r['peak_memory_bytes'] and b['peak_memory_bytes'] and r['peak_memory_bytes'] > b['peak_memory_bytes'] * (1 + memory_tolerance):
+      regressions.append("%s: peak memory %.1f MB, baseline %.1f MB" % (name, r['peak_memory_bytes'] / 1e6, b['peak_memory_bytes'] / 1e6))
+    for metric in ['heart_rate_error', 'breathing_rate_error']:
+      if r[metric] is not None and b[metric] is not None and r[metric] > b[metric] + error_tolerance:
+        regressions.append("%s: %s %.2f bpm, baseline %.2f bpm" % (name, metric.replace('_', ' '), r[metric], b[metric]))
+  return regressions
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark the HR/BR algorithms on synthetic recordings with known rates.')
+  parser.add_argument('--durations', type=float, nargs='+', default=default_durations, help='recording lengths in minutes (24 h = 1440)')
+  parser.add_argument('--rates', type=float, nargs='+', default=default_rates, help='sampling rates in Hz')
+  parser.add_argument('--noise', type=float, nargs='+', default=default_noise, help='white noise levels in m/s^2')
+  parser.add_argument('--heart-rate', type=float, default=62)
+  parser.add_argument('--breathing-rate', type=float, default=15)
+  parser.add_argument('--algorithms', nargs='+', choices=sorted(algorithms.keys()), default=sorted(algorithms.keys()))
+  parser.add_argument('--repeats', type=int, default=1, help='timed runs per case, the fastest is reported')
+  parser.add_argument('--no-memory', action='store_true', help='skip the traced run measuring peak memory')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', help='save the results to this JSON file')
+  parser.add_argument('--baseline', help='JSON results to compare against, exits with status 1 on regressions')
+  parser.add_argument('--bio-watch-batch', type=int, metavar='SUBJECTS', help='only compare BioWatch per-call and batch throughput on this many 30 s windows')
+  parser.add_argument('--peak-rss', type=float, metavar='HOURS', help='only report the peak resident memory of each algorithm on a recording of this many hours')
+  parser.add_argument('--float32', action='store_true', help='run --peak-rss on single precision input')
+  parser.add_argument('--variants', type=int, metavar='N', help='only compare N variants of each algorithm run separately and sharing their stages')
+  parser.add_argument('--quality-gate', type=float, metavar='SHARE', help='only compare each algorithm on every sample and gated by signal quality, with this share of corrupted windows')
+  parser.add_argument('--multirate', action='store_true', help='only compare the rate errors of each algorithm having a multirate front-end with and without it, '
+    'exits with status 1 when one running multirate by default is less accurate')
+  args = parser.parse_args()
+
+  if args.multirate:
+    regressions = []
+    for fs in args.rates:
+      for minutes in args.durations:
+        regressions += multirate_accuracy(args.algorithms, minutes, fs, args.heart_rate, seed=args.seed)[1]
+    for regression in regressions:
+      print("REGRESSION %s" % regression)
+    raise SystemExit(1 if regressions else 0)
+
+  if args.quality_gate is not None:
+    for fs in args.rates:
+      for minutes in args.durations:
+        quality_gate_throughput(args.algorithms, args.quality_gate, minutes, fs, args.heart_rate, args.breathing_rate, args.seed)
+    raise SystemExit(0)
+
+  if args.variants:
+    for fs in args.rates:
+      for minutes in args.durations:
+        shared_variants(args.algorithms, args.variants, minutes, fs, args.seed)
+    raise SystemExit(0)
+
+  if args.peak_rss:
+    for fs in args.rates:
+      peak_rss(args.algorithms, args.peak_rss, fs, np.float32 if args.float32 else np.float64, args.seed)
+    raise SystemExit(0)
+
+  if args.bio_watch_batch:
+    for fs in args.rates:
+      bio_watch_batch_throughput(args.bio_watch_batch, 30, fs, args.seed)
+    raise SystemExit(0)
+
+  results = run(grid(args.durations, args.rates, args.noise), args.algorithms, args.heart_rate, args.breathing_rate,
+    args.repeats, not args.no_memory, args.seed)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, f, indent=2)
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f)['results'])
+    for regression in regressions:
+      print("REGRESSION %s" % regression)
+    print("%d regressions against %s" % (len(regressions), args.baseline))
+    if regressions:
+      raise SystemExit(1)
@@ -1,168 +1,352 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import style
-import scipy.fftpack
-import scipy as sp
-from scipy.stats import zscore
 import pandas as pd
-from scipy.signal import butter, filtfilt
-from scipy import signal
+from dataclasses import dataclass, replace
+import logging
+import sys
 import warnings
+import spectral
+import filters
+import pipeline
+import plotting
+import profiling
+from quality import SignalQuality
 warnings.filterwarnings(action="ignore", module="scipy", message="^internal gelsd")
-style.use('ggplot')
+
+logger = logging.getLogger(__name__)
 
 # Source: https://archive.ics.uci.edu/ml/datasets/MHEALTH+Dataset
 input_file_path = 'datasets/uic_dataset.csv'
 
+# Defaults of the module level functions, BioWatch instances carry their own configuration
 sampling_frequency = 50
-average_filter_window_duration_hr = int((1/7)*sampling_frequency)
-average_filter_window_duration_br = int((40/60)*sampling_frequency)
-T = 1/sampling_frequency
-save_plots = True
 
+# The functions below work on (N, 3) data or on (subjects, N, 3) batches, time runs along axis -2
+
+# z-score of each axis, like scipy.stats.zscore, in place
+@profiling.stage('bio_watch.normalize')
 def normalize(data):
-  for i in range(0, 3):
-    data[:,i] = sp.stats.zscore(data[:,i])
-  return data
+  return pipeline.normalize(data)
+
+# Mean of the last `window` samples along axis, from cumulative sums. Like pandas'
+# rolling mean, the first window-1 samples and windows holding a NaN give NaN.
+# The result is written to out (which may be data) and the sums to the work buffer
+# when given (see spectral.scratch).
+def moving_average(data, window, axis=-2, out=None, work=None):
+  axis = axis % data.ndim
+  def along(a, index):
+    return a[(slice(None),) * axis + (index,)]
+
+  dtype = spectral.float_dtype(data.dtype)
+  finite = np.isfinite(data)
+  all_finite = finite.all()
+  sums = np.cumsum(data if all_finite else np.where(finite, data, 0), axis=axis, dtype=dtype, out=spectral.scratch(work, data.shape, dtype))
+  averages = np.empty(data.shape, dtype=dtype) if out is None else out
+  along(averages, slice(None, window-1))[...] = np.nan
+  along(averages, slice(window-1, window))[...] = along(sums, slice(window-1, window))
+  np.subtract(along(sums, slice(window, None)), along(sums, slice(None, -window)), out=along(averages, slice(window, None)))
+  averages /= window
+  if not all_finite:
+    missing = np.cumsum(~finite, axis=axis)
+    gaps = np.empty(missing.shape, dtype=bool)
+    along(gaps, slice(None, window))[...] = along(missing, slice(window-1, window)) > 0
+    np.greater(along(missing, slice(window, None)), along(missing, slice(None, -window)), out=along(gaps, slice(window, None)))
+    averages[gaps] = np.nan
+  return averages
+
+@profiling.stage('bio_watch.apply_average_filter')
+def apply_average_filter(data, window, work=None):
+  return moving_average(data, window, out=data, work=work)
+
+# Drops the rows holding a NaN: a leading run (as the average filters leave) by slicing,
+# NaN rows elsewhere by copying the finite rows
+def drop_nan_rows(data):
+  finite = np.all(np.isfinite(data.reshape(len(data), -1)), axis=1)
+  start = int(np.argmax(finite)) if finite.any() else len(data)
+  if finite[start:].all():
+    return data[start:]
+  return data[finite]
+
+# Filters every column of data, the design is cached in second-order sections form
+def butter_bandpass_filter(data, lowcut, highcut, fs, order, axis=0):
+  return filters.filtfilt(data, (lowcut, highcut), fs, order, 'band', axis)
+
+# Magnitude of the (x, y, z) components of each sample
+@profiling.stage('bio_watch.aggregate_components')
+def aggregate_components(data):
+  return np.sqrt(np.einsum('...i,...i->...', data, data))
+
+# Heart and breathing rate estimator. The configuration is immutable and every call
+# works on its own copy of the data, so one instance can be shared between threads.
+@dataclass(frozen=True)
+class BioWatch:
+  sampling_frequency: float = 50
+  average_filter_duration_hr: float = 1/7 # seconds
+  average_filter_duration_br: float = 40/60 # seconds
+  filter_order: int = 2
+  bcg_low_freq: float = 4
+  bcg_high_freq: float = 11
+  hr_low_freq: float = 0.66
+  hr_high_freq: float = 2.5
+  br_low_freq: float = 0.13
+  br_high_freq: float = 0.66
+  rate_window_duration: float = 30 # seconds, windows of estimate_windows
+  rate_hop_duration: float = 5 # seconds
+  multirate: bool = True # analyse each band at the lowest adequate sampling rate
+  rate_resolution: float = None # bpm, resolve spectral peaks this finely instead of the FFT bins of 60 fs/N bpm
+  signal_quality: SignalQuality = None # reject the windows failing it before any filter, see quality
+
+  # Hz, of rate_resolution
+  @property
+  def frequency_resolution(self):
+    return self.rate_resolution / 60 if self.rate_resolution else None
+
+  @property
+  def average_filter_window_hr(self):
+    return int(self.average_filter_duration_hr*self.sampling_frequency)
+
+  @property
+  def average_filter_window_br(self):
+    return int(self.average_filter_duration_br*self.sampling_frequency)
+
+  def plot(self, data, title, plot_save_path):
+    plotting.line(plot_save_path, data, title, 'TIME (s)', 'ACCELERATION Ax (m/s^2)', dx=1/self.sampling_frequency)
+
+  # Returns the estimator at the decimated rate and the data (or pipeline node) decimated along axis to
+  # the lowest rate keeping [0, f_high], or this estimator and the data as is without the multirate front-end
+  def decimated(self, data, f_high, axis=0):
+    factor = filters.decimation_factor(self.sampling_frequency, f_high) if self.multirate else 1
+    if factor == 1:
+      return self, data
+    estimator = replace(self, sampling_frequency=self.sampling_frequency / factor)
+    if isinstance(data, pipeline.Node):
+      return estimator, data.then('decimate', filters.decimate, factor, axis, profile='bio_watch.decimate')
+    with profiling.measure('bio_watch.decimate', data):
+      return estimator, filters.decimate(data, factor, axis)
+
+  # Returns the estimator at the decimated rate and the nodes of the runs (nodes) of a recording
+  # decimated one by one, see decimated()
+  def decimated_runs(self, runs, f_high):
+    decimated = [self.decimated(run, f_high) for run in runs]
+    return decimated[0][0], [run for _, run in decimated]
+
+  @profiling.stage('bio_watch.apply_bandpass_butterworth_filter')
+  def apply_bandpass_butterworth_filter(self, data, low_cutoff_freq, high_cutoff_freq, axis=0):
+    return butter_bandpass_filter(data, low_cutoff_freq, high_cutoff_freq, self.sampling_frequency, self.filter_order, axis)
+
+  # Returns amplitude and frequency of the spectral peak within [f_low, f_high] for each axis,
+  # of data or of the value of a pipeline node, or of a list of the runs of a recording (see spectral.runs_peak)
+  @profiling.stage('bio_watch.fft')
+  def fft(self, acc_data, f_low, f_high, work=None):
+    runs = acc_data if isinstance(acc_data, list) else [acc_data]
+    runs = pipeline.gathered(pipeline.source(run).then('drop_nan_rows', drop_nan_rows) for run in runs)
+    return runs.then('peak', spectral.runs_peak, self.sampling_frequency, f_low, f_high, True, work, self.frequency_resolution).value
+
+  # Returns the pipeline node of the data (or node) smoothed by the heart rate average filter,
+  # in place when not shared. Both waves start from it.
+  def smoothed(self, normalized_data, work=None):
+    return pipeline.source(normalized_data).then('average_filter', apply_average_filter, self.average_filter_window_hr, in_place=True, work=work)
+
+  # Returns the node of the respiratory wave of each axis, the first rows are NaN until the average filters are filled
+  def respiratory_wave(self, smoothed, work=None):
+    smooth_data = pipeline.source(smoothed).then('average_filter', apply_average_filter, self.average_filter_window_br, in_place=True, work=work)
+    if plotting.enabled():
+      self.plot(smooth_data.value[:,0], 'Smoothened Accelerometer Data', 'plots/bio_watch/smoothened_ax.png')
+    return smooth_data
+
+  # Breathing rate of smoothed data, see smoothed(), or of the list of the smoothed runs of a recording,
+  # filtered one by one
+  @profiling.stage('bio_watch.calculate_breathing_rate')
+  def calculate_breathing_rate(self, smoothed, work=None):
+    runs = smoothed if isinstance(smoothed, list) else [smoothed]
+    waves = [self.respiratory_wave(run, work).then('drop_nan_rows', drop_nan_rows) for run in runs]
+    estimator, smooth_data = self.decimated_runs(waves, self.br_high_freq)
 
-def apply_average_filter(data, window):
-  for i in range(0, 3):
-    data[:,i] = np.array(pd.Series(data[:,i]).rolling(window=window).mean())
-  return data
+    br_amp, br_f, f, amplitude = estimator.fft(smooth_data, self.br_low_freq, self.br_high_freq, work)
+    plot_fft(f, amplitude[:,0], 'plots/bio_watch/br_fft_xaxis.png')
+    plot_fft(f, amplitude[:,1], 'plots/bio_watch/br_fft_yaxis.png')
+    plot_fft(f, amplitude[:,2], 'plots/bio_watch/br_fft_zaxis.png')
+    logger.info('Max Amplitude within %s and %s Hz frequency:', self.br_low_freq, self.br_high_freq)
+    logger.info('X-Axis: %s', br_amp[0])
+    logger.info('Y-Axis: %s', br_amp[1])
+    logger.info('Z-Axis: %s', br_amp[2])
+    chosen_axis = np.argmax(br_amp)
+
+    logger.info("Max amplitude chosen: %s", br_amp[chosen_axis])
+    logger.info("Frequency of chosen amplitude: %s", br_f[chosen_axis])
+    logger.info("Respiratory Rate (bpm): %s", 60*br_f[chosen_axis])
+    return 60*br_f[chosen_axis]
+
+  # Returns the node of the pulse wave of smoothed data, which starts after the rows the average filter leaves NaN
+  def pulse_wave(self, smoothed):
+    smooth_data = pipeline.source(smoothed).then('drop_nan_rows', drop_nan_rows)
+    if plotting.enabled():
+      self.plot(smooth_data.value[:,0], 'Smoothened Accelerometer Data - HR', 'plots/bio_watch/smoothened_ax_hr.png')
+
+    smooth_data = smooth_data.then('bandpass', butter_bandpass_filter, self.bcg_low_freq, self.bcg_high_freq, self.sampling_frequency, self.filter_order)
+    if plotting.enabled():
+      self.plot(smooth_data.value[:,0], 'Bandpass-1 Accelerometer Data', 'plots/bio_watch/bandpass1_ax.png')
+
+    aggregated_data = smooth_data.then('aggregate_components', aggregate_components)
+
+    bandpass2_data = aggregated_data.then('bandpass', butter_bandpass_filter, self.hr_low_freq, self.hr_high_freq, self.sampling_frequency, self.filter_order)
+    if plotting.enabled():
+      self.plot(bandpass2_data.value, 'Pulse wave from Accelerometer Data', 'plots/bio_watch/pulse_wave.png')
+    return bandpass2_data
+
+  # Heart rate of smoothed data, see smoothed(), or of the list of the smoothed runs of a recording,
+  # filtered one by one
+  @profiling.stage('bio_watch.calculate_heart_rate')
+  def calculate_heart_rate(self, smoothed, work=None):
+    runs = smoothed if isinstance(smoothed, list) else [smoothed]
+    # the filters run at the full rate, as designed, the transform at the lowest rate keeping their band
+    estimator, bandpass2_data = self.decimated_runs([self.pulse_wave(run) for run in runs], self.hr_high_freq)
+    max_amp, max_freq, f, amplitude = estimator.fft(bandpass2_data, self.hr_low_freq, self.hr_high_freq, work)
+    plot_fft(f, amplitude, 'plots/bio_watch/hr_fft.png')
+    logger.info('Max Amplitude: %s', max_amp)
+    logger.info('Max Frequency: %s', max_freq)
+    logger.info('Heart Rate (bpm): %s', 60*max_freq)
+    return 60*max_freq
+
+  # Returns (heart rate, breathing rate) in bpm. The given data (or pipeline node) is not modified:
+  # the stages work in place on one copy, in float32 for float32 data and float64 otherwise, and
+  # share one work buffer for the sums of the average filters and the padded input of the
+  # transforms. Given a pipeline memo, the stages run on their own copies and are shared with the
+  # other estimates of the same recording through it. With a signal_quality, only the windows it
+  # accepts are estimated, each run of consecutive accepted windows filtered on its own.
+  @profiling.stage('bio_watch.estimate')
+  def estimate(self, data, memo=None):
+    source = pipeline.source(data, memo)
+    runs = [source]
+    if self.signal_quality is not None:
+      runs, accepted = self.signal_quality.gated(source, self.sampling_frequency, self.br_low_freq, self.bcg_high_freq)
+      if not accepted.any():
+        logger.warning('No window of sufficient signal quality to process')
+        return 0, 0
+    data = source.value
+    work = spectral.work_buffer(max(len(run.value) for run in runs), data.shape[1], spectral.float_dtype(data.dtype))
+    self.plot(data[:,0], 'Raw Accelerometer Data', 'plots/bio_watch/raw_ax.png')
+    smoothed = []
+    for run in runs:
+      normalized_data = run.then('normalize', pipeline.normalized)
+      if plotting.enabled():
+        self.plot(normalized_data.value[:,0], 'Normalized Accelerometer Data', 'plots/bio_watch/normalized.png')
+      smoothed.append(self.smoothed(normalized_data, work))
+      # both rates read it, it is computed here rather than in the stage of the first one
+      smoothed[-1].value
+    hr = self.calculate_heart_rate(smoothed, work)
+    br = self.calculate_breathing_rate(smoothed, work)
+    return hr, br
+
+  # Returns heart and breathing rates (bpm) over time, estimated in windows of rate_window_duration
+  # every rate_hop_duration, as a DataFrame with the window centre time (s) and the confidence of
+  # each rate (share of the band power in its spectral peak). Filtering runs once on the whole
+  # recording and the spectra of all windows come from one batched transform. With a signal_quality,
+  # the windows holding a sample it rejects have NaN rates.
+  @profiling.stage('bio_watch.estimate_windows')
+  def estimate_windows(self, data):
+    fs = self.sampling_frequency
+    valid = None
+    if self.signal_quality is not None:
+      valid = self.signal_quality.accepted_samples(np.asarray(data), fs, self.br_low_freq, self.bcg_high_freq)
+    normalized_data = normalize(np.array(data, dtype=spectral.float_dtype(np.asarray(data).dtype)))
+    smoothed = self.smoothed(normalized_data)
+    pulse = self.pulse_wave(smoothed).value
+    smooth_data = self.respiratory_wave(smoothed).value
+    # both waves are aligned on the first row left valid by the two average filters
+    br_start = np.argmax(np.all(np.isfinite(smooth_data), axis=1))
+    pulse = pulse[br_start - (len(normalized_data) - len(pulse)):]
+    smooth_data = smooth_data[br_start:]
+    valid = valid if valid is None else valid[br_start:]
+
+    times, hr_f, hr_amp, hr_confidence = spectral.windowed_peaks(pulse, fs, self.hr_low_freq, self.hr_high_freq,
+      self.rate_window_duration, self.rate_hop_duration, detrend=True, resolution=self.frequency_resolution, valid=valid)
+    times, br_f, br_amp, br_confidence = spectral.windowed_peaks(smooth_data, fs, self.br_low_freq, self.br_high_freq,
+      self.rate_window_duration, self.rate_hop_duration, detrend=True, resolution=self.frequency_resolution, valid=valid)
+    chosen_axis = np.expand_dims(np.argmax(np.nan_to_num(br_amp, nan=-np.inf), axis=1), 1)
+    rates = pd.DataFrame({'time': times + br_start / fs, 'heart_rate': 60*hr_f, 'heart_rate_confidence': hr_confidence,
+      'breathing_rate': 60*np.take_along_axis(br_f, chosen_axis, axis=1)[:,0],
+      'breathing_rate_confidence': np.take_along_axis(br_confidence, chosen_axis, axis=1)[:,0]})
+    plot_rates(rates, 'plots/bio_watch/rates.png')
+    return rates
+
+  # Returns the heart and breathing rates (bpm) of every subject of a (subjects, N, 3) batch of
+  # finite recordings of equal length, the rates estimate() gives for each subject on its own.
+  # With a signal_quality, the subjects with a rejected window are estimated by estimate(), one by
+  # one, and the others together.
+  @profiling.stage('bio_watch.estimate_batch')
+  def estimate_batch(self, data):
+    if self.signal_quality is None:
+      return self.batch_rates(data)
+    data = np.asarray(data)
+    complete = np.array([self.signal_quality.usable(subject, self.sampling_frequency, self.br_low_freq, self.bcg_high_freq)[1].all()
+      for subject in data], dtype=bool)
+    hr, br = np.zeros(len(data)), np.zeros(len(data))
+    if complete.any():
+      hr[complete], br[complete] = self.batch_rates(data[complete])
+    for index in np.flatnonzero(~complete):
+      hr[index], br[index] = self.estimate(data[index])
+    return hr, br
+
+  # Rates of every subject of a batch, each stage running on the whole batch at once. Nothing is plotted.
+  def batch_rates(self, data):
+    normalized_data = normalize(np.array(data, dtype=spectral.float_dtype(np.asarray(data).dtype)))
+    smooth_data = apply_average_filter(normalized_data, self.average_filter_window_hr)
+    start = self.average_filter_window_hr - 1 # rows left NaN by the average filter
+    bandpass1_data = self.apply_bandpass_butterworth_filter(smooth_data[:,start:], self.bcg_low_freq, self.bcg_high_freq, axis=1)
+    pulse = self.apply_bandpass_butterworth_filter(aggregate_components(bandpass1_data), self.hr_low_freq, self.hr_high_freq, axis=1)
+    estimator, pulse = self.decimated(pulse, self.hr_high_freq, axis=1)
+    hr_amp, hr_f, f, amplitude = spectral.peak(pulse.T, estimator.sampling_frequency, self.hr_low_freq, self.hr_high_freq, detrend=True, resolution=self.frequency_resolution)
+
+    smooth_data = apply_average_filter(smooth_data, self.average_filter_window_br)
+    start += self.average_filter_window_br - 1
+    estimator, smooth_data = self.decimated(smooth_data[:,start:], self.br_high_freq, axis=1)
+    br_amp, br_f, f, amplitude = spectral.peak(np.moveaxis(smooth_data, 1, 0), estimator.sampling_frequency, self.br_low_freq, self.br_high_freq, detrend=True, resolution=self.frequency_resolution)
+    chosen_axis = np.argmax(br_amp, axis=1)
+    return 60*hr_f, 60*br_f[np.arange(len(br_f)), chosen_axis]
+
+# Estimator configured by the module level defaults
+def default_estimator():
+  return BioWatch(sampling_frequency)
 
 def plot(data, title, plot_save_path):
-  N = len(data)
-  y = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(y, data)
-
-  plt.title(title)
-  plt.ylabel('ACCELERATION Ax (m/s^2)')
-  plt.xlabel('TIME (s)')
-  draw_plot(plot_save_path)
-  plt.close()
-
-def draw_plot(plot_save_path):
-  if (save_plots):
-    plt.savefig(plot_save_path)
-  else:
-    plt.draw()
-    plt.pause(5)
-
-def butter_bandpass(lowcut, highcut, fs, order):
-  nyq = 0.5 * fs
-  low = lowcut / nyq
-  high = highcut / nyq
-  b, a = butter(order, [low, high], btype='band')
-  return b, a
-
-def butter_bandpass_filter(data, lowcut, highcut, fs, order):
-  b, a = butter_bandpass(lowcut, highcut, fs, order)
-  y = filtfilt(b, a, data)
-  return y
+  default_estimator().plot(data, title, plot_save_path)
 
 def apply_bandpass_butterworth_filter(data, low_cutoff_freq, high_cutoff_freq):
-  order = 2
-  y = butter_bandpass_filter(data, low_cutoff_freq, high_cutoff_freq, sampling_frequency, order)
-  return y
+  return default_estimator().apply_bandpass_butterworth_filter(data, low_cutoff_freq, high_cutoff_freq)
 
-def aggregate_components(data):
-  return np.array(list(map(lambda c: np.sqrt(np.sum(np.square(c))) , data)), dtype=np.float64)
-
-def fft(acc_data, f_low, f_high, plot_save_path):
-  acc_data = acc_data[~np.isnan(acc_data)]
-  acc_data = sp.signal.detrend(acc_data)
-  N = len(acc_data)
-
-  fft_data = sp.fftpack.fft(acc_data)
-  f = np.linspace(0, N/sampling_frequency, N)
-
-  plt.plot(f, np.abs(fft_data))
-  plt.xlabel('Frequency in Hertz [Hz]')
-  plt.ylabel('Magnitude')
-  plt.title('FFT')
-  draw_plot(plot_save_path)
-  plt.close()
-
-  max_amp = 0
-  max_index = 0
-  index = 0
-  for c in fft_data:
-    if f[index] < f_low or f[index] > f_high:
-      index = index + 1
-      continue;
-    real = np.real(c)
-    img = np.imag(c)
-    amp = np.sqrt(real*real + img*img)
-    if max_amp < amp:
-      max_amp = amp
-      max_index = index
-    index = index + 1
-
-  return max_amp, f[max_index]
+def fft(acc_data, f_low, f_high, work=None):
+  return default_estimator().fft(acc_data, f_low, f_high, work)
+
+def plot_fft(f, amplitude, plot_save_path):
+  plotting.line(plot_save_path, amplitude, 'FFT', 'Frequency in Hertz [Hz]', 'Magnitude', x=f)
 
 def calculate_breathing_rate(normalized_data):
-  smooth_data = apply_average_filter(normalized_data, average_filter_window_duration_br)
-  plot(smooth_data[:,0], 'Smoothened Accelerometer Data', 'plots/bio_watch/smoothened_ax.png')
-
-  amp_to_freq = {}
-  breathing_low_freq = 0.13
-  breathing_high_freq = 0.66
-  print('Max Amplitude within 0.13 and 0.66 Hz frequency:')
-  br_x_amp, br_x_f = fft(smooth_data[:,0], breathing_low_freq, breathing_high_freq, 'plots/bio_watch/br_fft_xaxis.png')
-  amp_to_freq[br_x_amp] = br_x_f
-  print('X-Axis:', br_x_amp)
-  br_y_amp, br_y_f = fft(smooth_data[:,1], breathing_low_freq, breathing_high_freq, 'plots/bio_watch/br_fft_yaxis.png')
-  amp_to_freq[br_y_amp] = br_y_f
-  print('Y-Axis:', br_y_amp)
-  br_z_amp, br_z_f = fft(smooth_data[:,2], breathing_low_freq, breathing_high_freq, 'plots/bio_watch/br_fft_zaxis.png')
-  amp_to_freq[br_z_amp] = br_z_f
-  print('Z-Axis:', br_z_amp)
-  br_max_amp = max([br_x_amp, br_y_amp, br_z_amp])
-
-  print("Max amplitude chosen:", br_max_amp)
-  print("Frequency of chosen amplitude:", amp_to_freq[br_max_amp])
-  print("Respiratory Rate (bpm):", 60*amp_to_freq[br_max_amp])
-  return 60*amp_to_freq[br_max_amp]
+  return default_estimator().calculate_breathing_rate(normalized_data)
 
 def calculate_heart_rate(normalized_data):
-  smooth_data = apply_average_filter(normalized_data, average_filter_window_duration_hr)
-  smooth_data = np.array(list(filter(lambda row: np.isfinite(np.sum(row)), smooth_data)), dtype=np.float64)
-  plot(smooth_data[:,0], 'Smoothened Accelerometer Data - HR', 'plots/bio_watch/smoothened_ax_hr.png')
-
-  low_cutoff_freq = 4
-  high_cutoff_freq = 11
-  smooth_data[:,0] = apply_bandpass_butterworth_filter(smooth_data[:,0], low_cutoff_freq, high_cutoff_freq)
-  smooth_data[:,1] = apply_bandpass_butterworth_filter(smooth_data[:,1], low_cutoff_freq, high_cutoff_freq)
-  smooth_data[:,2] = apply_bandpass_butterworth_filter(smooth_data[:,2], low_cutoff_freq, high_cutoff_freq)
-  plot(smooth_data[:,0], 'Bandpass-1 Accelerometer Data', 'plots/bio_watch/bandpass1_ax.png')
-
-  aggregated_data = aggregate_components(smooth_data)
-
-  high_cutoff_freq = 2.5
-  low_cutoff_freq = 0.66
-  bandpass2_data = apply_bandpass_butterworth_filter(aggregated_data, low_cutoff_freq, high_cutoff_freq)
-  plot(bandpass2_data, 'Pulse wave from Accelerometer Data', 'plots/bio_watch/pulse_wave.png')
-
-  max_amp, max_freq = fft(bandpass2_data, 0.66, 2.5, 'plots/bio_watch/hr_fft.png')
-  print('Max Amplitude:', max_amp)
-  print('Max Frequency:', max_freq)
-  print('Heart Rate (bpm):', 60*max_freq)
-  return 60*max_freq
-
-def bio_watch(data, sampling_freq):
-  global sampling_frequency
-  sampling_frequency = sampling_freq
-  plot(data[:,0], 'Raw Accelerometer Data', 'plots/bio_watch/raw_ax.png')
-  normalized_data = normalize(data)
-  plot(normalized_data[:,0], 'Normalized Accelerometer Data', 'plots/bio_watch/normalized.png')
-
-  hr = calculate_heart_rate(normalized_data)
-  br = calculate_breathing_rate(normalized_data)
-  return hr, br
+  estimator = default_estimator()
+  return estimator.calculate_heart_rate(estimator.smoothed(normalized_data))
+
+def plot_rates(rates, plot_save_path):
+  if not plotting.enabled():
+    return
+  plotting.figure(plot_save_path, [
+    plotting.panel([plotting.series(rates['heart_rate'], x=rates['time'])], ylabel='Heart Rate (bpm)'),
+    plotting.panel([plotting.series(rates['breathing_rate'], x=rates['time'])], xlabel='Time (s)', ylabel='Breathing Rate (bpm)')])
+
+def bio_watch(data, sampling_freq, memo=None):
+  return BioWatch(sampling_freq).estimate(data, memo)
+
+# Heart and breathing rates of a (subjects, N, 3) batch
+def bio_watch_batch(data, sampling_freq):
+  return BioWatch(sampling_freq).estimate_batch(data)
+
+def bio_watch_windows(data, sampling_freq, window_seconds=30, hop_seconds=5):
+  return BioWatch(sampling_freq, rate_window_duration=window_seconds, rate_hop_duration=hop_seconds).estimate_windows(data)
 
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
   data = pd.read_csv(input_file_path).values
   print("Number of records:", len(data))
 
   bio_watch(data, sampling_frequency)
-
@@ -0,0 +1,294 @@
+import sys
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+import spectral
+import filters
+import plotting
+from bio_watch import BioWatch
+
+# Source: https://archive.ics.uci.edu/ml/datasets/MHEALTH+Dataset
+input_file_path = 'datasets/uic_dataset.csv'
+
+# bpm, of (hr, br), of the streaming estimates from the batch estimate of the same window: of
+# every estimate when the stream normalizes with the statistics of the whole recording, as the
+# batch estimate does, and of the median estimate with its running statistics
+parity_tolerance = (0.1, 0.1)
+running_tolerance = (0.5, 0.5)
+
+# Sliding DFT over a fixed set of bins of a window of the last `window` samples.
+# Adding h samples costs O(h * bins), independent of the window length. With
+# detrend, the coefficients of the least squares line through the window are
+# subtracted when reading the amplitudes, like scipy.signal.detrend.
+class SlidingDFT:
+  def __init__(self, window, bins, axes, detrend=True):
+    self.window = window
+    self.bins = np.asarray(bins)
+    self.detrend = detrend
+    self.ring = np.zeros((window, axes))
+    self.position = 0 # oldest sample of the window
+    self.coefficients = np.zeros((len(self.bins), axes), dtype=np.complex128)
+    self.sum = np.zeros(axes) # sum of the samples in the window
+    self.weighted_sum = np.zeros(axes) # sum of the samples weighted by their index in the window
+
+    W = window
+    self.index_sum = W * (W - 1) / 2
+    self.index_square_sum = (W - 1) * W * (2 * W - 1) / 6
+    # DFT of a constant of ones and of the ramp 0..W-1 at each bin
+    z = np.exp(-2j * np.pi * self.bins / W)
+    nonzero = self.bins % W != 0
+    self.ones_dft = np.where(nonzero, 0, W).astype(np.complex128)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      self.ramp_dft = np.where(nonzero, -W / (1 - z), self.index_sum)
+
+  def update(self, samples):
+    h = len(samples)
+    # h <= window, so the samples leaving the window are all in the ring
+    index = (self.position + np.arange(h)) % self.window
+    leaving = self.ring[index]
+    offsets = np.arange(h)[:,None]
+    self.weighted_sum = (self.weighted_sum - (offsets * leaving).sum(axis=0) - h * (self.sum - leaving.sum(axis=0))
+      + ((self.window - h + offsets) * samples).sum(axis=0))
+    self.sum = self.sum + samples.sum(axis=0) - leaving.sum(axis=0)
+
+    change = samples - leaving
+    self.ring[index] = samples
+    self.position = (self.position + h) % self.window
+    rotation = np.exp(2j * np.pi * np.outer(self.bins, np.arange(h, 0, -1)) / self.window)
+    self.coefficients = self.coefficients * np.exp(2j * np.pi * self.bins * h / self.window)[:,None] + rotation @ change
+
+  # Recomputes the state from the ring, removes accumulated rounding errors
+  def resync(self):
+    ordered = np.roll(self.ring, -self.position, axis=0)
+    kernel = np.exp(-2j * np.pi * np.outer(self.bins, np.arange(self.window)) / self.window)
+    self.coefficients = kernel @ ordered
+    self.sum = ordered.sum(axis=0)
+    self.weighted_sum = (np.arange(self.window)[:,None] * ordered).sum(axis=0)
+
+  def amplitude(self):
+    if not self.detrend:
+      return np.abs(self.coefficients)
+    W = self.window
+    slope = (W * self.weighted_sum - self.index_sum * self.sum) / (W * self.index_square_sum - self.index_sum ** 2)
+    intercept = (self.sum - slope * self.index_sum) / W
+    trend = self.ones_dft[:,None] * intercept[None,:] + self.ramp_dft[:,None] * slope[None,:]
+    return np.abs(self.coefficients - trend)
+
+# The last `window` samples, in a ring
+class RingBuffer:
+  def __init__(self, window, axes):
+    self.ring = np.zeros((window, axes))
+    self.position = 0 # next sample to overwrite
+    self.count = 0
+
+  # Adds at most window samples
+  def update(self, samples):
+    index = (self.position + np.arange(len(samples))) % len(self.ring)
+    self.ring[index] = samples
+    self.position = (self.position + len(samples)) % len(self.ring)
+    self.count = min(self.count + len(samples), len(self.ring))
+
+  # Returns the samples in the ring, oldest first
+  def values(self):
+    return np.roll(self.ring, -self.position, axis=0)[len(self.ring) - self.count:]
+
+# Moving average over the last `window` samples, carrying the previous samples between chunks
+class MovingAverage:
+  def __init__(self, window, axes):
+    self.window = window
+    self.tail = np.zeros((0, axes))
+
+  # Returns the averages of the samples that complete a full window
+  def update(self, samples):
+    extended = np.concatenate((self.tail, samples))
+    self.tail = extended[-(self.window - 1):] if self.window > 1 else extended[:0]
+    if len(extended) < self.window:
+      return extended[:0]
+    sums = np.cumsum(np.concatenate((np.zeros((1, extended.shape[1])), extended)), axis=0)
+    return (sums[self.window:] - sums[:-self.window]) / self.window
+
+# Zero-phase band-pass filter of the batch estimator, made causal by a delay of `delay`
+# samples (see filters.zero_phase_taps), carrying its state between chunks. The first
+# delay outputs precede the first sample.
+class ZeroPhaseFilter:
+  def __init__(self, low, high, fs, order):
+    self.taps = filters.zero_phase_taps((low, high), fs, order, 'band')
+    self.delay = (len(self.taps) - 1) // 2
+    self.zi = None
+
+  def update(self, samples):
+    if len(samples) == 0:
+      return samples
+    if self.zi is None:
+      self.zi = np.zeros((len(self.taps) - 1, samples.shape[1]))
+    filtered, self.zi = lfilter(self.taps, 1.0, samples, axis=0, zi=self.zi)
+    return filtered
+
+# Delays samples by `delay` samples, the first samples come out once delay more have arrived
+class Delay:
+  def __init__(self, delay, axes):
+    self.delay = delay
+    self.tail = np.zeros((0, axes))
+
+  def update(self, samples):
+    extended = np.concatenate((self.tail, samples))
+    ready = max(len(extended) - self.delay, 0)
+    self.tail = extended[ready:]
+    return extended[:ready]
+
+# Real-time version of the BioWatch estimator. Samples are pushed in chunks of any
+# size, an estimate is emitted every hop_seconds. Every stage keeps its state, so each
+# update costs O(hop). The band-pass filters are the zero-phase filters of the batch
+# estimator, delayed by `delay` samples to be causal, and the respiratory wave is
+# delayed as much: each estimate is the one estimate_windows gives for the window of
+# window_seconds ending delay samples before the newest sample, and is emitted with
+# the time of that window's centre. Samples are normalized by the running mean and
+# variance of each axis, or by a given (mean, std) of each axis; the batch estimate
+# normalizes by those of the whole recording, which weights the axes slightly
+# differently and can tip the choice between two near-equal spectral peaks.
+# finish() estimates the last window_seconds of raw samples with the batch
+# estimator, which filters that window alone.
+class BioWatchStream:
+  def __init__(self, estimator=None, window_seconds=30, hop_seconds=1, resync_hops=300, normalization=None):
+    self.estimator = estimator or BioWatch()
+    fs = self.estimator.sampling_frequency
+    self.fs = fs
+    self.window = int(window_seconds * fs)
+    self.hop = int(hop_seconds * fs)
+    self.resync_hops = resync_hops
+    e = self.estimator
+
+    self.count = 0
+    self.mean = np.zeros(3)
+    self.m2 = np.zeros(3)
+    self.normalization = normalization
+    self.hr_average = MovingAverage(e.average_filter_window_hr, 3)
+    self.br_average = MovingAverage(e.average_filter_window_br, 3)
+    self.bcg_filter = ZeroPhaseFilter(e.bcg_low_freq, e.bcg_high_freq, fs, e.filter_order)
+    self.pulse_filter = ZeroPhaseFilter(e.hr_low_freq, e.hr_high_freq, fs, e.filter_order)
+    self.delay = self.bcg_filter.delay + self.pulse_filter.delay
+    self.br_delay = Delay(self.delay, 3)
+    # samples before both spectra cover a full window of valid samples
+    self.warmup = self.window + self.delay + e.average_filter_window_hr + e.average_filter_window_br - 2
+
+    self.hr_f, hr_bins = self.band_bins(e.hr_low_freq, e.hr_high_freq)
+    self.br_f, br_bins = self.band_bins(e.br_low_freq, e.br_high_freq)
+    self.pulse_dft = SlidingDFT(self.window, hr_bins, 1)
+    self.br_dft = SlidingDFT(self.window, br_bins, 3)
+
+    self.raw = RingBuffer(self.window, 3)
+    self.samples_until_hop = self.hop
+    self.hops = 0
+
+  # Bins covering [low, high] plus one neighbour on each side for peak interpolation
+  def band_bins(self, low, high):
+    first = max(int(np.ceil(low * self.window / self.fs)) - 1, 0)
+    last = int(np.floor(high * self.window / self.fs)) + 1
+    bins = np.arange(first, last + 1)
+    return bins * self.fs / self.window, bins
+
+  # Running z-score, mean and variance include the given chunk
+  def normalize(self, samples):
+    if self.normalization is not None:
+      self.count += len(samples)
+      mean, std = self.normalization
+      return (samples - mean) / np.where(std == 0, 1, std)
+    n = len(samples)
+    chunk_mean = samples.mean(axis=0)
+    delta = chunk_mean - self.mean
+    total = self.count + n
+    self.m2 = self.m2 + ((samples - chunk_mean) ** 2).sum(axis=0) + delta ** 2 * self.count * n / total
+    self.mean = self.mean + delta * n / total
+    self.count = total
+    std = np.sqrt(self.m2 / total)
+    std[std == 0] = 1
+    return (samples - self.mean) / std
+
+  def process(self, samples):
+    self.raw.update(samples)
+    normalized = self.normalize(samples)
+    smooth_hr = self.hr_average.update(normalized)
+    if len(smooth_hr):
+      bcg = self.bcg_filter.update(smooth_hr)
+      pulse = self.pulse_filter.update(np.sqrt(np.sum(np.square(bcg), axis=1))[:,None])
+      self.pulse_dft.update(pulse)
+      br = self.br_delay.update(self.br_average.update(smooth_hr))
+      if len(br):
+        self.br_dft.update(br)
+
+  def estimate(self):
+    e = self.estimator
+    hr_amp, hr_freq = spectral.find_peak(self.hr_f, self.pulse_dft.amplitude(), e.hr_low_freq, e.hr_high_freq)
+    br_amp, br_freq = spectral.find_peak(self.br_f, self.br_dft.amplitude(), e.br_low_freq, e.br_high_freq)
+    return 60*hr_freq[0], 60*br_freq[np.argmax(br_amp)]
+
+  # Returns (hr, br) in bpm of the batch estimate of the last window_seconds of raw samples. Costs
+  # a batch estimate of the window, to call at the end of a recording rather than every hop.
+  def finish(self):
+    return self.estimator.estimate(self.raw.values())
+
+  # Adds samples of shape (n, 3) and returns the estimates (window centre time (s), hr, br) emitted meanwhile
+  def push(self, samples):
+    samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+    emitted = []
+    start = 0
+    while start < len(samples):
+      # split at hop boundaries, pieces never exceed the window of the sliding DFT
+      size = min(self.samples_until_hop, self.window, len(samples) - start)
+      self.process(samples[start:start+size])
+      start += size
+      self.samples_until_hop -= size
+      if self.samples_until_hop == 0:
+        self.samples_until_hop = self.hop
+        self.hops += 1
+        if self.hops % self.resync_hops == 0:
+          self.pulse_dft.resync()
+          self.br_dft.resync()
+        if self.count >= self.warmup:
+          hr, br = self.estimate()
+          emitted.append(((self.count - self.delay - self.window / 2) / self.fs, hr, br))
+    return emitted
+
+# Replays a recording in chunks of chunk_size samples through a stream with windows of
+# window_seconds and returns, for every estimate it emits, (time (s), hr, br) of the stream
+# and of the batch estimate of the same window: estimate_windows of the whole recording,
+# at a hop of one sample so that every window the stream can emit is in it. With
+# recording_normalization, the stream normalizes as the batch estimate does.
+def parity(data, fs, window_seconds=30, chunk_size=37, recording_normalization=False):
+  estimator = BioWatch(fs, rate_window_duration=window_seconds, rate_hop_duration=1 / fs)
+  normalization = (data.mean(axis=0), data.std(axis=0)) if recording_normalization else None
+  stream = BioWatchStream(estimator, window_seconds=window_seconds, hop_seconds=1, normalization=normalization)
+  emitted = []
+  for start in range(0, len(data), chunk_size):
+    emitted += stream.push(data[start:start+chunk_size])
+  streamed = np.array(emitted).reshape(-1, 3)
+  batch = estimator.estimate_windows(data)
+  # both give window centres in samples, whole or half
+  index = pd.Index(np.round(batch['time'].values * fs * 2).astype(np.int64))
+  rows = index.get_indexer(np.round(streamed[:,0] * fs * 2).astype(np.int64))
+  batched = batch[['time', 'heart_rate', 'breathing_rate']].values[rows]
+  return streamed, batched
+
+# Replays a recording and checks the streaming estimates against the batch estimate of the
+# same windows: every one within parity_tolerance (bpm) of (hr, br) when normalized as the
+# batch estimate, the median within running_tolerance with the running normalization
+if __name__ == '__main__':
+  plotting.set_mode('headless')
+  data = pd.read_csv(input_file_path).values
+  fs = 50
+  stream = BioWatchStream(BioWatch(fs))
+  print("Windows of 30 s, estimated %.2f s after their centre" % ((stream.delay + stream.window / 2) / fs))
+  failures = []
+  for recording_normalization, tolerance in [(True, parity_tolerance), (False, running_tolerance)]:
+    streamed, batched = parity(data, fs, recording_normalization=recording_normalization)
+    error = np.abs(streamed[:,1:] - batched[:,1:])
+    name = 'recording' if recording_normalization else 'running'
+    print("%s normalization, %d estimates. Difference from the batch estimate HR: median %.3f, max %.3f bpm, BR: median %.3f, max %.3f bpm"
+      % ((name, len(error)) + tuple(np.column_stack((np.median(error, axis=0), error.max(axis=0))).ravel())))
+    checked = error.max(axis=0) if recording_normalization else np.median(error, axis=0)
+    if np.any(checked > tolerance):
+      failures.append("%s normalization off by %.2f/%.2f bpm (tolerance %.2f/%.2f)" % ((name,) + tuple(checked) + tolerance))
+  print("Last window at %.2f s, streaming HR: %.2f bpm, BR: %.2f bpm, batch HR: %.2f bpm, BR: %.2f bpm" % (tuple(streamed[-1]) + tuple(batched[-1,1:])))
+  if failures:
+    sys.exit("Streaming estimates off the batch estimate: " + "; ".join(failures))
+  print("Parity within %.2f/%.2f bpm (every estimate) and %.2f/%.2f bpm (median, running normalization)" % (parity_tolerance + running_tolerance))
@@ -1,16 +1,137 @@
-import pandas as pd
+import argparse
+import collections
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+import pandas as pd
+
+import ingest
+
+# Converts raw recordings into binary .npy files with a JSON metadata file next
+# to each (sampling rate, source fingerprint, shape), as read by ingest.py.
+#
+# hmp:     HMP ADL accelerometer .txt files, whitespace separated x y z codes in
+#          [0..63] for [-1.5 g..+1.5 g], sampled at 32 Hz
+# mhealth: MHEALTH .log files, whitespace separated sensor columns sampled at
+#          50 Hz, of which three accelerometer columns are kept (the right lower
+#          arm by default)
+#
+# Files are converted in parallel. A file is skipped when its output was converted
+# from the source as it is now (same size and mtime) with the same settings: format,
+# sampling rate, dtype, kept columns and CSV copy.
+
+modes = {
+  'hmp': {'pattern': '*.txt', 'sampling_rate': 32},
+  'mhealth': {'pattern': '*.log', 'sampling_rate': 50},
+}
+mhealth_columns = [14, 15, 16] # right lower arm accelerometer, 0 based
+
+# real value of each code: -1.5 g + (coded_val / 63) * 3 g
+hmp_table = -ingest.hmp_range + (np.arange(ingest.hmp_coded_max + 1) / ingest.hmp_coded_max) * (2 * ingest.hmp_range)
+
+# Maps an array of HMP codes to m/s^2
+def decode_hmp(codes):
+  codes = np.asarray(codes)
+  if codes.size and (codes.min() < 0 or codes.max() > ingest.hmp_coded_max):
+    raise ValueError('HMP codes must lie in [0..%d]' % ingest.hmp_coded_max)
+  return hmp_table[codes]
+
+def read_hmp(path):
+  codes = pd.read_csv(path, header=None, sep=r'\s+', usecols=[0, 1, 2], dtype=np.int16).values
+  return decode_hmp(codes)
 
-input_file_path = "datasets/Accelerometer-2011-06-02-17-21-57-liedown_bed-m1.txt"
-fields = ['15', '16', '17']
+def read_mhealth(path, columns=None):
+  columns = columns or mhealth_columns
+  return pd.read_csv(path, header=None, sep=r'\s+', usecols=columns, dtype=np.float64).values
+
+# Returns the sources matched by files, directories (searched recursively for the mode's extension) and glob patterns
+def expand_sources(paths, mode):
+  sources = []
+  for path in paths:
+    if os.path.isdir(path):
+      sources.extend(sorted(glob.glob(os.path.join(path, '**', modes[mode]['pattern']), recursive=True)))
+    else:
+      sources.extend(sorted(glob.glob(path, recursive=True)))
+  return list(dict.fromkeys(sources))
+
+def output_paths(path, output_dir):
+  base = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0])
+  return base + '.npy', base + '.json'
+
+# Settings of a conversion, as stored in the metadata of its output
+def conversion_settings(mode, sampling_rate, dtype=np.float64, columns=None, csv=False):
+  return {'format': mode, 'sampling_rate': sampling_rate, 'dtype': np.dtype(dtype).str,
+    'columns': list(columns or mhealth_columns) if mode == 'mhealth' else None, 'csv': bool(csv)}
+
+# Returns true if the output was converted from the source as it is now with the given settings
+def is_up_to_date(path, npy_path, json_path, settings):
+  metadata = ingest.read_metadata(json_path)
+  if metadata is None or not os.path.exists(npy_path):
+    return False
+  if settings['csv'] and not os.path.exists(os.path.splitext(npy_path)[0] + '.csv'):
+    return False
+  return (ingest.file_stat(path) == {'size': metadata['size'], 'mtime_ns': metadata['mtime_ns']}
+    and all(metadata.get(name) == value for name, value in settings.items()))
+
+# Converts one file, returns (source, output, samples, status)
+def convert(path, mode, output_dir, sampling_rate, dtype=np.float64, columns=None, csv=False, force=False):
+  npy_path, json_path = output_paths(path, output_dir)
+  settings = conversion_settings(mode, sampling_rate, dtype, columns, csv)
+  if not force and is_up_to_date(path, npy_path, json_path, settings):
+    return path, npy_path, ingest.read_metadata(json_path)['shape'][0], 'up to date'
+  stat = ingest.file_stat(path)
+  data = read_mhealth(path, columns) if mode == 'mhealth' else read_hmp(path)
+  data = data.astype(dtype, copy=False)
+  with ingest.atomic_write(npy_path) as f:
+    np.save(f, data)
+  csv_path = os.path.splitext(npy_path)[0] + '.csv'
+  if csv:
+    pd.DataFrame(data).to_csv(csv_path, header=False, index=False)
+  elif os.path.exists(csv_path):
+    os.remove(csv_path) # the copy of an earlier conversion
+  ingest.write_metadata(json_path, dict(settings, source=os.path.abspath(path), size=stat['size'], mtime_ns=stat['mtime_ns'],
+    shape=list(data.shape), output=os.path.abspath(npy_path)))
+  return path, npy_path, len(data), 'converted'
+
+# Converts the sources over a process pool, returns their (source, output, samples, status) in completion order
+def convert_all(sources, mode, output_dir, sampling_rate=None, workers=None, dtype=np.float64, columns=None, csv=False, force=False):
+  sampling_rate = sampling_rate or modes[mode]['sampling_rate']
+  os.makedirs(output_dir, exist_ok=True)
+  names = [output_paths(path, output_dir)[0] for path in sources]
+  if len(set(names)) != len(names):
+    raise ValueError('Several sources have the same file name, convert them into different output directories')
+  results = []
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = {pool.submit(convert, path, mode, output_dir, sampling_rate, dtype, columns, csv, force): path for path in sources}
+    for future in as_completed(futures):
+      try:
+        result = future.result()
+      except Exception as e:
+        result = (futures[future], None, 0, 'failed')
+        print("failed       %s: %s: %s" % (futures[future], type(e).__name__, e))
+      else:
+        print("%-12s %s -> %s (%d samples)" % (result[3], result[0], result[1], result[2]))
+      results.append(result)
+  return results
 
 if __name__ == '__main__':
-	# data = pd.read_csv(input_file_path, skipinitialspace=True, usecols=fields, delim_whitespace=True)
-	# data.to_csv('uic_dataset.csv', index=False)
-
-  # CONVERT THE ACCELEROMETER DATA INTO REAL ACCELERATION VALUES
-  # mapping from [0. .63] to[-14.709.. + 14.709]
-  # real_val = -1.5 g + (coded_val / 63) * 3 g
-  data = np.loadtxt("datasets/Accelerometer-2011-05-30-10-38-41-liedown_bed-m1.txt")
-  real_data = list(map(lambda v: -14.709 + (v / 63) * (2 * 14.709), data))
-  np.savetxt("datasets/hmp_dataset1.csv", real_data, delimiter=",")
+  parser = argparse.ArgumentParser(description='Convert raw HMP or MHEALTH recordings into binary .npy files with sampling rate metadata.')
+  parser.add_argument('mode', choices=sorted(modes))
+  parser.add_argument('paths', nargs='+', help='files, directories (searched recursively) or glob patterns')
+  parser.add_argument('--output-dir', default='datasets/converted')
+  parser.add_argument('--sampling-rate', type=float, help='stored with the output, 32 Hz for hmp and 50 Hz for mhealth by default')
+  parser.add_argument('--columns', type=int, nargs=3, default=mhealth_columns, help='0 based MHEALTH columns to keep')
+  parser.add_argument('--workers', type=int, default=os.cpu_count())
+  parser.add_argument('--float32', action='store_true', help='store single precision samples')
+  parser.add_argument('--csv', action='store_true', help='also write a CSV copy of each output')
+  parser.add_argument('--force', action='store_true', help='convert files whose output is up to date')
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  sources = expand_sources(args.paths, args.mode)
+  results = convert_all(sources, args.mode, args.output_dir, args.sampling_rate, args.workers,
+    np.float32 if args.float32 else np.float64, args.columns, args.csv, args.force)
+  counts = collections.Counter(r[3] for r in results)
+  print("%d files in %.2f s: %s" % (len(results), time.perf_counter() - start, ', '.join('%d %s' % (n, s) for s, n in counts.items())))
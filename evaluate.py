@@ -0,0 +1,113 @@
+import argparse
+import itertools
+import logging
+import sys
+import time
+from dataclasses import fields, replace
+import numpy as np
+import pandas as pd
+
+import ground_truth
+import ingest
+import plotting
+from bio_watch import BioWatch
+from seismotracker import SeismoTracker
+
+logger = logging.getLogger(__name__)
+
+# Heart rate accuracy of the algorithms against the ECG reference of a recording
+# (ground_truth). Every algorithm estimating heart rate over windows is run with
+# estimate_windows and its window rates are compared with the reference of the
+# same windows, giving the mean absolute and root mean square error (bpm). The R
+# peaks are detected once, and the errors of every configuration of a parameter
+# sweep are computed together from one array of estimates, so a sweep costs about
+# one estimate_windows call per configuration. Sleep Monitor does not estimate
+# heart rate and is left out.
+
+accelerometer_path = 'datasets/uic_dataset.csv'
+sampling_frequency = 50
+estimators = {'Bio Watch': BioWatch, 'SeismoTracker': SeismoTracker}
+
+# Returns the mean absolute and root mean square error of each row of estimates against the same
+# row of the reference, over the windows where both are finite, and the number of those windows
+def errors(estimates, reference):
+  difference = np.atleast_2d(estimates - reference)
+  valid = np.isfinite(difference)
+  count = valid.sum(axis=1)
+  difference = np.where(valid, difference, 0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.abs(difference).sum(axis=1) / count, np.sqrt(np.square(difference).sum(axis=1) / count), count
+
+# Returns the centre times of the windows of each estimator on data and their heart rates, one row
+# per estimator, padded with NaN to the most windows
+def window_estimates(estimators, data):
+  rates = [estimator.estimate_windows(data) for estimator in estimators]
+  times, estimates = np.full((2, len(rates), max((len(r) for r in rates), default=0)), np.nan)
+  for row, r in enumerate(rates):
+    times[row,:len(r)] = r['time']
+    estimates[row,:len(r)] = r['heart_rate']
+  return times, estimates
+
+# Returns the configurations of an estimator for every combination of the values of grid, a dict
+# of field name: values. Fields the estimator does not have are ignored.
+def configurations(estimator, grid):
+  names = [name for name in grid if name in {f.name for f in fields(estimator)}]
+  return [replace(estimator, **dict(zip(names, values))) for values in itertools.product(*(grid[name] for name in names))]
+
+# Returns the errors of every configuration of an algorithm against the R peak times of the
+# reference, as a DataFrame sorted by mean absolute error, with the swept fields
+def evaluate(algorithm, configs, data, peak_times, grid=None):
+  times, estimates = window_estimates(configs, data)
+  reference = np.array([ground_truth.window_heart_rate(peak_times, t, c.rate_window_duration) for t, c in zip(times, configs)])
+  mae, rmse, windows = errors(estimates, reference)
+  swept = {name: [getattr(c, name) for c in configs] for name in (grid or {}) if hasattr(configs[0], name)}
+  return pd.DataFrame(dict(swept, algorithm=algorithm, mae=mae, rmse=rmse, windows=windows)).sort_values('mae', kind='stable')
+
+# Parses name=v1,v2,... sweep arguments into a dict of name: values, cast to the type of the
+# field of the estimators (float when its default is None)
+def parse_grid(arguments):
+  defaults = {f.name: f.default for e in estimators.values() for f in fields(e)}
+  grid = {}
+  for argument in arguments:
+    name, values = argument.split('=', 1)
+    if name not in defaults:
+      raise ValueError("No estimator has a field '%s'" % name)
+    cast = float if defaults[name] is None else type(defaults[name])
+    grid[name] = [cast(value) for value in values.split(',')]
+  return grid
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Measure the heart rate error of the algorithms against the ECG reference.')
+  parser.add_argument('--accelerometer', default=accelerometer_path)
+  parser.add_argument('--ecg', nargs='+', default=ground_truth.ecg_paths, help='lead files recorded with the accelerometer')
+  parser.add_argument('--sampling-rate', type=float, default=sampling_frequency, help='of both recordings')
+  parser.add_argument('--window-seconds', type=float, default=30)
+  parser.add_argument('--hop-seconds', type=float, default=5)
+  parser.add_argument('--algorithms', nargs='+', choices=sorted(estimators), default=sorted(estimators))
+  parser.add_argument('--sweep', nargs='+', default=[], metavar='FIELD=V1,V2,...',
+    help='evaluate every combination of these estimator field values, e.g. bcg_low_freq=3,4,5 filter_order=2,4')
+  parser.add_argument('--top', type=int, default=10, help='configurations listed per algorithm in a sweep')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stdout)
+  plotting.set_mode('headless')
+
+  fs = args.sampling_rate
+  data = np.asarray(ingest.load(args.accelerometer, fs)[0])
+  peak_times = ground_truth.r_peaks(ground_truth.load_leads(args.ecg, fs), fs) / fs
+  print("Reference: %d R peaks, %.2f bpm over the recording" % (len(peak_times), ground_truth.recording_heart_rate(peak_times)))
+  grid = parse_grid(args.sweep)
+
+  for algorithm in args.algorithms:
+    estimator = estimators[algorithm](fs, rate_window_duration=args.window_seconds, rate_hop_duration=args.hop_seconds)
+    configs = configurations(estimator, grid)
+    start = time.perf_counter()
+    results = evaluate(algorithm, configs, data, peak_times, grid)
+    seconds = time.perf_counter() - start
+    if len(configs) == 1:
+      hr = estimator.estimate(data)[0]
+      print("%-14s MAE %6.2f bpm  RMSE %6.2f bpm over %d windows (%.3f s), recording estimate %.2f bpm, error %.2f bpm" % (
+        algorithm, results['mae'].iloc[0], results['rmse'].iloc[0], results['windows'].iloc[0], seconds, hr,
+        abs(hr - ground_truth.recording_heart_rate(peak_times))))
+    else:
+      print("\n%s: %d configurations in %.2f s (%.1f ms each)" % (algorithm, len(configs), seconds, 1e3 * seconds / len(configs)))
+      print(results.drop(columns='algorithm').head(args.top).to_string(index=False))
@@ -0,0 +1,128 @@
+import argparse
+import logging
+import sys
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import scipy.signal
+
+import filters
+import ingest
+import plotting
+import profiling
+import spectral
+
+logger = logging.getLogger(__name__)
+
+# Reference heart rate from ECG leads recorded with an accelerometer, to measure
+# the error of the algorithms. R peaks are detected as in Pan-Tompkins, with every
+# step vectorized over the whole recording: a band-pass filter keeping the QRS
+# complexes, the derivative, squared and summed over the leads, a moving window
+# integration, and peak picking above an adaptive threshold, a share of the
+# largest integrated value of the last few seconds (instead of the running signal
+# and noise levels of the original, updated beat by beat). Each R peak is then
+# placed on the largest deflection of the band-passed leads near its QRS energy.
+
+# Leads recorded together with datasets/uic_dataset.csv
+ecg_paths = ['datasets/uic_hr_dataset.csv', 'datasets/uic_hr_dataset_lead2.csv']
+sampling_frequency = 50
+
+qrs_low_freq = 5
+qrs_high_freq = 15
+filter_order = 2
+integration_seconds = 0.15
+refractory_seconds = 0.25 # shortest RR interval, 240 bpm
+threshold_seconds = 2.5 # the adaptive threshold follows the QRS energy of this long
+threshold_ratio = 0.3 # of the largest integrated value nearby
+noise_ratio = 0.1 # of the 99th percentile of the recording, the threshold never goes below
+
+# Returns the (N, leads) ECG of lead files recorded together, cut to the shortest
+def load_leads(paths, fs=None):
+  leads = [np.asarray(ingest.load(path, fs)[0]) for path in paths]
+  n = min(len(lead) for lead in leads)
+  return np.column_stack([lead[:n] for lead in leads])
+
+# Returns the band-passed leads and their QRS energy: the squared derivative summed over the
+# leads, integrated over a centred moving window so it peaks with the QRS complex
+@profiling.stage('ground_truth.qrs_energy')
+def qrs_energy(ecg, fs):
+  ecg = np.asarray(ecg, dtype=np.float64).reshape(len(ecg), -1)
+  # the band is kept below Nyquist at low sampling rates, at 50 Hz it is unchanged
+  bandpassed = filters.filtfilt(ecg, (qrs_low_freq, min(qrs_high_freq, 0.45 * fs)), fs, filter_order, 'band')
+  derivative = np.gradient(bandpassed, axis=0) * fs
+  energy = np.einsum('ij,ij->i', derivative, derivative)
+  return bandpassed, scipy.ndimage.uniform_filter1d(energy, max(int(round(integration_seconds * fs)), 1))
+
+# Returns the sample indices of the R peaks of (N,) or (N, leads) ECG at fs
+@profiling.stage('ground_truth.r_peaks')
+def r_peaks(ecg, fs):
+  if len(ecg) == 0:
+    return np.zeros(0, dtype=np.intp)
+  bandpassed, integrated = qrs_energy(ecg, fs)
+  threshold = np.maximum(threshold_ratio * scipy.ndimage.maximum_filter1d(integrated, max(int(threshold_seconds * fs), 1)),
+    noise_ratio * np.percentile(integrated, 99))
+  candidates, _ = scipy.signal.find_peaks(integrated, height=threshold, distance=max(int(refractory_seconds * fs), 1))
+  # largest deflection within half an integration window of each candidate
+  half = int(round(integration_seconds * fs / 2))
+  deflection = np.pad(np.abs(bandpassed).sum(axis=1), half, constant_values=-np.inf)
+  around = np.lib.stride_tricks.sliding_window_view(deflection, 2 * half + 1)[candidates]
+  return np.unique(candidates + np.argmax(around, axis=1) - half)
+
+# Returns the heart rate (bpm) of the RR intervals within each window of window_seconds
+# centred at times (s), NaN in a window without a full interval
+def window_heart_rate(peak_times, times, window_seconds):
+  times = np.asarray(times, dtype=np.float64)
+  if len(peak_times) < 2:
+    return np.full(len(times), np.nan)
+  first = np.searchsorted(peak_times, times - window_seconds / 2)
+  last = np.searchsorted(peak_times, times + window_seconds / 2) - 1
+  intervals = last - first
+  span = peak_times[np.clip(last, 0, len(peak_times) - 1)] - peak_times[np.clip(first, 0, len(peak_times) - 1)]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(intervals > 0, 60 * intervals / span, np.nan)
+
+# Heart rate (bpm) of all the RR intervals of a recording
+def recording_heart_rate(peak_times):
+  if len(peak_times) < 2:
+    return np.nan
+  return 60 * (len(peak_times) - 1) / (peak_times[-1] - peak_times[0])
+
+# Returns the reference heart rate of ECG at fs in windows of window_seconds every hop_seconds,
+# the windows of estimate_windows, as a DataFrame with the window centre time (s). The R peaks
+# are detected unless given.
+def reference_rates(ecg, fs, window_seconds=30, hop_seconds=5, peaks=None):
+  peak_times = (r_peaks(ecg, fs) if peaks is None else peaks) / fs
+  window_size = int(round(window_seconds * fs))
+  starts = spectral.window_starts(len(ecg), window_size, max(int(round(hop_seconds * fs)), 1))
+  times = (starts + window_size / 2) / fs
+  return pd.DataFrame({'time': times, 'heart_rate': window_heart_rate(peak_times, times, window_seconds)})
+
+# Plots the first lead with its R peaks and the reference heart rate over time
+def plot_reference(ecg, fs, peaks, rates, plot_save_path):
+  if not plotting.enabled():
+    return
+  lead = np.asarray(ecg, dtype=np.float64).reshape(len(ecg), -1)[:,0]
+  plotting.figure(plot_save_path, [
+    plotting.panel([plotting.series(lead, dx=1/fs), plotting.series(lead[peaks], x=peaks / fs, fmt='o')],
+      ylabel='ECG amplitude', title='Electrocardiogram signal and R peaks'),
+    plotting.panel([plotting.series(rates['heart_rate'], x=rates['time'], fmt='o-')], xlabel='TIME (s)', ylabel='Heart Rate (bpm)')],
+    figsize=(12, 8))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Detect the R peaks of ECG leads and print the reference heart rate.')
+  parser.add_argument('paths', nargs='*', default=ecg_paths, help='lead files recorded together')
+  parser.add_argument('--sampling-rate', type=float, default=sampling_frequency)
+  parser.add_argument('--window-seconds', type=float, default=30)
+  parser.add_argument('--hop-seconds', type=float, default=5)
+  parser.add_argument('--plots', choices=plotting.plot_modes, default='save')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+  plotting.set_mode(args.plots)
+
+  ecg = load_leads(args.paths, args.sampling_rate)
+  peaks = r_peaks(ecg, args.sampling_rate)
+  rates = reference_rates(ecg, args.sampling_rate, args.window_seconds, args.hop_seconds, peaks)
+  print("R peaks: %d in %.1f s, heart rate %.2f bpm" % (len(peaks), len(ecg) / args.sampling_rate, recording_heart_rate(peaks / args.sampling_rate)))
+  print(rates.to_string(index=False))
+  plot_reference(ecg, args.sampling_rate, peaks, rates, 'plots/uic_heart_rate.png')
+  plotting.flush()
@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+# Ingest layer for accelerometer recordings. Each CSV or raw HMP .txt file is
+# parsed once, in chunks, into a binary .npy cache next to a JSON metadata file
+# holding the fingerprint of the source (size, mtime, SHA-256), the sampling
+# rate and the shape. Later loads memory-map the cache instead of parsing text.
+# The cache is rebuilt when the source's size or mtime changes, or when its
+# hash changes and verify_hash is set.
+
+cache_dir = '.cache/ingest'
+parse_chunk_rows = 1000000 # rows parsed at a time while converting
+hash_block_size = 1 << 20
+
+# Raw HMP samples are coded in [0..63] for [-1.5 g..+1.5 g]
+hmp_coded_max = 63
+hmp_range = 14.709
+
+# Opens a new file for writing next to path and moves it over path once written, so readers
+# never see a partial file. Each writer gets its own file (tempfile.mkstemp), so concurrent
+# writers of the same path cannot interleave; the last to finish wins. The file is removed
+# when writing fails.
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+  try:
+    with os.fdopen(fd, mode) as f:
+      yield f
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+def file_hash(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(hash_block_size), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+# Size and modification time of the source, cheap to compare on every load
+def file_stat(path):
+  stat = os.stat(path)
+  return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def source_format(path):
+  return 'hmp' if path.endswith('.txt') else 'csv'
+
+# Returns the cache and metadata paths of a source file and dtype
+def cache_paths(path, dtype=np.float64, directory=None):
+  directory = directory or cache_dir
+  key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+  name = '%s-%s-%s' % (os.path.splitext(os.path.basename(path))[0], key, np.dtype(dtype).str.lstrip('<>|='))
+  base = os.path.join(directory, name)
+  return base + '.npy', base + '.json'
+
+def has_header(path):
+  first = pd.read_csv(path, header=None, nrows=1)
+  return not all(pd.api.types.is_numeric_dtype(t) for t in first.dtypes)
+
+# Yields (n, columns) blocks of the first three columns of the source file, without loading it whole
+def parse_chunks(path, dtype=np.float64, chunk_rows=None):
+  chunk_rows = chunk_rows or parse_chunk_rows
+  if source_format(path) == 'hmp':
+    reader = pd.read_csv(path, header=None, sep=r'\s+', chunksize=chunk_rows)
+  else:
+    reader = pd.read_csv(path, header=0 if has_header(path) else None, chunksize=chunk_rows)
+  for chunk in reader:
+    values = chunk.values[:,0:3].astype(np.float64)
+    if source_format(path) == 'hmp':
+      values = -hmp_range + (values / hmp_coded_max) * (2 * hmp_range)
+    yield values.astype(dtype, copy=False)
+
+# Parses the source into an .npy file, in chunks so memory stays bounded by the chunk size
+def write_cache(path, npy_path, dtype, chunk_rows=None):
+  dtype = np.dtype(dtype)
+  rows = 0
+  columns = 0
+  with tempfile.TemporaryFile() as raw:
+    for values in parse_chunks(path, dtype, chunk_rows):
+      raw.write(np.ascontiguousarray(values).tobytes())
+      rows += len(values)
+      columns = values.shape[1]
+    raw.seek(0)
+    with atomic_write(npy_path) as f:
+      header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows, columns)}
+      np.lib.format.write_array_header_1_0(f, header)
+      shutil.copyfileobj(raw, f)
+  return rows, columns
+
+def read_metadata(json_path):
+  try:
+    with open(json_path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+# Returns true if the cache described by metadata still matches the source file
+def is_fresh(path, metadata, npy_path, verify_hash=False):
+  if metadata is None or not os.path.exists(npy_path):
+    return False
+  if file_stat(path) != {'size': metadata['size'], 'mtime_ns': metadata['mtime_ns']}:
+    return False
+  return not verify_hash or file_hash(path) == metadata['sha256']
+
+# Converts the source file if its cache is missing or stale and returns the cache metadata.
+# The sampling rate is stored with the cache, a given one replaces the stored one.
+def ingest(path, sampling_rate=None, dtype=np.float64, directory=None, verify_hash=False, chunk_rows=None):
+  npy_path, json_path = cache_paths(path, dtype, directory)
+  metadata = read_metadata(json_path)
+  if is_fresh(path, metadata, npy_path, verify_hash):
+    if sampling_rate is not None and metadata['sampling_rate'] != sampling_rate:
+      metadata['sampling_rate'] = sampling_rate
+      write_metadata(json_path, metadata)
+    return metadata
+
+  os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+  stat = file_stat(path)
+  digest = file_hash(path)
+  rows, columns = write_cache(path, npy_path, dtype, chunk_rows)
+  metadata = {'source': os.path.abspath(path), 'format': source_format(path), 'size': stat['size'],
+    'mtime_ns': stat['mtime_ns'], 'sha256': digest, 'sampling_rate': sampling_rate if sampling_rate is not None else (metadata or {}).get('sampling_rate'),
+    'dtype': np.dtype(dtype).str, 'shape': [rows, columns], 'cache': os.path.abspath(npy_path)}
+  write_metadata(json_path, metadata)
+  return metadata
+
+def write_metadata(json_path, metadata):
+  with atomic_write(json_path, 'w') as f:
+    json.dump(metadata, f, indent=2)
+
+# Returns the (N, 3) recording (fewer columns if the source has fewer) and its metadata. With mmap the array is a read-only
+# memory map of the cache, pages are read from disk as they are accessed.
+def load(path, sampling_rate=None, dtype=np.float64, mmap=True, directory=None, verify_hash=False):
+  metadata = ingest(path, sampling_rate, dtype, directory, verify_hash)
+  data = np.load(metadata['cache'], mmap_mode='r' if mmap else None)
+  return data, metadata
+
+# Yields consecutive blocks of chunk_size samples of a recording, read from the memory mapped cache
+def iter_chunks(path, chunk_size, sampling_rate=None, dtype=np.float64, directory=None, verify_hash=False):
+  data, metadata = load(path, sampling_rate, dtype, True, directory, verify_hash)
+  for start in range(0, len(data), chunk_size):
+    yield np.array(data[start:start+chunk_size])
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert recordings (CSV or raw HMP .txt) into the binary ingest cache.')
+  parser.add_argument('paths', nargs='+')
+  parser.add_argument('--sampling-rate', type=float, help='sampling rate (Hz) stored with the cache')
+  parser.add_argument('--float32', action='store_true', help='store single precision samples, halving memory')
+  parser.add_argument('--cache-dir', default=cache_dir)
+  parser.add_argument('--verify-hash', action='store_true', help='also compare the SHA-256 of each source file')
+  args = parser.parse_args()
+
+  dtype = np.float32 if args.float32 else np.float64
+  for path in args.paths:
+    start = time.perf_counter()
+    for values in parse_chunks(path, dtype):
+      pass
+    parse_seconds = time.perf_counter() - start
+    metadata = ingest(path, args.sampling_rate, dtype, args.cache_dir, args.verify_hash)
+    start = time.perf_counter()
+    data, _ = load(path, args.sampling_rate, dtype, True, args.cache_dir)
+    np.sum(data)
+    load_seconds = time.perf_counter() - start
+    print("%s: %d samples -> %s (text parse %.3f s, cached load %.3f s)" % (path, metadata['shape'][0], metadata['cache'], parse_seconds, load_seconds))
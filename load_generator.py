@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+import numpy as np
+
+import ingest
+import server
+from smart_sensor import input_dataset_csv
+
+# Load generator for the ingest server. Simulated devices replay the bundled
+# recordings, looping them, at a multiple of real time, each sending a block of
+# samples per interval over TCP or UDP. A subscriber collects the published rates
+# to measure the end-to-end latency (send time of the newest block behind an
+# estimate to its publication) and the server's own statistics report drops and
+# the devices one core sustains.
+
+default_block_seconds = 0.2
+
+logger = logging.getLogger(__name__)
+
+# Returns [(name, (N, 3) recording, sampling rate)] of the three-axis datasets, at the given
+# sampling rate or the one stored with each. Other recordings are skipped with a warning.
+def recordings(paths=None, sampling_rate=None):
+  paths = paths or sorted(input_dataset_csv)
+  loaded = []
+  for path in paths:
+    data, metadata = ingest.load(path, sampling_rate or input_dataset_csv.get(path))
+    if data.ndim != 2 or data.shape[1] != 3:
+      logger.warning('Skipping %s: %s samples, not three axes', path, 'x'.join(map(str, data.shape)))
+    elif not metadata['sampling_rate']:
+      logger.warning('Skipping %s: no sampling rate, give one with --sampling-rate', path)
+    else:
+      loaded.append((path, np.asarray(data), metadata['sampling_rate']))
+  return loaded
+
+class Replay:
+  def __init__(self):
+    self.sent_samples = 0
+    self.late_blocks = 0
+    self.rates = 0
+    self.latencies = []
+    self.stats = None
+
+# Sends a device's recording block by block on a fixed schedule until the deadline
+async def replay_device(name, data, fs, host, port, speed, block_seconds, deadline, udp, replay):
+  loop = asyncio.get_running_loop()
+  block = max(int(block_seconds * fs), 1)
+  interval = block / fs / speed
+  if udp:
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+  else:
+    reader, writer = await asyncio.open_connection(host, port)
+  start = 0
+  next_send = loop.time()
+  try:
+    while loop.time() < deadline:
+      samples = data[start:start+block]
+      if len(samples) < block:
+        samples = np.concatenate([samples, data[:block-len(samples)]])
+      start = (start + block) % len(data)
+      frame = server.encode_frame(name, fs, samples)
+      if udp:
+        transport.sendto(frame)
+      else:
+        writer.write(frame)
+        await writer.drain()
+      replay.sent_samples += block
+      next_send += interval
+      delay = next_send - loop.time()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      else:
+        replay.late_blocks += 1
+  finally:
+    if udp:
+      transport.close()
+    else:
+      writer.close()
+
+async def subscribe(host, port, replay):
+  reader, writer = await asyncio.open_connection(host, port)
+  try:
+    while True:
+      line = await reader.readline()
+      if not line:
+        break
+      message = json.loads(line)
+      if message['type'] == 'rate':
+        replay.rates += 1
+        replay.latencies.append(message['latency'])
+      else:
+        replay.stats = message
+  finally:
+    writer.close()
+
+async def run(devices, speed, duration, host='127.0.0.1', port=server.default_port, subscriber_port=server.default_subscriber_port,
+    block_seconds=default_block_seconds, udp=False, paths=None, sampling_rate=None):
+  replay = Replay()
+  sources = recordings(paths, sampling_rate)
+  if not sources:
+    raise SystemExit('No three-axis recording with a sampling rate to replay')
+  loop = asyncio.get_running_loop()
+  subscriber = loop.create_task(subscribe(host, subscriber_port, replay))
+  deadline = loop.time() + duration
+  await asyncio.gather(*[replay_device('device-%04d' % i, sources[i % len(sources)][1], sources[i % len(sources)][2], host, port, speed,
+    block_seconds, deadline, udp, replay) for i in range(devices)])
+  # give the last blocks and the next statistics time to arrive
+  await asyncio.sleep(server.stats_seconds + 1)
+  subscriber.cancel()
+  return replay
+
+def print_replay(replay, devices, speed, duration):
+  print("%d devices at %gx real time for %g s" % (devices, speed, duration))
+  print("  sent:       %d samples (%.0f samples/s), %d blocks sent late" % (replay.sent_samples, replay.sent_samples / duration, replay.late_blocks))
+  print("  published:  %d rates (%.1f rates/s)" % (replay.rates, replay.rates / duration))
+  if replay.latencies:
+    p50, p95, p99 = np.percentile(replay.latencies, [50, 95, 99]) * 1000
+    print("  latency:    p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms" % (p50, p95, p99, max(replay.latencies) * 1000))
+  if replay.stats:
+    s = replay.stats
+    print("  server:     %d samples received, %d dropped, %d buffered, %d published messages dropped, %d packets rejected" % (
+      s['received_samples'], s['dropped_samples'], s['buffered_samples'], s['dropped_messages'], s['rejected_packets']))
+    print("  cpu:        %.1f s over %.1f s, %.1f devices per core" % (s['cpu_seconds'], s['wall_seconds'], s['devices_per_core'] or 0))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Replay the bundled recordings from many simulated devices to a running ingest server.')
+  parser.add_argument('--devices', type=int, default=100)
+  parser.add_argument('--speed', type=float, default=1, help='replay speed, a multiple of real time')
+  parser.add_argument('--duration', type=float, default=60, help='seconds to send for')
+  parser.add_argument('--block-seconds', type=float, default=default_block_seconds, help='seconds of samples per packet')
+  parser.add_argument('--udp', action='store_true', help='send over UDP instead of TCP')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=server.default_port)
+  parser.add_argument('--subscriber-port', type=int, default=server.default_subscriber_port)
+  parser.add_argument('--sampling-rate', type=float, help='of the datasets, the rate stored with each by default')
+  parser.add_argument('datasets', nargs='*', help='three-axis recordings to replay, the bundled datasets by default')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stdout)
+  replay = asyncio.run(run(args.devices, args.speed, args.duration, args.host, args.port, args.subscriber_port,
+    args.block_seconds, args.udp, args.datasets, args.sampling_rate))
+  print_replay(replay, args.devices, args.speed, args.duration)
@@ -0,0 +1,190 @@
+import collections
+import hashlib
+import threading
+import numpy as np
+
+import profiling
+import spectral
+
+# Preprocessing shared between the algorithms, as a small DAG of named stages.
+# A node is a stage applied to the value of its input node with some arguments.
+# Its key is derived from the content hash of the recording at the root and from
+# the stage and arguments of every node on the way, so the same (stage, input,
+# arguments) gets the same key in every algorithm and variant that builds it.
+# Array arguments are scratch buffers (see spectral.work_buffer) and are left
+# out of the key. A node is evaluated once, when its value is first read.
+#
+# Given a Memo, node values are also shared through it between every estimate of
+# the same recording: the memo holds them read-only, up to a size bound in least
+# recently used order, and counts its hits and misses per stage. Comparing
+# variants of an algorithm on one recording then runs their common stages once.
+# A memo given a persistent store (see result_store) also reads the values it
+# misses from the store and saves those it computes, for the stages the store keeps.
+# Each node records the modules of the functions leading to it, which version
+# its stored value.
+
+default_max_bytes = 256 * 1024 * 1024
+
+missing = object()
+
+def digest(*parts):
+  return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+# Content key of an array: its type, shape and bytes
+@profiling.stage('pipeline.content_key')
+def content_key(data):
+  h = hashlib.blake2b(digest_size=16)
+  h.update(repr((data.dtype.str, data.shape)).encode())
+  h.update(memoryview(np.ascontiguousarray(data)).cast('B'))
+  return h.hexdigest()
+
+# Numpy scalars are keyed by their value, as Python numbers, and arrays are left out
+def key_argument(a):
+  return a.item() if isinstance(a, np.generic) else a
+
+def key_arguments(args, kwargs):
+  return (tuple(key_argument(a) for a in args if not isinstance(a, np.ndarray)),
+    tuple((name, key_argument(a)) for name, a in sorted(kwargs.items()) if not isinstance(a, np.ndarray)))
+
+def value_bytes(value):
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, tuple):
+    return sum(value_bytes(v) for v in value)
+  return 0
+
+# Marks the arrays of a value read-only, they are shared by every reader of the memo
+def freeze(value):
+  if isinstance(value, np.ndarray):
+    value.flags.writeable = False
+  elif isinstance(value, tuple):
+    for v in value:
+      freeze(v)
+  return value
+
+# z-score of each axis of (N, 3) data or (subjects, N, 3) batches, like scipy.stats.zscore, in place
+def normalize(data):
+  mean = data.mean(axis=-2, keepdims=True)
+  data -= mean
+  # the centred data gives the standard deviation without another full size temporary
+  std = np.sqrt(np.einsum('...ij,...ij->...j', data, data)[...,None,:] / data.shape[-2])
+  with np.errstate(divide='ignore', invalid='ignore'):
+    data /= std
+  return data
+
+# z-score of each axis on a copy, in float32 for float32 data and float64 otherwise
+def normalized(data):
+  return normalize(np.array(data, dtype=spectral.float_dtype(np.asarray(data).dtype)))
+
+class Memo:
+  def __init__(self, max_bytes=default_max_bytes, store=None):
+    self.max_bytes = max_bytes
+    self.store = store
+    self.entries = collections.OrderedDict() # key: (value, bytes), least recently used first
+    self.bytes = 0
+    self.hits = collections.Counter() # per stage
+    self.misses = collections.Counter()
+    self.evictions = 0
+    self.lock = threading.Lock()
+
+  # Returns the value of key, computed by compute() and kept when missing
+  def get(self, key, stage, compute, modules=()):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+        self.hits[stage] += 1
+        return entry[0]
+      self.misses[stage] += 1
+    value = self.store.load(key, stage, modules) if self.store is not None else None
+    if value is None:
+      value = compute()
+      if self.store is not None:
+        self.store.save(key, stage, modules, value)
+    value = freeze(value)
+    size = value_bytes(value)
+    if size <= self.max_bytes:
+      with self.lock:
+        if key not in self.entries:
+          self.entries[key] = (value, size)
+          self.bytes += size
+        while self.bytes > self.max_bytes:
+          old_key, (old_value, old_size) = self.entries.popitem(last=False)
+          self.bytes -= old_size
+          self.evictions += 1
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.bytes = 0
+
+  # Returns the hit and miss counts, in total and per stage, and the memory held
+  def stats(self):
+    with self.lock:
+      stages = sorted(set(self.hits) | set(self.misses))
+      return {'hits': sum(self.hits.values()), 'misses': sum(self.misses.values()), 'entries': len(self.entries),
+        'bytes': self.bytes, 'max_bytes': self.max_bytes, 'evictions': self.evictions,
+        'stages': {stage: {'hits': self.hits[stage], 'misses': self.misses[stage]} for stage in stages}}
+
+  def format_stats(self):
+    stats = self.stats()
+    lines = ["%-24s %6s %6s" % ('stage', 'hits', 'misses')]
+    for stage, counts in stats['stages'].items():
+      lines.append("%-24s %6d %6d" % (stage, counts['hits'], counts['misses']))
+    lines.append("%d hits, %d misses, %d entries holding %.1f MB, %d evicted" % (
+      stats['hits'], stats['misses'], stats['entries'], stats['bytes'] / 1e6, stats['evictions']))
+    return '\n'.join(lines)
+
+class Node:
+  def __init__(self, key, stage, memo, compute=None, value=missing, modules=frozenset()):
+    self.key = key
+    self.stage = stage
+    self.memo = memo
+    self.compute = compute
+    self._value = value
+    self.modules = modules # of the functions computing this node and its inputs
+
+  @property
+  def value(self):
+    if self._value is missing:
+      if self.memo is None:
+        self._value = self.compute()
+      else:
+        self._value = self.memo.get(self.key, self.stage, self.compute, self.modules)
+      self.compute = None
+    return self._value
+
+  # Returns the node of function(value, *args, **kwargs) on the value of this node. The stage
+  # names the function. depends holds anything else the result depends on, such as the
+  # configuration a method reads, and is only keyed. An in_place function may overwrite its
+  # input: the input is copied first when a memo holds it, otherwise the value of this node
+  # is overwritten and must not be read again. The function is profiled as 'pipeline.' + stage,
+  # or as profile, the name of the stage building the node, which only runs once it is read.
+  def then(self, stage, function, *args, in_place=False, depends=(), profile=None, **kwargs):
+    def compute():
+      value = self.value
+      if in_place and not value.flags.writeable:
+        value = value.copy()
+      with profiling.measure(profile or 'pipeline.' + stage, value):
+        return function(value, *args, **kwargs)
+    key = digest(stage, self.key, key_arguments(args, kwargs), key_arguments(depends, {}))
+    return Node(key, stage, self.memo, compute, modules=self.modules | {function.__module__})
+
+# Returns the root node of a recording, or data itself when it is already a node. Without
+# a memo, nothing is shared and the recording is not hashed.
+def source(data, memo=None):
+  if isinstance(data, Node):
+    return data
+  data = np.asarray(data)
+  return Node(content_key(data) if memo is not None else None, 'source', memo, value=data)
+
+# Returns the node of the tuple of the values of nodes, such as the runs of the accepted windows
+# of a recording (see quality), for a stage reading them all. The values are held by their
+# own nodes, the tuple and the nodes built on it are left out of the memo.
+def gathered(nodes, stage='gather'):
+  nodes = list(nodes)
+  def compute():
+    return tuple(node.value for node in nodes)
+  key = digest(stage, tuple(node.key for node in nodes))
+  return Node(key, stage, None, compute, modules=frozenset().union(*(node.modules for node in nodes)))
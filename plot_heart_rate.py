@@ -1,27 +1,27 @@
-import pandas as pd
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import style
-style.use('ggplot')
+
+import ground_truth
+import ingest
+import plotting
 
 input_file_path = 'datasets/uic_hr_dataset_lead2.csv'
 sampling_frequency = 50
 
-def plot_hr_graph(data):
-  data = np.array(data)
-  N = len(data)
-  y = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(y, data)
-
-  plt.title('Electrocardiogram signal')
-  plt.ylabel('ECG amplitude')
-  plt.xlabel('TIME (s)')
-  plt.show()
-  plt.pause(20)
-  plt.close()
-  return
+# Plots an ECG lead with its R peaks and the reference heart rate over time
+def plot_hr_graph(data, plot_save_path='plots/uic_heart_rate.png'):
+  data = np.asarray(data, dtype=np.float64)
+  peaks = ground_truth.r_peaks(data, sampling_frequency)
+  rates = ground_truth.reference_rates(data, sampling_frequency, peaks=peaks)
+  ground_truth.plot_reference(data, sampling_frequency, peaks, rates, plot_save_path)
 
 if __name__ == '__main__':
-  data = pd.read_csv(input_file_path).values
+  parser = argparse.ArgumentParser(description='Plot an ECG lead with its R peaks and heart rate.')
+  parser.add_argument('path', nargs='?', default=input_file_path)
+  parser.add_argument('--plots', choices=plotting.plot_modes, default='save', help="'show' displays the figure for a few seconds")
+  args = parser.parse_args()
+  plotting.set_mode(args.plots)
+  data = np.asarray(ingest.load(args.path, sampling_frequency)[0])
   print("Number of records:", len(data))
   plot_hr_graph(data)
+  plotting.flush()
@@ -0,0 +1,151 @@
+import atexit
+import logging
+import queue
+import threading
+import numpy as np
+import profiling
+
+# Plot sink shared by the algorithms. Estimation code only describes figures,
+# matplotlib is imported when the first figure is actually drawn.
+#
+#   'headless' - nothing is drawn and matplotlib is never imported
+#   'save'     - figures are saved as PNG by a background thread using the Agg backend
+#   'show'     - figures are displayed interactively for show_seconds each
+plot_modes = ['headless', 'save', 'show']
+plot_mode = 'save'
+max_points = 2000 # points per line after downsampling, about the width of a saved figure in pixels
+show_seconds = 5
+
+render_queue = None
+render_errors = []
+render_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
+def set_mode(mode):
+  global plot_mode
+  if mode not in plot_modes:
+    raise ValueError("Unknown plot mode: %s" % mode)
+  plot_mode = mode
+
+def enabled():
+  return plot_mode != 'headless'
+
+# Largest-Triangle-Three-Buckets downsampling, keeps the visual shape of a line
+# with n_out points. First and last points are always kept.
+def lttb(x, y, n_out):
+  n = len(y)
+  if n_out >= n or n_out < 3:
+    return x, y
+  edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+  selected = np.empty(n_out, dtype=np.intp)
+  selected[0] = 0
+  selected[-1] = n - 1
+  a = 0
+  for i in range(0, n_out - 2):
+    start, end = edges[i], edges[i+1]
+    next_end = edges[i+2] if i + 2 < len(edges) else n
+    avg_x = np.mean(x[end:next_end])
+    avg_y = np.mean(y[end:next_end])
+    area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+    a = start + np.argmax(area)
+    selected[i+1] = a
+  return x[selected], y[selected]
+
+# A line to draw: y against x, or against sample index * dx when x is not given.
+# Data is copied because callers may modify their arrays after submitting.
+def series(y, x=None, dx=1.0, fmt='-', **kwargs):
+  return {'x': None if x is None else np.array(x, dtype=np.float64), 'y': np.array(y, dtype=np.float64), 'dx': dx, 'fmt': fmt, 'kwargs': kwargs}
+
+def panel(lines, xlabel=None, ylabel=None, title=None, grid=False, legend=False):
+  return {'lines': lines, 'xlabel': xlabel, 'ylabel': ylabel, 'title': title, 'grid': grid, 'legend': legend}
+
+# Submits a figure made of vertically stacked panels
+@profiling.stage('plotting.figure')
+def figure(plot_save_path, panels, figsize=None, hspace=None):
+  if not enabled():
+    return
+  spec = {'path': plot_save_path, 'panels': panels, 'figsize': figsize, 'hspace': hspace}
+  if plot_mode == 'show':
+    show(spec)
+    return
+  start_worker().put(spec)
+
+# Submits a single line plot
+def line(plot_save_path, y, title, xlabel, ylabel, x=None, dx=1.0):
+  if not enabled():
+    return
+  figure(plot_save_path, [panel([series(y, x, dx)], xlabel, ylabel, title)])
+
+# Blocks until all submitted figures are written
+def flush():
+  if render_queue is not None:
+    render_queue.join()
+
+def import_matplotlib():
+  import matplotlib
+  from matplotlib import style
+  style.use('ggplot')
+  return matplotlib
+
+def draw(fig, spec):
+  panels = spec['panels']
+  for index, p in enumerate(panels):
+    ax = fig.add_subplot(len(panels), 1, index + 1)
+    for s in p['lines']:
+      y = s['y']
+      x = s['x'] if s['x'] is not None else np.arange(len(y)) * s['dx']
+      x, y = lttb(x, y, max_points)
+      ax.plot(x, y, s['fmt'], **s['kwargs'])
+    if p['xlabel']:
+      ax.set_xlabel(p['xlabel'])
+    if p['ylabel']:
+      ax.set_ylabel(p['ylabel'])
+    if p['title']:
+      ax.set_title(p['title'])
+    if p['grid']:
+      ax.grid()
+    if p['legend']:
+      ax.legend()
+  if spec['hspace'] is not None:
+    fig.subplots_adjust(hspace=spec['hspace'])
+
+@profiling.stage('plotting.render')
+def render(spec):
+  import_matplotlib()
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  fig = Figure(figsize=spec['figsize'])
+  FigureCanvasAgg(fig)
+  draw(fig, spec)
+  fig.savefig(spec['path'])
+
+@profiling.stage('plotting.show')
+def show(spec):
+  import_matplotlib()
+  import matplotlib.pyplot as plt
+  fig = plt.figure(figsize=spec['figsize'])
+  draw(fig, spec)
+  plt.draw()
+  plt.pause(show_seconds)
+  plt.close(fig)
+
+def render_loop(q):
+  while True:
+    spec = q.get()
+    try:
+      render(spec)
+    except Exception as e:
+      render_errors.append((spec['path'], e))
+      logger.warning("Failed to render %s: %s", spec['path'], e)
+    finally:
+      q.task_done()
+
+def start_worker():
+  global render_queue
+  with render_lock:
+    if render_queue is None:
+      render_queue = queue.Queue()
+      threading.Thread(target=render_loop, args=(render_queue,), name='plot-render', daemon=True).start()
+      atexit.register(flush)
+  return render_queue
@@ -0,0 +1,150 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+import numpy as np
+
+# Per-stage instrumentation of the algorithms. Stages are marked with the
+# `stage` decorator (or the `measure` context manager) and, once enabled, every
+# call records its wall time, CPU time, input size and, when memory tracing is
+# on, the bytes allocated at its peak. Records can be read in process, summed
+# per stage, or exported as JSON or as trace events for chrome://tracing and
+# Perfetto. CPU time is that of the calling thread, while memory tracing counts
+# the allocations of every thread. While disabled a marked call costs one
+# global lookup.
+
+enabled = False
+trace_memory = False
+
+records = []
+origin = time.perf_counter()
+local = threading.local()
+
+def enable(memory=False):
+  global enabled, trace_memory, origin
+  trace_memory = memory
+  if memory and not tracemalloc.is_tracing():
+    tracemalloc.start()
+  origin = time.perf_counter()
+  enabled = True
+
+def disable():
+  global enabled
+  enabled = False
+  if trace_memory and tracemalloc.is_tracing():
+    tracemalloc.stop()
+
+def reset():
+  del records[:]
+
+# Bytes of the array arguments
+def input_size(args):
+  size = 0
+  for arg in args:
+    if isinstance(arg, np.ndarray):
+      size += arg.nbytes
+  return size
+
+class Measurement:
+  def __init__(self, name, size):
+    self.name = name
+    self.size = size
+
+  def __enter__(self):
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+      stack = local.stack = []
+    if trace_memory:
+      current, peak = tracemalloc.get_traced_memory()
+      if stack:
+        # the enclosing stage keeps its own peak before it is reset for this one
+        stack[-1].children_peak = max(stack[-1].children_peak, peak)
+      tracemalloc.reset_peak()
+      self.start_memory = current
+      self.children_peak = 0
+    stack.append(self)
+    self.depth = len(stack) - 1
+    self.cpu_start = time.thread_time()
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    wall = time.perf_counter() - self.start
+    cpu = time.thread_time() - self.cpu_start
+    local.stack.pop()
+    record = {'stage': self.name, 'start': self.start - origin, 'wall': wall, 'cpu': cpu, 'input_bytes': self.size,
+      'allocated_bytes': None, 'thread': threading.current_thread().name, 'depth': self.depth}
+    if trace_memory:
+      peak = max(tracemalloc.get_traced_memory()[1], self.children_peak)
+      record['allocated_bytes'] = max(peak - self.start_memory, 0)
+      if local.stack:
+        local.stack[-1].children_peak = max(local.stack[-1].children_peak, peak)
+    records.append(record)
+    return False
+
+class NoMeasurement:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+no_measurement = NoMeasurement()
+
+# Context manager measuring the enclosed block as the given stage
+def measure(name, *data):
+  if not enabled:
+    return no_measurement
+  return Measurement(name, input_size(data))
+
+# Decorator marking a function as a stage, its array arguments count as its input
+def stage(name):
+  def decorate(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not enabled:
+        return function(*args, **kwargs)
+      with Measurement(name, input_size(args)):
+        return function(*args, **kwargs)
+    return wrapper
+  return decorate
+
+# Returns {stage: {'calls', 'wall', 'cpu', 'input_bytes', 'allocated_bytes'}} summed over all records
+def summary():
+  totals = {}
+  for r in records:
+    total = totals.setdefault(r['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'input_bytes': 0, 'allocated_bytes': None})
+    total['calls'] += 1
+    total['wall'] += r['wall']
+    total['cpu'] += r['cpu']
+    total['input_bytes'] += r['input_bytes']
+    if r['allocated_bytes'] is not None:
+      total['allocated_bytes'] = max(total['allocated_bytes'] or 0, r['allocated_bytes'])
+  return totals
+
+def format_summary():
+  lines = ["%-46s %6s %10s %10s %12s %12s" % ('stage', 'calls', 'wall (s)', 'cpu (s)', 'input (MB)', 'peak (MB)')]
+  for name, total in sorted(summary().items(), key=lambda item: -item[1]['wall']):
+    peak = '-' if total['allocated_bytes'] is None else '%.2f' % (total['allocated_bytes'] / 1e6)
+    lines.append("%-46s %6d %10.4f %10.4f %12.2f %12s" % (name, total['calls'], total['wall'], total['cpu'], total['input_bytes'] / 1e6, peak))
+  return '\n'.join(lines)
+
+def export_json(path):
+  with open(path, 'w') as f:
+    json.dump({'records': records, 'summary': summary()}, f, indent=2)
+
+# Writes the records in the trace event format, as complete ('X') events in microseconds
+def export_trace(path):
+  threads = {}
+  events = []
+  for r in records:
+    tid = threads.setdefault(r['thread'], len(threads))
+    events.append({'name': r['stage'], 'cat': r['stage'].split('.')[0], 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+      'ts': r['start'] * 1e6, 'dur': r['wall'] * 1e6,
+      'args': {'cpu_s': r['cpu'], 'input_bytes': r['input_bytes'], 'allocated_bytes': r['allocated_bytes']}})
+  for name, tid in threads.items():
+    events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}})
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
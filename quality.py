@@ -0,0 +1,131 @@
+import logging
+import operator
+from dataclasses import dataclass
+import numpy as np
+import scipy.fft
+
+import pipeline
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# Signal quality index of accelerometer recordings, shared by the algorithms to
+# reject unusable windows before their filters and transforms. Every window gets
+# a few cheap features of the magnitude of its samples, computed for all windows
+# at once: the standard deviation (motion above a bound, a stuck or disconnected
+# sensor below another), the share of samples at full scale (saturation) and the
+# power within the band of the estimate relative to white noise, from one batched
+# transform of the windows (below 1, the band holds less than its share of the
+# power, the window is dominated by drift or by noise outside of it).
+#
+# The rejected windows are not spliced out: an estimate of the whole recording
+# filters each run of consecutive accepted windows on its own and sums the power
+# of their spectra (spectral.runs_peak), and the windowed estimates skip the
+# analysis windows holding a rejected sample.
+
+# Returns start and end sample of each window of about window_size samples, split the
+# same way as np.array_split
+def window_bounds(size, window_size):
+  n_windows = int(size / window_size)
+  if n_windows < 1:
+    n_windows = 1
+  sizes = np.full(n_windows, size // n_windows)
+  sizes[:size % n_windows] += 1
+  ends = np.cumsum(sizes)
+  return ends - sizes, ends
+
+# Returns the samples of the given windows, a view when they are contiguous
+def select(data, bounds, windows):
+  starts, ends = bounds
+  if len(windows) > 0 and np.all(np.diff(windows) == 1):
+    return data[starts[windows[0]]:ends[windows[-1]]]
+  return data[np.repeat(np.isin(np.arange(len(starts)), windows), ends - starts)]
+
+# Quality thresholds of a window. The configuration is immutable, one instance can be shared between threads.
+@dataclass(frozen=True)
+class SignalQuality:
+  window_duration: float = 30 # seconds
+  max_magnitude_std: float = 1.0 # m/s^2, motion above
+  min_magnitude_std: float = 1e-4 # m/s^2, a flat line below
+  max_clipping_ratio: float = 0.01 # share of the samples of an axis at full scale
+  full_scale: float = None # m/s^2, the extremes of each axis over the recording by default
+  min_band_power_ratio: float = 0.5 # power within the band, relative to white noise
+
+  # Returns the features of each window of (N, 3) data at fs, in windows of window_duration or of the
+  # given (starts, ends) bounds: magnitude_std, clipping_ratio and band_power_ratio of [f_low, f_high]
+  def features(self, data, fs, f_low, f_high, bounds=None):
+    data = np.asarray(data)[:,0:3]
+    starts, ends = bounds if bounds is not None else window_bounds(len(data), self.window_duration * fs)
+    if len(data) == 0:
+      return {name: np.zeros(0) for name in ('magnitude_std', 'clipping_ratio', 'band_power_ratio')}
+    sizes = ends - starts
+    magnitude = np.sqrt(np.einsum('ij,ij->i', data, data, dtype=np.float64))
+    centred = magnitude - np.repeat(np.add.reduceat(magnitude, starts) / sizes, sizes)
+    magnitude_std = np.sqrt(np.add.reduceat(centred * centred, starts) / sizes)
+
+    window_low, window_high = np.minimum.reduceat(data, starts, axis=0), np.maximum.reduceat(data, starts, axis=0)
+    if self.full_scale is None:
+      low, high = np.nanmin(window_low, axis=0), np.nanmax(window_high, axis=0)
+    else:
+      low, high = -self.full_scale, self.full_scale
+    # only the windows reaching full scale are compared sample by sample, the ratio is the one of their most clipped axis
+    reached = np.flatnonzero(np.any((window_low <= low) | (window_high >= high), axis=1))
+    clipping_ratio = np.zeros(len(starts))
+    if len(reached) > 0:
+      spans = select(data, (starts, ends), reached)
+      span_sizes = sizes[reached]
+      clipped = np.add.reduceat((spans <= low) | (spans >= high), np.cumsum(span_sizes) - span_sizes, axis=0, dtype=np.intp)
+      clipping_ratio[reached] = clipped.max(axis=1) / span_sizes
+
+    # the first samples of every window, as many as in the shortest one, transformed together
+    length = int(sizes.min())
+    power = np.abs(scipy.fft.rfft(np.lib.stride_tricks.sliding_window_view(centred, length)[starts], axis=1)) ** 2
+    f = scipy.fft.rfftfreq(length, 1 / fs)
+    in_band = (f >= f_low) & (f <= f_high)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      # without bins in the band the ratio is NaN, and not held against the window
+      band_power_ratio = power[:,in_band].sum(axis=1) / power[:,1:].sum(axis=1) / in_band[1:].mean()
+    return {'magnitude_std': magnitude_std, 'clipping_ratio': clipping_ratio, 'band_power_ratio': band_power_ratio}
+
+  # Returns the boolean mask of the windows of the given features meeting every threshold, a window holding NaN fails
+  def accepted(self, features):
+    std = features['magnitude_std']
+    return ((std >= self.min_magnitude_std) & (std <= self.max_magnitude_std)
+      & (features['clipping_ratio'] <= self.max_clipping_ratio) & ~(features['band_power_ratio'] < self.min_band_power_ratio))
+
+  # Returns the (starts, ends) bounds of the windows of data and their accepted mask
+  def usable(self, data, fs, f_low, f_high):
+    bounds = window_bounds(len(data), self.window_duration * fs)
+    accepted = self.accepted(self.features(data, fs, f_low, f_high, bounds))
+    report(accepted)
+    return bounds, accepted
+
+  # Returns the (starts, ends) bounds of each run of consecutive accepted windows of data, and the
+  # accepted window mask
+  @profiling.stage('quality.gate')
+  def gate(self, data, fs, f_low, f_high):
+    bounds, accepted = self.usable(data, fs, f_low, f_high)
+    return accepted_runs(bounds, accepted), accepted
+
+  # Returns the pipeline nodes of the runs of consecutive accepted windows of data (or a node), views
+  # of its samples, and the accepted window mask. Each run is filtered on its own, a filter never
+  # spans the rejected windows between two runs.
+  def gated(self, data, fs, f_low, f_high):
+    source = pipeline.source(data)
+    (starts, ends), accepted = source.then('quality_gate', self.gate, fs, f_low, f_high, depends=(self,)).value
+    return [source.then('accepted_run', operator.getitem, slice(int(start), int(end))) for start, end in zip(starts, ends)], accepted
+
+  # Returns the boolean mask of the samples of data in accepted windows
+  def accepted_samples(self, data, fs, f_low, f_high):
+    (starts, ends), accepted = self.usable(data, fs, f_low, f_high)
+    return np.repeat(accepted, ends - starts)
+
+# Returns the (starts, ends) sample bounds of each run of consecutive accepted windows
+def accepted_runs(bounds, accepted):
+  starts, ends = bounds
+  edges = np.diff(np.concatenate(([0], np.asarray(accepted, dtype=np.int8), [0])))
+  return starts[edges[:-1] == 1], ends[edges[1:] == -1]
+
+def report(accepted):
+  logger.info('Signal quality: %d of %d windows accepted (%.0f%%)', np.count_nonzero(accepted), len(accepted),
+    100 * np.count_nonzero(accepted) / max(len(accepted), 1))
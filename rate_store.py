@@ -0,0 +1,260 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+import ingest
+import plotting
+from bio_watch import bio_watch_windows
+from seismotracker import seismotracker_windows
+
+logger = logging.getLogger(__name__)
+
+# Append-only store of the rates over time of many devices, for long-term monitoring.
+# Rows are fixed-width binary records (record_dtype), appended to one partition per
+# device and UTC day, and read back through a memory map without parsing. Each
+# partition keeps a time index: the first and last time of every block of
+# block_records rows, so a query reads only the blocks overlapping its time range.
+# Rows of a partition need not be appended in time order.
+#
+# The minimum, mean and maximum of each rate per minute and per hour are kept up to
+# date as rows are appended, as dense (algorithms, buckets) tables per partition,
+# so dashboards read them without scanning the rows. One writer per store.
+#
+#   <directory>/algorithms.json                 algorithm names, by record code
+#   <directory>/<device>/<YYYY-MM-DD>.rates     records
+#   <directory>/<device>/<YYYY-MM-DD>.index.npy first and last time of each block
+#   <directory>/<device>/<YYYY-MM-DD>.minute.npy, .hour.npy   aggregates
+
+store_dir = '.cache/rates'
+block_records = 4096
+measures = ['heart_rate', 'breathing_rate']
+record_dtype = np.dtype([('time', '<f8'), ('algorithm', '<u2'), ('heart_rate', '<f4'), ('breathing_rate', '<f4'),
+  ('heart_rate_confidence', '<f4'), ('breathing_rate_confidence', '<f4')])
+aggregate_dtype = np.dtype([(measure + suffix, dtype) for measure in measures
+  for suffix, dtype in [('_count', '<i4'), ('_sum', '<f8'), ('_min', '<f4'), ('_max', '<f4')]])
+resolutions = {'minute': 60, 'hour': 3600} # bucket seconds
+day_seconds = 86400
+
+# Algorithms with rates over windows
+window_algorithms = {'Bio Watch': bio_watch_windows, 'SeismoTracker': seismotracker_windows}
+
+# UTC day number of unix times (s)
+def day_of(times):
+  return np.floor_divide(times, day_seconds).astype(np.int64)
+
+def day_name(day):
+  return (datetime.date(1970, 1, 1) + datetime.timedelta(days=int(day))).isoformat()
+
+# Writes an array to a .npy file, atomically
+def save_array(path, array):
+  with ingest.atomic_write(path) as f:
+    np.save(f, array)
+
+# Returns empty aggregate tables of the given number of algorithms and buckets
+def empty_aggregates(algorithms, buckets):
+  table = np.zeros((algorithms, buckets), dtype=aggregate_dtype)
+  for measure in measures:
+    table[measure + '_min'] = np.inf
+    table[measure + '_max'] = -np.inf
+  return table
+
+# Adds records to aggregate tables, in place, at the given bucket of each record
+def accumulate(table, records, buckets):
+  for measure in measures:
+    values = records[measure]
+    finite = np.isfinite(values)
+    at = (records['algorithm'][finite], buckets[finite])
+    np.add.at(table[measure + '_count'], at, 1)
+    np.add.at(table[measure + '_sum'], at, values[finite])
+    np.minimum.at(table[measure + '_min'], at, values[finite])
+    np.maximum.at(table[measure + '_max'], at, values[finite])
+
+class RateStore:
+  def __init__(self, directory=None):
+    self.directory = directory or store_dir
+    self.algorithms_path = os.path.join(self.directory, 'algorithms.json')
+    self.algorithms = (ingest.read_metadata(self.algorithms_path) or {}).get('algorithms', [])
+
+  # Record code of an algorithm, registered when new
+  def algorithm_code(self, algorithm):
+    if algorithm not in self.algorithms:
+      self.algorithms.append(algorithm)
+      os.makedirs(self.directory, exist_ok=True)
+      ingest.write_metadata(self.algorithms_path, {'algorithms': self.algorithms})
+    return self.algorithms.index(algorithm)
+
+  def partition_path(self, device, day, suffix):
+    return os.path.join(self.directory, device, day_name(day) + suffix)
+
+  def devices(self):
+    if not os.path.isdir(self.directory):
+      return []
+    return sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name)))
+
+  # Days (UTC day numbers) holding rows of a device
+  def days(self, device):
+    directory = os.path.join(self.directory, device)
+    if not os.path.isdir(directory):
+      return []
+    return sorted((datetime.date.fromisoformat(name[:-len('.rates')]) - datetime.date(1970, 1, 1)).days
+      for name in os.listdir(directory) if name.endswith('.rates'))
+
+  # Returns the records of a partition, memory mapped
+  def records(self, device, day):
+    path = self.partition_path(device, day, '.rates')
+    rows = os.path.getsize(path) // record_dtype.itemsize if os.path.exists(path) else 0
+    if rows == 0:
+      return np.zeros(0, dtype=record_dtype)
+    return np.memmap(path, dtype=record_dtype, mode='r', shape=(rows,))
+
+  # Returns the (blocks, 2) first and last time of every block of a partition, completed from the
+  # records when they hold more blocks than the stored index (after an interrupted append)
+  def time_index(self, device, day, records=None):
+    records = self.records(device, day) if records is None else records
+    path = self.partition_path(device, day, '.index.npy')
+    index = np.load(path) if os.path.exists(path) else np.zeros((0, 2))
+    blocks = -(-len(records) // block_records)
+    if len(index) < blocks or (blocks > 0 and len(records) % block_records != 0):
+      first = max(min(len(index), blocks) - 1, 0)
+      tail = records['time'][first * block_records:]
+      starts = np.arange(0, len(tail), block_records)
+      index = np.concatenate((index[:first], np.column_stack((np.minimum.reduceat(tail, starts), np.maximum.reduceat(tail, starts)))))
+    return index
+
+  # Appends the rates of an algorithm on a device at unix times (s), with the confidence of each
+  # rate when known, and updates the time index and the aggregates of the partitions written
+  def append(self, device, algorithm, times, heart_rate, breathing_rate, heart_rate_confidence=np.nan, breathing_rate_confidence=np.nan):
+    records = np.zeros(len(times), dtype=record_dtype)
+    records['time'] = times
+    records['algorithm'] = self.algorithm_code(algorithm)
+    records['heart_rate'] = heart_rate
+    records['breathing_rate'] = breathing_rate
+    records['heart_rate_confidence'] = heart_rate_confidence
+    records['breathing_rate_confidence'] = breathing_rate_confidence
+    days = day_of(records['time'])
+    os.makedirs(os.path.join(self.directory, device), exist_ok=True)
+    for day in np.unique(days):
+      self.append_partition(device, day, records[days == day])
+
+  def append_partition(self, device, day, records):
+    path = self.partition_path(device, day, '.rates')
+    with open(path, 'ab') as f:
+      f.write(records.tobytes())
+    save_array(self.partition_path(device, day, '.index.npy'), self.time_index(device, day))
+    seconds = records['time'] - day * day_seconds
+    for resolution, bucket_seconds in resolutions.items():
+      aggregate_path = self.partition_path(device, day, '.%s.npy' % resolution)
+      table = np.load(aggregate_path) if os.path.exists(aggregate_path) else empty_aggregates(0, day_seconds // bucket_seconds)
+      if len(table) < len(self.algorithms):
+        table = np.concatenate((table, empty_aggregates(len(self.algorithms) - len(table), table.shape[1])))
+      accumulate(table, records, (seconds // bucket_seconds).astype(np.intp))
+      save_array(aggregate_path, table)
+
+  # Returns the rows of a device within [start, end) (unix times, s), of one algorithm or all, as a
+  # dict of NumPy arrays sorted by time: time, algorithm (names), the rates and their confidences.
+  # Only the blocks of the time index overlapping the range are read.
+  def query(self, device, start, end, algorithm=None):
+    selected = []
+    for day in self.days(device) if algorithm is None or algorithm in self.algorithms else []:
+      if day < day_of(start) or day > day_of(np.nextafter(end, -np.inf)):
+        continue
+      records = self.records(device, day)
+      index = self.time_index(device, day, records)
+      blocks = np.flatnonzero((index[:,1] >= start) & (index[:,0] < end))
+      # runs of consecutive blocks are read in one slice
+      for run in np.split(blocks, np.flatnonzero(np.diff(blocks) > 1) + 1) if len(blocks) else []:
+        rows = np.array(records[run[0] * block_records:(run[-1] + 1) * block_records])
+        keep = (rows['time'] >= start) & (rows['time'] < end)
+        if algorithm is not None:
+          keep &= rows['algorithm'] == self.algorithms.index(algorithm)
+        selected.append(rows[keep])
+    rows = np.concatenate(selected) if selected else np.zeros(0, dtype=record_dtype)
+    rows = rows[np.argsort(rows['time'], kind='stable')]
+    result = {name: rows[name] for name in record_dtype.names}
+    result['algorithm'] = np.array(self.algorithms + [''])[rows['algorithm']] if len(rows) else np.zeros(0, dtype=str)
+    return result
+
+  # Returns the minimum, mean and maximum of each rate of an algorithm on a device in the minutes or
+  # hours starting within [start, end), from the aggregates kept as rows are appended, as a dict of
+  # NumPy arrays: time (start of each bucket holding rows), count and <rate>_min, _mean, _max
+  def aggregates(self, device, algorithm, start, end, resolution='minute'):
+    bucket_seconds = resolutions[resolution]
+    code = self.algorithms.index(algorithm) if algorithm in self.algorithms else None
+    times, tables = [], []
+    for day in self.days(device):
+      path = self.partition_path(device, day, '.%s.npy' % resolution)
+      if code is None or day < day_of(start) or day > day_of(np.nextafter(end, -np.inf)) or not os.path.exists(path):
+        continue
+      table = np.load(path)
+      if code >= len(table):
+        continue
+      bucket_times = day * day_seconds + np.arange(table.shape[1]) * bucket_seconds
+      keep = (bucket_times >= start) & (bucket_times < end) & (table[code]['heart_rate_count'] + table[code]['breathing_rate_count'] > 0)
+      times.append(bucket_times[keep])
+      tables.append(table[code][keep])
+    table = np.concatenate(tables) if tables else np.zeros(0, dtype=aggregate_dtype)
+    result = {'time': np.concatenate(times).astype(np.float64) if times else np.zeros(0)}
+    with np.errstate(divide='ignore', invalid='ignore'):
+      for measure in measures:
+        count = table[measure + '_count']
+        result[measure + '_count'] = count
+        result[measure + '_min'] = np.where(count > 0, table[measure + '_min'], np.nan)
+        result[measure + '_mean'] = np.where(count > 0, table[measure + '_sum'] / count, np.nan)
+        result[measure + '_max'] = np.where(count > 0, table[measure + '_max'], np.nan)
+    return result
+
+# Estimates the rates over time of a recording starting at a unix time with every window algorithm,
+# appends them to the store and returns the duration of the recording (s)
+def store_recording(store, device, path, start_time, sampling_rate=None, window_seconds=30, hop_seconds=5):
+  data, metadata = ingest.load(path, sampling_rate)
+  fs = metadata['sampling_rate'] or sampling_rate
+  for algorithm, estimate in sorted(window_algorithms.items()):
+    rates = estimate(np.asarray(data), fs, window_seconds, hop_seconds)
+    store.append(device, algorithm, start_time + rates['time'].to_numpy(), rates['heart_rate'].to_numpy(), rates['breathing_rate'].to_numpy(),
+      rates['heart_rate_confidence'].to_numpy(), rates['breathing_rate_confidence'].to_numpy())
+    logger.info('%s: %d windows of %s from %s', device, len(rates), algorithm, path)
+  return len(data) / fs
+
+def parse_time(value):
+  return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Store the rates over time of recordings per device, and query them.')
+  parser.add_argument('--directory', default=store_dir)
+  commands = parser.add_subparsers(dest='command', required=True)
+  write = commands.add_parser('write', help='estimate the rates over time of recordings and append them')
+  write.add_argument('paths', nargs='+')
+  write.add_argument('--device', required=True)
+  write.add_argument('--start', required=True, help='UTC time of the first sample of the first recording, e.g. 2024-01-01T22:00, later recordings follow it')
+  write.add_argument('--sampling-rate', type=float)
+  query = commands.add_parser('query', help='print the rates or their aggregates of a device over a time range')
+  query.add_argument('--device', required=True)
+  query.add_argument('--start', required=True, help='UTC time')
+  query.add_argument('--end', required=True, help='UTC time')
+  query.add_argument('--algorithm', choices=sorted(window_algorithms))
+  query.add_argument('--aggregate', choices=sorted(resolutions), help='print the aggregates per minute or hour instead of the rows')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+  plotting.set_mode('headless')
+  store = RateStore(args.directory)
+
+  if args.command == 'write':
+    start_time = parse_time(args.start)
+    for path in args.paths:
+      start_time += store_recording(store, args.device, path, start_time, args.sampling_rate)
+  else:
+    start = time.perf_counter()
+    if args.aggregate:
+      result = store.aggregates(args.device, args.algorithm or sorted(window_algorithms)[0], parse_time(args.start), parse_time(args.end), args.aggregate)
+    else:
+      result = store.query(args.device, parse_time(args.start), parse_time(args.end), args.algorithm)
+    seconds = time.perf_counter() - start
+    rows = {name: values for name, values in result.items()}
+    rows['time'] = [datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S') for t in result['time']]
+    print(pd.DataFrame(rows).to_string(index=False))
+    print("%d rows in %.3f s" % (len(result['time']), seconds))
@@ -0,0 +1,166 @@
+import ast
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+import ingest
+
+# Persistent store of the rates of each (recording, algorithm) pair, keyed by the
+# SHA-256 of the recording's source file, its dtype, the algorithm, every field
+# of its estimator and the code version: the hash of the syntax tree of the
+# algorithm's module, of ingest, which parses the source file, and of every
+# module of this directory they import. The
+# module level defaults of the estimator fields are left out of the code version,
+# their values are keyed as parameters, so changing one recomputes only the pairs
+# that use it.
+#
+# Large intermediate stages of the pipeline (denoised and filtered signals) are
+# kept alongside as .npy artifacts, read back by a pipeline.Memo given the store.
+# Artifacts are keyed by their pipeline node and the code version of the modules
+# computing it, and evicted in least recently used order beyond a disk budget.
+# A refreshing store reads neither, and stores everything computed again.
+
+store_dir = '.cache/results'
+default_budget_bytes = 1 << 30
+artifact_stages = ('tv_filter', 'bandpass', 'pass_filter')
+source_dir = os.path.dirname(os.path.abspath(__file__))
+
+def digest(value):
+  return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+# Names of the modules of this directory imported by the source
+def local_imports(source):
+  names = set()
+  for node in ast.walk(ast.parse(source)):
+    if isinstance(node, ast.Import):
+      names.update(alias.name.split('.')[0] for alias in node.names)
+    elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+      names.add(node.module.split('.')[0])
+  return [name for name in names if os.path.exists(os.path.join(source_dir, name + '.py'))]
+
+# Syntax tree of a module without the module level assignments of the given names
+def code_without(source, names):
+  tree = ast.parse(source)
+  tree.body = [node for node in tree.body if not (isinstance(node, ast.Assign)
+    and all(isinstance(target, ast.Name) and target.id in names for target in node.targets))]
+  return ast.dump(tree)
+
+# Hash of the code of the given modules and of every module of this directory they import, directly
+# or not, without the module level assignments of the parameter names. Comments and formatting do
+# not count, and modules from elsewhere (the standard library, numpy, ...) are left out.
+@functools.lru_cache(maxsize=None)
+def code_version(module_names, parameters=()):
+  sources = {}
+  pending = list(module_names)
+  while pending:
+    name = pending.pop()
+    if name in sources or not os.path.exists(os.path.join(source_dir, name + '.py')):
+      continue
+    with open(os.path.join(source_dir, name + '.py'), 'rb') as f:
+      sources[name] = f.read()
+    pending.extend(local_imports(sources[name]))
+  version = hashlib.sha256()
+  for name in sorted(sources):
+    version.update((name + '\0' + code_without(sources[name], set(parameters)) + '\0').encode())
+  return version.hexdigest()
+
+# SHA-256 of a recording's source file, from its ingest cache when that is fresh
+def source_hash(path, dtype=np.float64):
+  npy_path, json_path = ingest.cache_paths(path, dtype)
+  metadata = ingest.read_metadata(json_path)
+  if ingest.is_fresh(path, metadata, npy_path):
+    return metadata['sha256']
+  return ingest.file_hash(path)
+
+# parameters are the names of the estimator fields of every algorithm, left out of the code version of artifacts
+class ResultStore:
+  def __init__(self, directory=None, budget_bytes=default_budget_bytes, parameters=(), refresh=False):
+    self.directory = directory or store_dir
+    self.budget_bytes = budget_bytes
+    self.parameters = tuple(sorted(parameters))
+    self.refresh = refresh
+    self.stages = artifact_stages
+    self.index_path = os.path.join(self.directory, 'index.json')
+    self.index = ingest.read_metadata(self.index_path) or {'results': {}, 'artifacts': {}}
+    self.artifact_hits = 0
+    self.artifact_misses = 0
+
+  def flush(self):
+    os.makedirs(self.directory, exist_ok=True)
+    ingest.write_metadata(self.index_path, self.index)
+
+  # Key of the rates of algorithm, run by estimator (a dataclass) on the source with the given hash
+  def result_key(self, source_sha256, dtype, algorithm, estimator, module_name):
+    return digest({'source': source_sha256, 'dtype': np.dtype(dtype).str, 'algorithm': algorithm,
+      'parameters': dataclasses.asdict(estimator),
+      'code': code_version((module_name, 'ingest'), tuple(sorted(f.name for f in dataclasses.fields(estimator))))})
+
+  # Returns the stored result of key, or None
+  def result(self, key):
+    if self.refresh:
+      return None
+    return self.index['results'].get(key)
+
+  def save_result(self, key, result):
+    self.index['results'][key] = dict(result, stored=time.time())
+    self.flush()
+
+  def artifact_path(self, name):
+    return os.path.join(self.directory, 'artifacts', name + '.npy')
+
+  def artifact_name(self, node_key, modules):
+    return hashlib.sha256((node_key + code_version(tuple(sorted(modules)), self.parameters)).encode()).hexdigest()[:32]
+
+  # Returns the stored value of a pipeline node, computed by the given modules, memory mapped, or None
+  def load(self, node_key, stage, modules):
+    if stage not in self.stages:
+      return None
+    name = self.artifact_name(node_key, modules)
+    entry = self.index['artifacts'].get(name) if not self.refresh else None
+    try:
+      value = np.load(self.artifact_path(name), mmap_mode='r') if entry else None
+    except (OSError, ValueError):
+      value = None
+    if value is None:
+      self.artifact_misses += 1
+      return None
+    self.artifact_hits += 1
+    entry['accessed'] = time.time()
+    self.flush()
+    return value
+
+  # Stores the value of a pipeline node of an artifact stage, evicting the least recently used beyond the budget
+  def save(self, node_key, stage, modules, value):
+    if stage not in self.stages or not isinstance(value, np.ndarray) or value.nbytes > self.budget_bytes:
+      return
+    name = self.artifact_name(node_key, modules)
+    path = self.artifact_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with ingest.atomic_write(path) as f:
+      np.save(f, value)
+    self.index['artifacts'][name] = {'stage': stage, 'bytes': os.path.getsize(path), 'accessed': time.time()}
+    self.evict()
+    self.flush()
+
+  def artifact_bytes(self):
+    return sum(entry['bytes'] for entry in self.index['artifacts'].values())
+
+  def evict(self):
+    artifacts = self.index['artifacts']
+    total = self.artifact_bytes()
+    for name in sorted(artifacts, key=lambda name: artifacts[name]['accessed']):
+      if total <= self.budget_bytes:
+        break
+      total -= artifacts.pop(name)['bytes']
+      try:
+        os.remove(self.artifact_path(name))
+      except OSError:
+        pass
+
+  def stats(self):
+    return {'results': len(self.index['results']), 'artifacts': len(self.index['artifacts']), 'artifact_bytes': self.artifact_bytes(),
+      'budget_bytes': self.budget_bytes, 'artifact_hits': self.artifact_hits, 'artifact_misses': self.artifact_misses}
@@ -1,19 +1,19 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import style
-import scipy.fftpack
-import scipy as sp
 import pandas as pd
-from scipy.stats import zscore
-from scipy.signal import butter, filtfilt
-from scipy import signal
-
-style.use('ggplot')
-save_plots = True
+from dataclasses import dataclass, replace
+import logging
+import sys
+import spectral
+import filters
+import pipeline
+import plotting
+import profiling
+from quality import SignalQuality
 
 # Source: https://archive.ics.uci.edu/ml/datasets/MHEALTH+Dataset
 input_file_path = 'datasets/uic_dataset.csv'
 
+# Defaults of the module level functions, SeismoTracker instances carry their own configuration
 sampling_frequency = 50
 highpass_cutoff_frequency = 5.6
 lowpass_cutoff_frequency = 0.66 #TODO: Validate lowpass cutoff frequency
@@ -22,154 +22,214 @@ hr_min_freq = 0.66 #TODO: Validate assumption of filtering freq in range
 hr_max_freq = 2.5
 br_min_freq = 0.13
 br_max_freq = 0.66
+axes = {'x': 0, 'y': 1, 'z': 2}
 
-def plot(data, title, plot_save_path):
-  N = len(data)
-  y = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(y, data)
-
-  plt.title(title)
-  plt.ylabel('ACCELERATION Ax (m/s^2)')
-  plt.xlabel('TIME (s)')
-  draw_plot(plot_save_path)
-  plt.close()
-
-def plot_hr_graph(data, plot_save_path):
-  data = np.array(data)
-  N = len(data)
-  y = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(y, data)
-
-  plt.title('Heart Rate signal')
-  plt.ylabel('Amplitude')
-  plt.xlabel('Time (s)')
-  # plt.axis([0,61,0.0006,-0.0006])
-  draw_plot(plot_save_path)
-  plt.close()
-  return
-
-def draw_plot(plot_save_path):
-  if (save_plots):
-    plt.savefig(plot_save_path)
-  else:
-    plt.draw()
-    plt.pause(5)
-
-def fft(data, f_low, f_high, plot_save_path):
-  N = len(data)
-  fft_data = sp.fftpack.fft(data)
-  f = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(f[:N // 2], np.abs(fft_data)[:N // 2] * 1 / N)
-  plt.xlabel('Frequency in Hertz [Hz]')
-  plt.ylabel('Amplitude')
-  plt.title('FFT')
-
-  draw_plot(plot_save_path)
-  plt.close()
-
-  max_amp = 0
-  max_index = 0
-  index = 0
-  for c in fft_data:
-    if f[index] < f_low or f[index] > f_high:
-      index = index + 1
-      continue;
-    real = np.real(c)
-    img = np.imag(c)
-    amp = np.sqrt(real*real + img*img)
-    if max_amp < amp:
-      max_amp = amp
-      max_index = index
-    index = index + 1
-
-  print('Max Amplitude:', max_amp)
-  print('Frequency:',f[max_index])
-  return 60*f[max_index]
+logger = logging.getLogger(__name__)
 
+# Filters every column of data, the design is cached in second-order sections form
 def butter_pass_filter(data, cutoff, fs, btype, order=5):
-    nyq = 0.5 * fs
-    normal_cutoff = cutoff / nyq
-    b, a = butter(order, normal_cutoff, btype=btype, analog=False)
-    y = filtfilt(b, a, data)
-    return y
+  return filters.filtfilt(data, cutoff, fs, order, btype)
+
+# butter_pass_filter written over data
+def butter_pass_filter_in_place(data, cutoff, fs, btype, order=5):
+  return filters.filtfilt_in_place(data, cutoff, fs, order, btype)
 
+# z-score of each axis, in place
+@profiling.stage('seismotracker.normalize')
 def normalize(data):
-  data[:,0] = sp.stats.zscore(data[:,0])
-  data[:,1] = sp.stats.zscore(data[:,1])
-  data[:,2] = sp.stats.zscore(data[:,2])
-  return data
+  return pipeline.normalize(data)
+
+# Heart and breathing rate estimator. The configuration is immutable and every call
+# works on its own copy of the data, so one instance can be shared between threads.
+@dataclass(frozen=True)
+class SeismoTracker:
+  sampling_frequency: float = 50
+  highpass_cutoff_frequency: float = 5.6
+  lowpass_cutoff_frequency: float = 0.66
+  hr_min_freq: float = 0.66
+  hr_max_freq: float = 2.5
+  br_min_freq: float = 0.13
+  br_max_freq: float = 0.66
+  filter_order: int = 2
+  rate_window_duration: float = 30 # seconds, windows of estimate_windows
+  rate_hop_duration: float = 5 # seconds
+  multirate: bool = True # analyse each band at the lowest adequate sampling rate
+  rate_resolution: float = None # bpm, resolve spectral peaks this finely instead of the FFT bins of 60 fs/N bpm
+  signal_quality: SignalQuality = None # reject the windows failing it before any filter, see quality
+
+  # Hz, of rate_resolution
+  @property
+  def frequency_resolution(self):
+    return self.rate_resolution / 60 if self.rate_resolution else None
+
+  def plot(self, data, title, plot_save_path):
+    plotting.line(plot_save_path, data, title, 'TIME (s)', 'ACCELERATION Ax (m/s^2)', dx=1/self.sampling_frequency)
+
+  def plot_hr_graph(self, data, plot_save_path):
+    plotting.line(plot_save_path, data, 'Heart Rate signal', 'Time (s)', 'Amplitude', dx=1/self.sampling_frequency)
+
+  # Returns the estimator at the decimated rate and the data (or pipeline node) decimated to the lowest
+  # rate keeping [0, f_high], or this estimator and the data as is without the multirate front-end
+  def decimated(self, data, f_high):
+    factor = filters.decimation_factor(self.sampling_frequency, f_high) if self.multirate else 1
+    if factor == 1:
+      return self, data
+    estimator = replace(self, sampling_frequency=self.sampling_frequency / factor)
+    if isinstance(data, pipeline.Node):
+      return estimator, data.then('decimate', filters.decimate, factor, 0, profile='seismotracker.decimate')
+    with profiling.measure('seismotracker.decimate', data):
+      return estimator, filters.decimate(data, factor)
+
+  # Returns the estimator at the decimated rate and the nodes of the runs (nodes) of a recording
+  # decimated one by one, see decimated()
+  def decimated_runs(self, runs, f_high):
+    decimated = [self.decimated(run, f_high) for run in runs]
+    return decimated[0][0], [run for _, run in decimated]
+
+  # Returns the rate (bpm) of the spectral peak within [f_low, f_high] for each axis, of data or
+  # of the value of a pipeline node, or of a list of the runs of a recording (see spectral.runs_peak)
+  @profiling.stage('seismotracker.fft')
+  def fft(self, data, f_low, f_high, plot_save_paths, work=None):
+    runs = pipeline.gathered(pipeline.source(run) for run in (data if isinstance(data, list) else [data]))
+    max_amp, max_freq, f, amplitude = runs.then('peak', spectral.runs_peak, self.sampling_frequency, f_low, f_high, False, work, self.frequency_resolution).value
+    for index, plot_save_path in enumerate(plot_save_paths if plotting.enabled() else []):
+      plotting.line(plot_save_path, amplitude[:,index] * 1 / sum(len(run) for run in runs.value), 'FFT', 'Frequency in Hertz [Hz]', 'Amplitude', x=f)
+
+    for axis, index in axes.items():
+      logger.info("%s-Axis:", axis.upper())
+      logger.info('Max Amplitude: %s', max_amp[index])
+      logger.info('Frequency: %s', max_freq[index])
+    return 60*max_freq
+
+  # Filters data, or a pipeline node into a node. With in_place, the value of the node is
+  # filtered in place (see pipeline.Node.then), unless it is kept for the plots.
+  def apply_pass_filter(self, unfiltered_data, btype, cutoff, plot_save_path, in_place=False):
+    unfiltered = pipeline.source(unfiltered_data)
+    if in_place and not plotting.enabled():
+      filtered = unfiltered.then('pass_filter', butter_pass_filter_in_place, cutoff, self.sampling_frequency, btype, self.filter_order, in_place=True,
+        profile='seismotracker.apply_pass_filter')
+    else:
+      filtered = unfiltered.then('pass_filter', butter_pass_filter, cutoff, self.sampling_frequency, btype, self.filter_order,
+        profile='seismotracker.apply_pass_filter')
+    if plotting.enabled():
+      self.plot_pass_filter(unfiltered.value, filtered.value, btype, plot_save_path)
+    return filtered if isinstance(unfiltered_data, pipeline.Node) else filtered.value
+
+  def plot_pass_filter(self, unfiltered_data, filtered_data, btype, plot_save_path):
+    if not plotting.enabled():
+      return
+    dt = 1/self.sampling_frequency
+    panels = []
+    for axis, index in axes.items():
+      panels.append(plotting.panel([
+        plotting.series(unfiltered_data[:,index], dx=dt, fmt='b-', label="data %s-axis" % axis),
+        plotting.series(filtered_data[:,index], dx=dt, fmt='g-', linewidth=2, label="filtered data %s-axis" % axis)],
+        xlabel='Time [sec]', grid=True, legend=True))
+    panels[-1]['title'] = "%s pass filtering" % btype
+    plotting.figure(plot_save_path, panels, figsize=(12,8), hspace=0.35)
+
+  # Returns (heart rate, breathing rate) in bpm. The given data (or pipeline node) is not modified:
+  # it is normalized and filtered in place on one copy, in float32 for float32 data and float64
+  # otherwise, and both transforms pad their input in one work buffer. Given a pipeline memo, the
+  # stages run on their own copies and are shared with the other estimates of the same recording
+  # through it. With a signal_quality, only the windows it accepts are estimated, each run of
+  # consecutive accepted windows filtered on its own.
+  @profiling.stage('seismotracker.estimate')
+  def estimate(self, data, memo=None):
+    source = pipeline.source(data, memo)
+    runs = [source]
+    if self.signal_quality is not None:
+      runs, accepted = self.signal_quality.gated(source, self.sampling_frequency, self.br_min_freq, self.hr_max_freq)
+      if not accepted.any():
+        logger.warning('No window of sufficient signal quality to process')
+        return 0, 0
+    data = source.value
+    work = spectral.work_buffer(max(len(run.value) for run in runs), data.shape[1], spectral.float_dtype(data.dtype))
+    self.plot(data[:,0], 'Unfiltered Raw Accelerometer Data', 'plots/seismotracker/raw_ax.png')
+    normalized_runs = [run.then('normalize', pipeline.normalized) for run in runs]
+    for normalized_data in normalized_runs:
+      # both rates read it, it is computed here rather than in the stage of the first one
+      normalized_data.value
+    logger.info('Breathing Rate:')
+    estimator, br_data = self.decimated_runs(normalized_runs, self.br_max_freq)
+    breathing_rate = estimator.fft(br_data, self.br_min_freq, self.br_max_freq, ['plots/seismotracker/br_fft_xaxis.png', 'plots/seismotracker/br_fft_yaxis.png', 'plots/seismotracker/br_fft_zaxis.png'], work)
+    logger.info("Respiration Rate (bpm): %s", breathing_rate)
+    avg_br = np.mean(breathing_rate)
+    logger.info("Average Respiration Rate (bpm): %s", avg_br)
+
+    logger.info('\nHeart Rate:')
+
+    # the breathing rate is estimated, the normalized data is filtered in place from here on
+    filtered_runs = []
+    for normalized_data in normalized_runs:
+      highpass_filtered_data = self.apply_pass_filter(normalized_data, 'high', self.highpass_cutoff_frequency, 'plots/seismotracker/hr_highpass_filtering.png', in_place=True)
+      filtered_runs.append(self.apply_pass_filter(highpass_filtered_data, 'low', self.lowpass_cutoff_frequency, 'plots/seismotracker/hr_lowpass_filtering.png', in_place=True))
+
+    # squared_signal = lowpass_filtered_data * lowpass_filtered_data # TODO: Squaring signal?
+
+    heart_rate = self.fft(filtered_runs, self.hr_min_freq, self.hr_max_freq, ['plots/seismotracker/hr_fft_xaxis.png', 'plots/seismotracker/hr_fft_yaxis.png', 'plots/seismotracker/hr_fft_zaxis.png'], work)
+    logger.info("Heart Rate (bpm): %s", heart_rate)
+    avg_hr = np.mean(heart_rate)
+    logger.info("Average Heart Rate (bpm): %s", avg_hr)
+    if plotting.enabled():
+      lowpass_filtered_data = np.concatenate([run.value for run in filtered_runs])
+      self.plot_hr_graph(lowpass_filtered_data[:,0], "plots/seismotracker/seismotracker_hr_estimate_ax.png")
+      self.plot_hr_graph(lowpass_filtered_data[:,1], "plots/seismotracker/seismotracker_hr_estimate_ay.png")
+      self.plot_hr_graph(lowpass_filtered_data[:,2], "plots/seismotracker/seismotracker_hr_estimate_az.png")
+    return avg_hr, avg_br
+
+  # Returns heart and breathing rates (bpm) over time, estimated in windows of rate_window_duration
+  # every rate_hop_duration, as a DataFrame with the window centre time (s) and the confidence of
+  # each rate (share of the band power in its spectral peak), both averaged over the axes.
+  # Filtering runs once on the whole recording and the spectra of all windows come from one
+  # batched transform. With a signal_quality, the windows holding a sample it rejects have NaN rates.
+  @profiling.stage('seismotracker.estimate_windows')
+  def estimate_windows(self, data):
+    fs = self.sampling_frequency
+    valid = None
+    if self.signal_quality is not None:
+      valid = self.signal_quality.accepted_samples(np.asarray(data), fs, self.br_min_freq, self.hr_max_freq)
+    normalized_data = normalize(np.array(data, dtype=spectral.float_dtype(np.asarray(data).dtype)))
+    filtered_data = butter_pass_filter(normalized_data, self.highpass_cutoff_frequency, fs, 'high', self.filter_order)
+    filtered_data = butter_pass_filter(filtered_data, self.lowpass_cutoff_frequency, fs, 'low', self.filter_order)
+
+    times, br_f, br_amp, br_confidence = spectral.windowed_peaks(normalized_data, fs, self.br_min_freq, self.br_max_freq,
+      self.rate_window_duration, self.rate_hop_duration, resolution=self.frequency_resolution, valid=valid)
+    times, hr_f, hr_amp, hr_confidence = spectral.windowed_peaks(filtered_data, fs, self.hr_min_freq, self.hr_max_freq,
+      self.rate_window_duration, self.rate_hop_duration, resolution=self.frequency_resolution, valid=valid)
+    rates = pd.DataFrame({'time': times, 'heart_rate': 60*np.mean(hr_f, axis=1), 'heart_rate_confidence': np.mean(hr_confidence, axis=1),
+      'breathing_rate': 60*np.mean(br_f, axis=1), 'breathing_rate_confidence': np.mean(br_confidence, axis=1)})
+    if plotting.enabled():
+      plotting.figure('plots/seismotracker/rates.png', [
+        plotting.panel([plotting.series(rates['heart_rate'], x=times)], ylabel='Heart Rate (bpm)'),
+        plotting.panel([plotting.series(rates['breathing_rate'], x=times)], xlabel='Time (s)', ylabel='Breathing Rate (bpm)')])
+    return rates
+
+# Estimator configured by the module level defaults
+def default_estimator():
+  return SeismoTracker(sampling_frequency, highpass_cutoff_frequency, lowpass_cutoff_frequency, hr_min_freq, hr_max_freq, br_min_freq, br_max_freq)
+
+def plot(data, title, plot_save_path):
+  default_estimator().plot(data, title, plot_save_path)
+
+def plot_hr_graph(data, plot_save_path):
+  default_estimator().plot_hr_graph(data, plot_save_path)
+
+def fft(data, f_low, f_high, plot_save_paths, work=None):
+  return default_estimator().fft(data, f_low, f_high, plot_save_paths, work)
 
 def apply_pass_filter(unfiltered_data, btype, cutoff, plot_save_path):
-  t = np.linspace(0, len(unfiltered_data)/sampling_frequency, len(unfiltered_data), endpoint=False)
-  filtered_data = np.full_like(unfiltered_data, 0)
-  axes = {'x': 0, 'y': 1, 'z': 2}
-
-  plt.figure(figsize=(12,8))
-  for axis, index in axes.items():
-    filtered_data[:,index] = butter_pass_filter(unfiltered_data[:,index], cutoff, sampling_frequency, btype, 2)
-
-    plt.subplot(len(axes), 1, index+1)
-    plt.plot(t, unfiltered_data[:,index], 'b-', label="data %s-axis" % axis)
-    plt.plot(t, filtered_data[:,index], 'g-', linewidth=2, label="filtered data %s-axis" % axis)
-    plt.xlabel('Time [sec]')
-    plt.grid()
-    plt.legend()
-    plt.subplots_adjust(hspace=0.35)
-  plt.title("%s pass filtering" % btype)
-  draw_plot(plot_save_path)
-  plt.close()
-  return filtered_data
-
-def seismotracker(data, sampling_freq):
-  global sampling_frequency
-  sampling_frequency = sampling_freq
-
-  plot(data[:,0], 'Unfiltered Raw Accelerometer Data', 'plots/seismotracker/raw_ax.png')
-  normalized_data = normalize(data)
-  print('Breathing Rate:')
-
-  print("X-Axis:")    
-  breathing_rate_x = fft(normalized_data[:,0], br_min_freq, br_max_freq, 'plots/seismotracker/br_fft_xaxis.png')
-  print("Respiration Rate (bpm):", breathing_rate_x)
-
-  print("Y-Axis:")
-  breathing_rate_y = fft(normalized_data[:,1], br_min_freq, br_max_freq, 'plots/seismotracker/br_fft_yaxis.png')
-  print("Respiration Rate (bpm):", breathing_rate_y)
-
-  print("Z-Axis:")    
-  breathing_rate_z = fft(normalized_data[:,2], br_min_freq, br_max_freq, 'plots/seismotracker/br_fft_zaxis.png')
-  print("Respiration Rate (bpm):", breathing_rate_z)
-  avg_br = (breathing_rate_x + breathing_rate_y + breathing_rate_z)/3
-  print("Average Respiration Rate (bpm):", avg_br)
-
-  print('\nHeart Rate:')
-
-  highpass_filtered_data = apply_pass_filter(normalized_data, 'high', highpass_cutoff_frequency, 'plots/seismotracker/hr_highpass_filtering.png')
-  lowpass_filtered_data = apply_pass_filter(highpass_filtered_data, 'low', lowpass_cutoff_frequency, 'plots/seismotracker/hr_lowpass_filtering.png')
-
-  # squared_signal = lowpass_filtered_data * lowpass_filtered_data # TODO: Squaring signal?
-
-  print("X-Axis:")    
-  heart_rate_x = fft(lowpass_filtered_data[:,0], hr_min_freq, hr_max_freq, 'plots/seismotracker/hr_fft_xaxis.png')
-  print("Heart Rate (bpm):", heart_rate_x)
-
-  print("Y-Axis:")    
-  heart_rate_y = fft(lowpass_filtered_data[:,1], hr_min_freq, hr_max_freq, 'plots/seismotracker/hr_fft_xaxis.png')
-  print("Heart Rate (bpm):", heart_rate_y)
-
-  print("Z-Axis:")
-  heart_rate_z = fft(lowpass_filtered_data[:,2], hr_min_freq, hr_max_freq, 'plots/seismotracker/hr_fft_zaxis.png')
-  print("Heart Rate (bpm):", heart_rate_z)
-  avg_hr = (heart_rate_x + heart_rate_y + heart_rate_z)/3
-  print("Average Heart Rate (bpm):", avg_hr)
-  plot_hr_graph(lowpass_filtered_data[:,0], "plots/seismotracker/seismotracker_hr_estimate_ax.png")
-  plot_hr_graph(lowpass_filtered_data[:,1], "plots/seismotracker/seismotracker_hr_estimate_ay.png")
-  plot_hr_graph(lowpass_filtered_data[:,2], "plots/seismotracker/seismotracker_hr_estimate_az.png")
-  return avg_hr, avg_br
+  return default_estimator().apply_pass_filter(unfiltered_data, btype, cutoff, plot_save_path)
+
+def seismotracker(data, sampling_freq, memo=None):
+  return replace(default_estimator(), sampling_frequency=sampling_freq).estimate(data, memo)
+
+def seismotracker_windows(data, sampling_freq, window_seconds=30, hop_seconds=5):
+  return replace(default_estimator(), sampling_frequency=sampling_freq, rate_window_duration=window_seconds,
+    rate_hop_duration=hop_seconds).estimate_windows(data)
 
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
   data = pd.read_csv(input_file_path).values
   print("Number of records:", len(data))
   seismotracker(data, sampling_frequency)
-
-
@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from bio_watch import BioWatch
+from bio_watch_stream import BioWatchStream
+
+# Ingest server for live accelerometer data from many devices. Devices send
+# packets over TCP (a stream of length-prefixed frames) or UDP (one frame per
+# datagram):
+#
+#   frame  = length (uint32) + packet, big endian
+#   packet = device id length (uint16), device id (UTF-8), sampling rate (float32),
+#            send time (float64, seconds since the epoch), sample count n (uint32),
+#            n x (x, y, z) samples (float32)
+#
+# Each device has a bounded buffer. A TCP connection is not read while its
+# device's buffer is full (backpressure), UDP packets that do not fit are
+# dropped and counted. Devices are sharded over single-process worker pools,
+# each keeping the BioWatchStream state of its devices, so the event loop never
+# runs filters or FFTs. Rates are published to subscribers, in process as queues
+# or over TCP as newline-delimited JSON, together with periodic statistics.
+#
+# A TCP frame longer than max_frame_bytes closes its connection before it is
+# read. Devices sending nothing for idle_seconds are forgotten, by the server
+# and by their worker, and start from a new estimator if they come back.
+
+default_port = 7700 # TCP and UDP ingest
+default_subscriber_port = 7701
+buffer_seconds = 30 # per device buffer bound, in seconds of samples
+subscriber_queue_size = 10000
+stats_seconds = 5
+max_frame_bytes = 1 << 20 # about 87000 samples
+min_sampling_rate = 25 # Hz, the BCG band of the estimator ends at 11 Hz
+max_sampling_rate = 1000 # Hz, bounds the buffer and estimator window of a device
+idle_seconds = 300
+
+frame_length = struct.Struct('>I')
+device_id_length = struct.Struct('>H')
+packet_fields = struct.Struct('>fdI')
+sample_dtype = np.dtype('>f4')
+
+logger = logging.getLogger(__name__)
+
+def encode_packet(device, sampling_rate, samples, sent=None):
+  device = device.encode()
+  samples = np.asarray(samples, dtype=sample_dtype).reshape(-1, 3)
+  return (device_id_length.pack(len(device)) + device
+    + packet_fields.pack(sampling_rate, time.time() if sent is None else sent, len(samples)) + samples.tobytes())
+
+def encode_frame(device, sampling_rate, samples, sent=None):
+  packet = encode_packet(device, sampling_rate, samples, sent)
+  return frame_length.pack(len(packet)) + packet
+
+# Returns (device, sampling rate, send time, (n, 3) float64 samples), raises ValueError on a malformed
+# packet or a sampling rate outside [min_sampling_rate, max_sampling_rate]
+def decode_packet(packet):
+  try:
+    (length,) = device_id_length.unpack_from(packet, 0)
+    device = bytes(packet[2:2+length]).decode()
+    sampling_rate, sent, count = packet_fields.unpack_from(packet, 2 + length)
+  except (struct.error, UnicodeDecodeError) as e:
+    raise ValueError('Malformed packet: %s' % e)
+  offset = 2 + length + packet_fields.size
+  if len(packet) - offset != count * 3 * sample_dtype.itemsize:
+    raise ValueError('Malformed packet: %d samples do not match its size' % count)
+  if not (np.isfinite(sampling_rate) and min_sampling_rate <= sampling_rate <= max_sampling_rate):
+    raise ValueError('Malformed packet: sampling rate %s Hz outside [%g, %g] Hz' % (sampling_rate, min_sampling_rate, max_sampling_rate))
+  samples = np.frombuffer(packet, dtype=sample_dtype, count=count * 3, offset=offset).reshape(count, 3)
+  return device, float(sampling_rate), sent, samples.astype(np.float64)
+
+# Worker side: the streaming estimators of the devices of one shard, least recently used first,
+# with the time each was last used
+streams = collections.OrderedDict()
+stream_window_seconds = 30
+stream_hop_seconds = 1
+stream_idle_seconds = idle_seconds
+
+def init_worker(window_seconds, hop_seconds, idle=idle_seconds):
+  global stream_window_seconds, stream_hop_seconds, stream_idle_seconds
+  stream_window_seconds = window_seconds
+  stream_hop_seconds = hop_seconds
+  stream_idle_seconds = idle
+
+# Pushes samples to the device's estimator, returns its new estimates and the CPU time spent.
+# The estimators of devices idle for stream_idle_seconds are dropped.
+def process_samples(device, sampling_rate, samples):
+  start = time.thread_time()
+  now = time.monotonic()
+  stream, _ = streams.pop(device, (None, None))
+  if stream is None or stream.fs != sampling_rate:
+    stream = BioWatchStream(BioWatch(sampling_rate), stream_window_seconds, stream_hop_seconds)
+  while streams and now - next(iter(streams.values()))[1] > stream_idle_seconds:
+    streams.popitem(last=False)
+  streams[device] = (stream, now)
+  estimates = stream.push(samples)
+  return estimates, time.thread_time() - start
+
+class Device:
+  def __init__(self, name, sampling_rate):
+    self.name = name
+    self.sampling_rate = sampling_rate
+    self.capacity = int(buffer_seconds * sampling_rate)
+    self.blocks = collections.deque()
+    self.buffered = 0
+    self.latest_sent = None
+    self.ready = asyncio.Event()
+    self.space = asyncio.Event()
+    self.space.set()
+    self.received = 0
+    self.dropped = 0
+    self.estimates = 0
+    self.task = None
+    self.busy = False # a job of the device is running on its shard
+    self.last_seen = time.monotonic()
+
+class IngestServer:
+  def __init__(self, workers=None, window_seconds=30, hop_seconds=1, max_frame=max_frame_bytes, idle=idle_seconds):
+    workers = workers or os.cpu_count()
+    # one process per shard, so each device's state stays in one process and its blocks stay in order
+    self.shards = [ProcessPoolExecutor(max_workers=1, initializer=init_worker, initargs=(window_seconds, hop_seconds, idle))
+      for _ in range(workers)]
+    self.max_frame = max_frame
+    self.idle = idle
+    self.devices = {}
+    self.expired = collections.Counter() # totals of the forgotten devices
+    self.subscribers = []
+    self.servers = []
+    self.transports = []
+    self.tasks = []
+    self.dropped_messages = 0
+    self.rejected_packets = 0 # malformed, or with a sampling rate out of range
+    self.worker_cpu_seconds = 0.0
+    self.started = time.perf_counter()
+    self.cpu_started = time.process_time()
+
+  def device(self, name, sampling_rate):
+    device = self.devices.get(name)
+    if device is None:
+      device = self.devices[name] = Device(name, sampling_rate)
+      device.task = asyncio.get_running_loop().create_task(self.drain(device))
+    elif device.sampling_rate != sampling_rate:
+      device.sampling_rate = sampling_rate
+      device.capacity = int(buffer_seconds * sampling_rate)
+    return device
+
+  # Buffers the samples if they fit, otherwise counts them as dropped. Returns true if buffered.
+  def offer(self, name, sampling_rate, sent, samples):
+    device = self.device(name, sampling_rate)
+    if device.buffered + len(samples) > device.capacity:
+      device.dropped += len(samples)
+      device.space.clear()
+      return False
+    device.blocks.append(samples)
+    device.buffered += len(samples)
+    device.received += len(samples)
+    device.latest_sent = sent
+    device.last_seen = time.monotonic()
+    device.ready.set()
+    return True
+
+  # Forgets the devices idle for longer than self.idle with nothing buffered or running, keeping their counts
+  def expire(self):
+    now = time.monotonic()
+    for device in [d for d in self.devices.values() if now - d.last_seen > self.idle and not d.blocks and not d.busy]:
+      device.task.cancel()
+      del self.devices[device.name]
+      self.expired.update({'devices': 1, 'received': device.received, 'dropped': device.dropped, 'estimates': device.estimates,
+        'signal_seconds': device.received / device.sampling_rate})
+
+  # Buffers the samples, waiting for space while the device's buffer is full
+  async def put(self, name, sampling_rate, sent, samples):
+    device = self.device(name, sampling_rate)
+    if len(samples) > device.capacity:
+      device.dropped += len(samples)
+      return
+    while device.buffered + len(samples) > device.capacity:
+      device.space.clear()
+      await device.space.wait()
+    self.offer(name, sampling_rate, sent, samples)
+
+  # Hands the buffered samples of a device to its shard, one job at a time
+  async def drain(self, device):
+    loop = asyncio.get_running_loop()
+    shard = self.shards[zlib.crc32(device.name.encode()) % len(self.shards)]
+    while True:
+      await device.ready.wait()
+      device.ready.clear()
+      if not device.blocks:
+        continue
+      samples = np.concatenate(device.blocks)
+      device.blocks.clear()
+      device.buffered = 0
+      device.space.set()
+      sent = device.latest_sent
+      device.busy = True
+      try:
+        estimates, cpu_seconds = await loop.run_in_executor(shard, process_samples, device.name, device.sampling_rate, samples)
+      except Exception as e:
+        logger.warning('Estimation failed for %s: %s', device.name, e)
+        continue
+      finally:
+        device.busy = False
+        device.last_seen = time.monotonic()
+      self.worker_cpu_seconds += cpu_seconds
+      now = time.time()
+      for stream_time, hr, br in estimates:
+        device.estimates += 1
+        self.publish({'type': 'rate', 'device': device.name, 'time': stream_time, 'heart_rate': hr, 'breathing_rate': br,
+          'latency': now - sent})
+
+  def subscribe(self, maxsize=subscriber_queue_size):
+    queue = asyncio.Queue(maxsize)
+    self.subscribers.append(queue)
+    return queue
+
+  def unsubscribe(self, queue):
+    self.subscribers.remove(queue)
+
+  # Slow subscribers lose messages instead of holding up the server
+  def publish(self, message):
+    for queue in self.subscribers:
+      try:
+        queue.put_nowait(message)
+      except asyncio.QueueFull:
+        self.dropped_messages += 1
+
+  # devices_per_core is the number of real time devices one busy core keeps up with: seconds of signal received per CPU second
+  def stats(self):
+    wall = time.perf_counter() - self.started
+    cpu = time.process_time() - self.cpu_started + self.worker_cpu_seconds
+    signal_seconds = self.expired['signal_seconds'] + sum(d.received / d.sampling_rate for d in self.devices.values())
+    return {'type': 'stats', 'devices': len(self.devices), 'expired_devices': self.expired['devices'], 'wall_seconds': wall, 'cpu_seconds': cpu,
+      'received_samples': self.expired['received'] + sum(d.received for d in self.devices.values()),
+      'dropped_samples': self.expired['dropped'] + sum(d.dropped for d in self.devices.values()),
+      'buffered_samples': sum(d.buffered for d in self.devices.values()),
+      'estimates': self.expired['estimates'] + sum(d.estimates for d in self.devices.values()),
+      'dropped_messages': self.dropped_messages, 'rejected_packets': self.rejected_packets,
+      'signal_seconds': signal_seconds, 'devices_per_core': signal_seconds / cpu if cpu > 0 else None}
+
+  async def publish_stats(self, interval):
+    while True:
+      await asyncio.sleep(interval)
+      self.expire()
+      stats = self.stats()
+      self.publish(stats)
+      logger.info('%d devices, %d samples received, %d dropped, %d estimates, %.1f devices per core',
+        stats['devices'], stats['received_samples'], stats['dropped_samples'], stats['estimates'], stats['devices_per_core'] or 0)
+
+  async def handle_ingest(self, reader, writer):
+    try:
+      while True:
+        (length,) = frame_length.unpack(await reader.readexactly(frame_length.size))
+        if length > self.max_frame:
+          logger.warning('Frame of %d bytes over the limit of %d, closing the connection', length, self.max_frame)
+          break
+        try:
+          name, sampling_rate, sent, samples = decode_packet(await reader.readexactly(length))
+        except ValueError as e:
+          self.rejected_packets += 1
+          logger.warning('%s', e)
+          continue
+        await self.put(name, sampling_rate, sent, samples)
+    except (asyncio.IncompleteReadError, ConnectionError):
+      pass
+    finally:
+      writer.close()
+
+  async def handle_subscriber(self, reader, writer):
+    queue = self.subscribe()
+    try:
+      while True:
+        message = await queue.get()
+        writer.write((json.dumps(message) + '\n').encode())
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self.unsubscribe(queue)
+      writer.close()
+
+  async def start(self, host='127.0.0.1', port=default_port, subscriber_port=default_subscriber_port, stats_interval=stats_seconds):
+    loop = asyncio.get_running_loop()
+    self.servers.append(await asyncio.start_server(self.handle_ingest, host, port))
+    self.servers.append(await asyncio.start_server(self.handle_subscriber, host, subscriber_port))
+    transport, _ = await loop.create_datagram_endpoint(lambda: DatagramIngest(self), local_addr=(host, port))
+    self.transports.append(transport)
+    self.tasks.append(loop.create_task(self.publish_stats(stats_interval)))
+    logger.info('Ingesting on %s:%d (TCP and UDP), publishing on %s:%d, %d workers', host, port, host, subscriber_port, len(self.shards))
+
+  async def close(self):
+    for server in self.servers:
+      server.close()
+    for transport in self.transports:
+      transport.close()
+    for task in self.tasks + [d.task for d in self.devices.values()]:
+      task.cancel()
+    for shard in self.shards:
+      shard.shutdown(wait=False, cancel_futures=True)
+
+class DatagramIngest(asyncio.DatagramProtocol):
+  def __init__(self, server):
+    self.server = server
+
+  def datagram_received(self, data, addr):
+    try:
+      (length,) = frame_length.unpack_from(data, 0)
+      name, sampling_rate, sent, samples = decode_packet(memoryview(data)[frame_length.size:frame_length.size+length])
+    except (struct.error, ValueError) as e:
+      self.server.rejected_packets += 1
+      logger.warning('%s', e)
+      return
+    self.server.offer(name, sampling_rate, sent, samples)
+
+async def serve(args):
+  server = IngestServer(args.workers, args.window, args.hop, args.max_frame_bytes, args.idle_seconds)
+  await server.start(args.host, args.port, args.subscriber_port, args.stats_seconds)
+  try:
+    await asyncio.Event().wait()
+  finally:
+    await server.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Ingest accelerometer packets from many devices and publish their live heart and breathing rates.')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=default_port, help='TCP and UDP ingest port')
+  parser.add_argument('--subscriber-port', type=int, default=default_subscriber_port, help='TCP port streaming rates as JSON lines')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='estimation processes, devices are spread over them')
+  parser.add_argument('--window', type=float, default=30, help='seconds of data behind each estimate')
+  parser.add_argument('--hop', type=float, default=1, help='seconds between estimates of a device')
+  parser.add_argument('--stats-seconds', type=float, default=stats_seconds)
+  parser.add_argument('--max-frame-bytes', type=int, default=max_frame_bytes, help='longer TCP frames close their connection')
+  parser.add_argument('--idle-seconds', type=float, default=idle_seconds, help='devices silent this long are forgotten')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', stream=sys.stdout)
+  try:
+    asyncio.run(serve(args))
+  except KeyboardInterrupt:
+    pass
@@ -1,211 +1,302 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import style
-import scipy.fftpack
 import scipy as sp
 from scipy import signal
 import pandas as pd
-import math
+from dataclasses import dataclass, replace
+import logging
+import sys
 import warnings
+import operator
+import tv_filter
+import spectral
+import pipeline
+import plotting
+import profiling
+import quality
+from quality import SignalQuality
 warnings.filterwarnings(action="ignore", module="scipy", message="^internal gelsd")
-style.use('ggplot')
+
+logger = logging.getLogger(__name__)
 
 # Source: https://archive.ics.uci.edu/ml/datasets/MHEALTH+Dataset
 input_file_path = 'datasets/uic_dataset.csv'
 # input_file_path = 'datasets/hmp_dataset1.csv'
 
+# Defaults of the module level functions, SleepMonitor instances carry their own configuration
 sampling_frequency = 50
 segment_window_size = 30
 acceleration_threshold = 10
 percentage_of_allowed_samples_with_motion_in_window = 25
-motionless_sleep_threshold_samples_in_window = (percentage_of_allowed_samples_with_motion_in_window/100)*segment_window_size*sampling_frequency
 tv_filter_lambda = 5
-save_plots = True
-
-def segment(data):
-  size = len(data)
-  print('Segmenting data...')
-  samples_in_window = int(size / (segment_window_size * sampling_frequency))
-  if samples_in_window < 1:
-    samples_in_window = 1
-  segmented_data = np.array_split(data, samples_in_window)
-  print("Number of segments:", len(segmented_data))
-  print("Size of each segment:", len(segmented_data[0]))
-
-  print('Removing segments with motion...')
-  filtered_data = np.array(list(filter(lambda segment: is_valid_segment(segment), segmented_data)))
-  print("Number of filtered segments:", len(filtered_data))
-  flattened_data = np.array([e for sl in filtered_data for e in sl])
-  print("Number of records:", len(flattened_data))
-  return flattened_data
-
-# Returns true if the given segment of data is of motionless acceleration
+br_min_freq = 0.13
+br_max_freq = 0.5
+tv_filter_method = 'direct' # 'direct' (exact, O(N)) or 'mm' (iterative clipping)
+initial_breathing_rate = 30 # bpm, initial guess of the Kalman filter
+
+# Breathing rate estimator. The configuration is immutable and no call modifies the
+# given data, so one instance can be shared between threads.
+@dataclass(frozen=True)
+class SleepMonitor:
+  sampling_frequency: float = 50
+  segment_window_size: float = 30 # seconds
+  acceleration_threshold: float = 10
+  percentage_of_allowed_samples_with_motion_in_window: float = 25
+  tv_filter_lambda: float = 5
+  tv_filter_method: str = 'direct'
+  br_min_freq: float = 0.13
+  br_max_freq: float = 0.5
+  kalman_segment_duration: float = 4 # seconds
+  rate_resolution: float = None # bpm, resolve the spectral peaks of the whole recording this finely instead of the FFT bins of 60 fs/N bpm
+  signal_quality: SignalQuality = None # also reject the windows failing it, in the segment windows, see quality
+
+  # Hz, of rate_resolution
+  @property
+  def frequency_resolution(self):
+    return self.rate_resolution / 60 if self.rate_resolution else None
+
+  @property
+  def motionless_sleep_threshold_samples_in_window(self):
+    return (self.percentage_of_allowed_samples_with_motion_in_window/100)*self.segment_window_size*self.sampling_frequency
+
+  @profiling.stage('sleep_monitor.segment')
+  def segment(self, data, return_windows=False):
+    size = len(data)
+    logger.info('Segmenting data...')
+    starts, ends = self.window_bounds(size)
+    logger.info("Number of segments: %s", len(starts))
+    logger.info("Size of each segment: %s", ends[0] - starts[0])
+
+    logger.info('Removing segments with motion...')
+    kept_windows = self.usable_windows(data)[1]
+    logger.info("Number of filtered segments: %s", len(kept_windows))
+    # a contiguous run of windows is returned as a view
+    segmented_data = quality.select(data, (starts, ends), kept_windows)
+    logger.info("Number of records: %s", len(segmented_data))
+    if return_windows:
+      return segmented_data, kept_windows
+    return segmented_data
+
+  # Returns start and end sample of each window, split the same way as np.array_split
+  def window_bounds(self, size):
+    return quality.window_bounds(size, self.segment_window_size * self.sampling_frequency)
+
+  # Returns the boolean sample mask of motionless windows and the indices of those windows
+  def motionless_windows(self, data):
+    size = len(data)
+    starts, ends = self.window_bounds(size)
+    if size == 0:
+      return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.intp)
+    in_motion = (np.linalg.norm(data[:,0:3], axis=1) > self.acceleration_threshold).astype(np.intp)
+    samples_in_motion = np.add.reduceat(in_motion, starts)
+    valid = samples_in_motion <= self.motionless_sleep_threshold_samples_in_window
+    return np.repeat(valid, ends - starts), np.flatnonzero(valid)
+
+  # Returns the sample mask and the indices of the motionless windows, which also meet the
+  # signal_quality when there is one
+  def usable_windows(self, data):
+    mask, kept_windows = self.motionless_windows(data)
+    if self.signal_quality is None or len(data) == 0:
+      return mask, kept_windows
+    starts, ends = self.window_bounds(len(data))
+    accepted = self.signal_quality.accepted(self.signal_quality.features(data, self.sampling_frequency, self.br_min_freq, self.br_max_freq, (starts, ends)))
+    quality.report(accepted)
+    accepted &= np.isin(np.arange(len(starts)), kept_windows)
+    return np.repeat(accepted, ends - starts), np.flatnonzero(accepted)
+
+  # Returns the time spans in seconds covered by the given windows
+  def window_time_spans(self, size, windows):
+    starts, ends = self.window_bounds(size)
+    return np.column_stack((starts[windows], ends[windows])) / self.sampling_frequency
+
+  # Returns true if the given segment of data is of motionless acceleration
+  def is_valid_segment(self, segment):
+    return np.count_nonzero(np.linalg.norm(segment[:,0:3], axis=1) > self.acceleration_threshold) <= self.motionless_sleep_threshold_samples_in_window
+
+  # Plots the first axis of data or of the value of a pipeline node
+  def plot_ax(self, data, title, plot_save_path):
+    if not plotting.enabled():
+      return
+    plotting.line(plot_save_path, pipeline.source(data).value[:,0], title, 'TIME (s)', 'ACCELERATION Ax (m/s^2)', dx=1/self.sampling_frequency)
+
+  # Preprocess raw accelerometer data, or a pipeline node into a node
+  def preprocess(self, data):
+    logger.info('Denoisifying data...')
+    if isinstance(data, pipeline.Node):
+      return data.then('tv_filter', tv_filter.denoise_axes, self.tv_filter_lambda, self.tv_filter_method, profile='sleep_monitor.preprocess')
+    with profiling.measure('sleep_monitor.preprocess', data):
+      return tv_filter.denoise_axes(data, self.tv_filter_lambda, self.tv_filter_method)
+
+  # Returns the breathing rate (bpm) of each axis, the variance of each axis and the end
+  # time (s) of every Kalman segment. Full segments are a strided view of the data and
+  # are transformed together in one FFT, a shorter last segment is transformed on its own.
+  # Segments keep their FFT bins even with a rate_resolution: a few seconds cannot resolve
+  # breathing finer, and a finer grid only samples the leakage of the drift at the band edge.
+  @profiling.stage('sleep_monitor.kalman_measurements')
+  def kalman_measurements(self, data):
+    segment_size_for_kalman = int(self.kalman_segment_duration * self.sampling_frequency)
+    n_full = len(data) // segment_size_for_kalman
+    rates = np.empty((0, 3))
+    variances = np.empty((0, 3))
+    if n_full > 0:
+      # (segment size, segments, axes) view, no data is copied
+      windows = np.lib.stride_tricks.sliding_window_view(data[:,0:3], segment_size_for_kalman, axis=0)[::segment_size_for_kalman]
+      windows = np.moveaxis(windows, -1, 0)
+      max_amp, max_freq, f, amplitude = self.fft(windows)
+      rates = max_freq * 60
+      variances = np.var(windows, axis=0)
+    tail = data[n_full*segment_size_for_kalman:, 0:3]
+    if len(tail) > 0:
+      max_amp, max_freq, f, amplitude = self.fft(tail)
+      rates = np.vstack((rates, max_freq * 60))
+      variances = np.vstack((variances, np.var(tail, axis=0)))
+    ends = np.minimum(np.arange(1, len(rates) + 1) * segment_size_for_kalman, len(data)) / self.sampling_frequency
+    return rates, variances, ends
+
+  # Apply Kalman filter for multi axis data fusion. With return_trajectory, also returns
+  # the end time (s) of each segment within the given data and the estimate after it.
+  @profiling.stage('sleep_monitor.apply_kalman_filter')
+  def apply_kalman_filter(self, data, return_trajectory=False):
+    logger.info("Performing multi-axis fusion by Kalman filter...")
+    r_measurement, variances, ends = pipeline.source(data).then('kalman_measurements', self.kalman_measurements,
+      depends=(self.sampling_frequency, self.kalman_segment_duration, self.br_min_freq, self.br_max_freq)).value
+    rhat, p = self.kalman_update(r_measurement, variances)
+    logger.info("Breathing rate from Kalman filter: %s", rhat[-1])
+    if return_trajectory:
+      return rhat[-1], ends, rhat[1:]
+    return rhat[-1]
+
+  # Runs the Kalman filter over the measurements of consecutive segments from the estimate initial
+  # and its error p, returns the estimate before and after every segment and the final error
+  def kalman_update(self, r_measurement, variances, initial=initial_breathing_rate, p=1.0):
+    total_variance = variances.sum(axis=1)
+
+    # a flat segment (e.g. a constant run of the TV filter output) or one too short
+    # to resolve the breathing band carries no measurement
+    valid = (total_variance != 0) & ~np.any(np.isnan(r_measurement), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      n_f = variances / total_variance[:,None]
+      z = np.sum(n_f * r_measurement, axis=1)
+      r = np.sqrt(np.sum(np.square(n_f * (r_measurement - z[:,None])), axis=1)) # variance of the measurement noise
+
+    n_segments = len(r_measurement)
+    rhat = np.zeros(n_segments + 1) # a posteri estimate of rr
+    rhat[0] = initial # p is the a posteri error estimate
+    for segment_number in range(n_segments):
+      # time update
+      rhatminus = rhat[segment_number]
+      pminus = p
+      if not valid[segment_number]:
+        rhat[segment_number+1] = rhatminus
+        continue
+
+      # measurement update
+      k = 0.0 # kalman gain
+      if pminus != 0 or r[segment_number] != 0:
+        k = pminus / (pminus + r[segment_number])
+      rhat[segment_number+1] = rhatminus + k * (z[segment_number] - rhatminus)
+      p = (1 - k) * pminus
+
+    return rhat, p
+
+  # Applies Fast Fourier Transform on data from axis x, y, z independently
+  @profiling.stage('sleep_monitor.apply_fft_on_xyz')
+  def apply_fft_on_xyz(self, data, work=None):
+    data = pipeline.source(data)
+    max_amp, max_freq, f, amplitude = self.fft(data, work, self.frequency_resolution)
+    titles = ['FFT of the filtered data X-Axis', 'FFT of the filtered data Y-Axis', 'FFT of the filtered data Z-Axis']
+    plot_save_paths = ['plots/sleep_monitor/fft_ax.png', 'plots/sleep_monitor/fft_ay.png', 'plots/sleep_monitor/fft_az.png']
+    for index, axis in enumerate(['X', 'Y', 'Z']):
+      logger.info('%s-Axis', axis)
+      logger.info('Max Amplitude: %s', max_amp[index])
+      logger.info('Respiratory rate: %s', max_freq[index])
+      logger.info('Respiratory rate (bpm): %s', max_freq[index]*60)
+      if plotting.enabled():
+        plotting.line(plot_save_paths[index], amplitude[:,index] * 1 / len(data.value), titles[index], 'Frequency in Hertz [Hz]', 'Magnitude', x=f)
+    r_x, r_y, r_z = max_freq*60
+    logger.info('Average Respiratory rate (bpm): %s', (r_x+r_y+r_z)/3)
+    return r_x, r_y, r_z
+
+  # Fast fourier transform, returns amplitude and frequency of the breathing peak of each axis
+  # of data or of the value of a pipeline node, resolved to resolution Hz when given
+  @profiling.stage('sleep_monitor.fft')
+  def fft(self, data, work=None, resolution=None):
+    data = pipeline.source(data)
+    return data.then('peak', spectral.peak, self.sampling_frequency, self.br_min_freq, self.br_max_freq, True, work, resolution).value
+
+  # Returns (heart rate, breathing rate) in bpm, heart rate is not estimated and always 0. The given
+  # data (or pipeline node) is not modified. Given a pipeline memo, the stages are shared with the
+  # other estimates of the same recording through it.
+  @profiling.stage('sleep_monitor.estimate')
+  def estimate(self, data, memo=None):
+    source = pipeline.source(data, memo)
+    self.plot_ax(source, 'Raw Accelerometer Data', 'plots/sleep_monitor/raw_ax.png')
+    size = len(source.value)
+    segmented = source.then('segment', self.segment, True, depends=(self.sampling_frequency, self.segment_window_size,
+      self.acceleration_threshold, self.percentage_of_allowed_samples_with_motion_in_window, self.br_min_freq, self.br_max_freq, self.signal_quality))
+    windows = segmented.value[1]
+    if logger.isEnabledFor(logging.INFO):
+      logger.info("Time spans used (s): %s", self.window_time_spans(size, windows).tolist())
+    if (len(windows) == 0):
+      logger.warning('Failed in data preprocessing: no data segments to process')
+      return 0, 0
+    data = self.preprocess(segmented.then('segmented_data', operator.getitem, 0))
+    self.plot_ax(data, 'Processed Accelerometer Data', 'plots/sleep_monitor/processed_data.png')
+
+    logger.info('Converting time domain signal to frequency domain by FFT...')
+    r_x, r_y, r_z = self.apply_fft_on_xyz(data, spectral.work_buffer(len(data.value), data.value.shape[1], data.value.dtype))
+    br = self.apply_kalman_filter(data)
+    return 0, br
+
+# Estimator configured by the module level defaults
+def default_estimator():
+  return SleepMonitor(sampling_frequency, segment_window_size, acceleration_threshold, percentage_of_allowed_samples_with_motion_in_window,
+    tv_filter_lambda, tv_filter_method, br_min_freq, br_max_freq)
+
+def segment(data, return_windows=False):
+  return default_estimator().segment(data, return_windows)
+
+def window_bounds(size):
+  return default_estimator().window_bounds(size)
+
+def motionless_windows(data):
+  return default_estimator().motionless_windows(data)
+
+def window_time_spans(size, windows):
+  return default_estimator().window_time_spans(size, windows)
+
 def is_valid_segment(segment):
-  return len(list(filter(lambda tuple: np.linalg.norm([tuple[0], tuple[1], tuple[2]]) > acceleration_threshold, segment))) <= motionless_sleep_threshold_samples_in_window
+  return default_estimator().is_valid_segment(segment)
 
 def plot_ax(data, title, plot_save_path):
-  x = np.array(data[:,0])
-  N = len(x)
-  y = np.linspace(0, N/sampling_frequency, N)
-  plt.plot(y, x)
-
-  plt.title(title)
-  plt.ylabel('ACCELERATION Ax (m/s^2)')
-  plt.xlabel('TIME (s)')
-  draw_plot(plot_save_path)
-  plt.close()
-
-def draw_plot(plot_save_path):
-  if (save_plots):
-    plt.savefig(plot_save_path)
-  else:
-    plt.draw()
-    plt.pause(5)
-
-# Preprocess raw accelerometer data
+  default_estimator().plot_ax(data, title, plot_save_path)
+
 def preprocess(data):
-  print('Denoisifying data...')
-  data[:,0] = denoisify(data[:,0], tv_filter_lambda, len(data))
-  data[:,1] = denoisify(data[:,1], tv_filter_lambda, len(data))
-  data[:,2] = denoisify(data[:,2], tv_filter_lambda, len(data))
-  return data
-
-def clip(x, b):
-  return np.where(x <= b, x, b * np.sign(x))
-
-# Total variation filter
-def denoisify(y, lambda_value, nit):
-  J = np.zeros((1, nit))
-  N = len(y)
-  z = np.zeros((1, N-1))
-  alpha = 4
-  T = lambda_value / 2
-  for k in range(0, N-1):
-    x = y - np.c_[-z[0][0], -np.diff(z, n=1), z[len(z)-1][len(z)-1]]
-    abs = np.abs(x-y)
-    J[0][k] = np.sum(abs*abs) + lambda_value * np.sum(np.abs(np.diff(x)))
-    z = z + (1/alpha) * np.diff(x)
-    z = np.vectorize(clip)(z, T)
-  return x
-
-# Apply Kalman filter for multi axis data fusion
-def apply_kalman_filter(data):
-  print("Performing multi-axis fusion by Kalman filter...")
-  segment_size_for_kalman = 4 * sampling_frequency
-  n_segments = math.ceil(len(data)/segment_size_for_kalman) +1
-  rhat = np.zeros(n_segments)    # a posteri estimate of rr
-  rhatminus = np.zeros(n_segments) # a priori estimate of rr
-  p = np.zeros(n_segments)  # a posteri error estimate
-  pminus = np.zeros(n_segments)  # a priori error estimate
-  k = np.zeros(n_segments) # kalman gain
-
-  r_measurement = np.zeros((n_segments, 3)) # observation measurements
-
-  # initial guesses
-  p[0] = 1.0
-  rhat[0] = 30
-  for segment_number in range(1, n_segments):
-    segment = get_segment(data, segment_number-1, segment_size_for_kalman)
-    f_x, fft_data_x, max_amp_x, max_index_x = fft(segment[:,0])
-    f_y, fft_data_y, max_amp_y, max_index_y = fft(segment[:,1])
-    f_z, fft_data_z, max_amp_z, max_index_z = fft(segment[:,2])
-    r_measurement[segment_number] = [f_x[max_index_x] * 60, f_y[max_index_y] * 60, f_z[max_index_z] * 60]  
-    variance_x = np.var(segment[:,0])
-    variance_y = np.var(segment[:,1])
-    variance_z = np.var(segment[:,2])
-    total_variance = variance_x + variance_y + variance_z
-
-    # time update
-    rhatminus[segment_number] = rhat[segment_number-1]
-    pminus[segment_number] = p[segment_number-1]
-
-    # measurement update
-    n_f = [variance_x/total_variance, variance_y/total_variance, variance_z/total_variance]
-    z = (n_f[0] * r_measurement[segment_number][0]) + (n_f[1] * r_measurement[segment_number][1]) + (n_f[2] * r_measurement[segment_number][2])
-    r = np.sqrt(np.sum(list(map(lambda index: np.square(n_f[index] * (r_measurement[segment_number][index] - z)), [0, 1, 2])))) # variance of the measurement noise
-    if (pminus[segment_number]!=0 or r != 0):
-      k[segment_number] = pminus[segment_number] /(pminus[segment_number] + r)
-
-    rhat[segment_number] = rhatminus[segment_number] + k[segment_number] * (z - rhatminus[segment_number]) 
-    p[segment_number] = (1 - k[segment_number]) * pminus[segment_number]
-
-  print("Breathing rate from Kalman filter:", rhat[n_segments-1])
-  return rhat[n_segments-1]
+  return default_estimator().preprocess(data)
+
+# Total variation filter, nit and tol bound the iterations of the 'mm' method
+def denoisify(y, lambda_value, nit=tv_filter.default_max_iterations, tol=tv_filter.default_tolerance, *, method='direct'):
+  return tv_filter.denoise(y, lambda_value, method, nit, tol)
+
+def kalman_measurements(data):
+  return default_estimator().kalman_measurements(data)
+
+def apply_kalman_filter(data, return_trajectory=False):
+  return default_estimator().apply_kalman_filter(data, return_trajectory)
 
 def get_segment(data, segment_number, segment_size):
   return data[segment_number*segment_size: segment_number*segment_size+segment_size]
 
-# Applies Fast Fourier Transform on data from axis x, y, z independently
-def apply_fft_on_xyz(data):
-  print('X-Axis')
-  r_x = apply_fft(data[:,0], 'FFT of the filtered data X-Axis', 'plots/sleep_monitor/fft_ax.png')
-  print('Y-Axis')
-  r_y = apply_fft(data[:,1], 'FFT of the filtered data Y-Axis', 'plots/sleep_monitor/fft_ay.png')
-  print('Z-Axis')
-  r_z = apply_fft(data[:,2], 'FFT of the filtered data Z-Axis', 'plots/sleep_monitor/fft_az.png')
-  print('Average Respiratory rate (bpm):', (r_x+r_y+r_z)/3)
-  return r_x, r_y, r_z
-
-def fft(data):
-  data = data - data.mean()
-  N = len(data)
-  data = sp.signal.detrend(data)  
-  fft_data = sp.fftpack.fft(data)
-  f = np.linspace(0, N/sampling_frequency, N)
-
-  max_amp = 0
-  max_index = 0
-  index = 0
-  for c in fft_data[:N // 2]:
-    if f[index] < 0.13 or f[index] > 0.5:
-      index = index + 1
-      continue;
-
-    real = np.real(c)
-    img = np.imag(c)
-    amp = np.sqrt(real*real + img*img)
-    if max_amp < amp:
-      max_amp = amp
-      max_index = index
-    index = index+1
-  return f, fft_data, max_amp, max_index
-
-# Fast fourier transform
-def apply_fft(acc_data, title, plot_save_path):
-  N = len(acc_data)
-  f, fft_data, max_amp, max_index = fft(acc_data)
-
-  print('Max Amplitude:', max_amp)
-  print('Respiratory rate:',f[max_index])
-  print('Respiratory rate (bpm):',f[max_index]*60)
-
-  plt.plot(f[:N // 2], np.abs(fft_data)[:N // 2] * 1 / N)
-  plt.xlabel('Frequency in Hertz [Hz]')
-  plt.ylabel('Magnitude')
-  plt.title(title)
-  draw_plot(plot_save_path)
-  plt.close()
-  return f[max_index]*60
-
-def sleep_monitor(data, sampling_freq):
-  global sampling_frequency
-  sampling_frequency = sampling_freq
-
-  plot_ax(data, 'Raw Accelerometer Data', 'plots/sleep_monitor/raw_ax.png')
-  data = segment(data)
-  if (len(data) == 0):
-    print('Failed in data preprocessing: no data segments to process')
-    return 0, 0
-  data = preprocess(data)
-  plot_ax(data, 'Processed Accelerometer Data', 'plots/sleep_monitor/processed_data.png')
-
-  print('Converting time domain signal to frequency domain by FFT...')
-  r_x, r_y, r_z = apply_fft_on_xyz(data)
-  br = apply_kalman_filter(data)
-  return 0, br
+def apply_fft_on_xyz(data, work=None):
+  return default_estimator().apply_fft_on_xyz(data, work)
+
+def fft(data, work=None):
+  return default_estimator().fft(data, work)
+
+def sleep_monitor(data, sampling_freq, memo=None):
+  return replace(default_estimator(), sampling_frequency=sampling_freq).estimate(data, memo)
 
 if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
   data = pd.read_csv(input_file_path).values
   print("Number of records:", len(data))
   sleep_monitor(data, sampling_frequency)
-
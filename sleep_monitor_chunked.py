@@ -0,0 +1,174 @@
+import argparse
+import logging
+import sys
+import time
+import tracemalloc
+from dataclasses import replace
+import numpy as np
+
+import ingest
+import plotting
+import spectral
+import tv_filter
+from sleep_monitor import SleepMonitor, initial_breathing_rate
+
+logger = logging.getLogger(__name__)
+
+# Out-of-core version of the SleepMonitor estimator, for recordings of a whole
+# night. Samples are pushed in chunks of any size and every stage runs on blocks
+# of block_seconds of kept samples, so memory is bounded by the block size and not
+# by the recording length:
+#
+# - motion rejection on each full window of segment_window_size seconds
+# - TV denoising resumed from block to block (tv_filter.StreamingDenoiser), which
+#   gives the solution of the whole signal unless it stays open for over a block
+# - the whole-recording spectrum of each axis, accumulated block by block
+#   (spectral.BandDFT) on a grid of resolution_bpm
+# - the Kalman filter, its estimate and error carried from block to block, a
+#   Kalman segment split between two blocks is completed by the next one
+#
+# The windows are exactly segment_window_size seconds, where SleepMonitor.estimate
+# spreads the remainder of the recording over all windows, and a last partial
+# window is checked on its own.
+
+input_file_path = 'datasets/uic_dataset.csv'
+default_block_seconds = 1800
+default_resolution_bpm = 0.1
+
+class SleepMonitorChunked:
+  def __init__(self, estimator=None, block_seconds=default_block_seconds, resolution_bpm=default_resolution_bpm):
+    self.estimator = estimator or SleepMonitor()
+    e = self.estimator
+    if e.tv_filter_method != 'direct':
+      raise ValueError("Chunked processing needs the direct TV filter, not '%s'" % e.tv_filter_method)
+    fs = e.sampling_frequency
+    self.fs = fs
+    self.window = max(int(e.segment_window_size * fs), 1)
+    # blocks are whole windows
+    self.block = max(int(round(block_seconds * fs / self.window)), 1) * self.window
+    self.segment_size = int(e.kalman_segment_duration * fs)
+
+    self.raw = np.zeros((0, 3)) # samples of the current window
+    self.kept = np.zeros((0, 3)) # kept samples not yet denoised
+    self.remainder = np.zeros((0, 3)) # denoised samples of an incomplete Kalman segment
+    # the TV solution is left open at most a block, then settled as if the signal ended
+    self.denoiser = tv_filter.StreamingDenoiser(e.tv_filter_lambda, 3, self.block)
+    self.spectrum = spectral.BandDFT(fs, e.br_min_freq, e.br_max_freq,
+      resolution_bpm / 60, 3, detrend=True)
+    self.rhat = initial_breathing_rate # Kalman estimate (bpm)
+    self.p = 1.0 # and its error
+    self.samples = 0
+    self.kept_samples = 0
+    self.windows = 0
+    self.kept_windows = 0
+
+  # Adds samples, processing every block of kept samples they complete
+  def push(self, samples):
+    samples = np.asarray(samples)[:,0:3]
+    self.samples += len(samples)
+    self.raw = np.concatenate((self.raw, samples))
+    full = len(self.raw) // self.window * self.window
+    if full > 0:
+      self.keep(self.raw[:full])
+      self.raw = self.raw[full:]
+    while len(self.kept) >= self.block:
+      self.process(self.block)
+
+  # Motion and signal quality rejection of whole windows, the full scale of the signal quality
+  # defaults to the extremes of the samples given
+  def keep(self, data):
+    mask, kept_windows = self.estimator.usable_windows(data)
+    self.windows += len(self.estimator.window_bounds(len(data))[0])
+    self.kept_windows += len(kept_windows)
+    if len(kept_windows) > 0:
+      self.kept = np.concatenate((self.kept, data[mask]))
+      self.kept_samples += np.count_nonzero(mask)
+
+  # Denoises the first size kept samples
+  def process(self, size):
+    block = self.kept[:size]
+    self.kept = self.kept[size:]
+    self.analyse(self.denoiser.add(block), final=False)
+
+  # Hands denoised samples to the spectrum and the Kalman filter
+  def analyse(self, denoised, final):
+    self.spectrum.add(denoised)
+    self.update_kalman(np.concatenate((self.remainder, denoised)), final)
+
+  # Runs the Kalman filter over the full segments of data, keeps the rest for the next block
+  def update_kalman(self, data, final):
+    end = len(data) if final else len(data) // self.segment_size * self.segment_size
+    if end > 0:
+      r_measurement, variances, ends = self.estimator.kalman_measurements(data[:end])
+      rhat, self.p = self.estimator.kalman_update(r_measurement, variances, self.rhat, self.p)
+      self.rhat = rhat[-1]
+    self.remainder = data[end:]
+
+  # Processes the samples left and returns (heart rate, breathing rate) in bpm like
+  # SleepMonitor.estimate, heart rate is not estimated and always 0
+  def finish(self):
+    if len(self.raw) > 0:
+      self.keep(self.raw)
+      self.raw = self.raw[:0]
+    logger.info('Number of segments: %d, of which %d without motion', self.windows, self.kept_windows)
+    if self.kept_samples == 0:
+      logger.warning('Failed in data preprocessing: no data segments to process')
+      return 0, 0
+    if len(self.kept) > 0:
+      self.process(len(self.kept))
+    self.analyse(self.denoiser.finish(), final=True)
+
+    f, amplitude = self.spectrum.amplitude()
+    max_amp, max_freq = spectral.find_peak(f, amplitude, self.estimator.br_min_freq, self.estimator.br_max_freq)
+    for index, axis in enumerate(['X', 'Y', 'Z']):
+      logger.info('%s-Axis respiratory rate (bpm): %s', axis, max_freq[index]*60)
+    logger.info("Breathing rate from Kalman filter: %s", self.rhat)
+    return 0, self.rhat
+
+# Estimates a recording read block by block from the ingest cache
+def estimate_file(path, sampling_rate=None, dtype=np.float64, block_seconds=default_block_seconds, estimator=None):
+  metadata = ingest.ingest(path, sampling_rate, dtype)
+  fs = metadata['sampling_rate'] or (estimator or SleepMonitor()).sampling_frequency
+  estimator = replace(estimator or SleepMonitor(), sampling_frequency=fs)
+  chunked = SleepMonitorChunked(estimator, block_seconds)
+  for chunk in ingest.iter_chunks(path, chunked.block, fs, dtype):
+    chunked.push(chunk)
+  return chunked.finish()
+
+# Runs the chunked estimator on a recording, optionally next to the whole-recording one,
+# with the time of each and, in a second run, its peak traced memory
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Estimate the breathing rate of a long recording block by block with bounded memory.')
+  parser.add_argument('path', nargs='?', default=input_file_path)
+  parser.add_argument('--sampling-rate', type=float, help='sampling rate (Hz), the one stored with the ingest cache by default')
+  parser.add_argument('--block-minutes', type=float, default=default_block_seconds / 60)
+  parser.add_argument('--compare', action='store_true', help='also run SleepMonitor.estimate on the whole recording')
+  parser.add_argument('--no-memory', action='store_true', help='skip the traced run measuring peak memory, which is much slower')
+  parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+  args = parser.parse_args()
+  logging.basicConfig(level=args.log_level, format='%(message)s', stream=sys.stdout)
+  plotting.set_mode('headless')
+
+  # tracemalloc slows the TV filter, which works on python floats, so runs are timed untraced
+  def measured(function):
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    if args.no_memory:
+      return result, seconds, ''
+    tracemalloc.start()
+    try:
+      function()
+      return result, seconds, ', peak %.1f MB' % (tracemalloc.get_traced_memory()[1] / 1e6)
+    finally:
+      tracemalloc.stop()
+
+  (hr, br), seconds, peak = measured(lambda: estimate_file(args.path, args.sampling_rate, block_seconds=args.block_minutes * 60))
+  print("Chunked BR: %.2f bpm (%.2f s%s)" % (br, seconds, peak))
+  if args.compare:
+    def whole():
+      data, metadata = ingest.load(args.path, args.sampling_rate)
+      fs = metadata['sampling_rate'] or SleepMonitor().sampling_frequency
+      return SleepMonitor(fs).estimate(np.asarray(data))
+    (hr, br), seconds, peak = measured(whole)
+    print("Whole BR:   %.2f bpm (%.2f s%s)" % (br, seconds, peak))
@@ -1,8 +1,21 @@
+import argparse
+import logging
+import sys
+import time
+from dataclasses import fields, replace
+import numpy as np
 import pandas as pd
 
-from sleep_monitor import sleep_monitor
-from bio_watch import bio_watch
-from seismotracker import seismotracker
+import ingest
+import pipeline
+import plotting
+import profiling
+import result_store
+from quality import SignalQuality
+
+from sleep_monitor import sleep_monitor, default_estimator as sleep_monitor_estimator
+from bio_watch import bio_watch, default_estimator as bio_watch_estimator
+from seismotracker import seismotracker, default_estimator as seismotracker_estimator
 
 # Source: https://archive.ics.uci.edu/ml/datasets/MHEALTH+Dataset
 # Source: https://archive.ics.uci.edu/ml/datasets/Dataset+for+ADL+Recognition+with+Wrist-worn+Accelerometer
@@ -10,28 +23,104 @@ input_dataset_csv = {'datasets/uic_dataset.csv': 50, 'datasets/hmp_dataset1.csv'
 
 algorithms = {'Bio Watch': bio_watch, 'Sleep Monitor': sleep_monitor, 'SeismoTracker': seismotracker}
 measurements = ['Heart Rate(bpm)', 'Breathing Rate(bpm)']
+default_estimators = {'Bio Watch': bio_watch_estimator, 'Sleep Monitor': sleep_monitor_estimator, 'SeismoTracker': seismotracker_estimator}
+
+# Estimator an algorithm runs with at a sampling rate, as its function in algorithms does, gated by
+# the given signal quality
+def estimator(algorithm, sampling_freq, signal_quality=None):
+  return replace(default_estimators[algorithm](), sampling_frequency=sampling_freq, signal_quality=signal_quality)
+
+# Key of the stored rates of an algorithm on a recording
+def result_key(store, source_sha256, dtype, algorithm, sampling_freq, signal_quality=None):
+  return store.result_key(source_sha256, dtype, algorithm, estimator(algorithm, sampling_freq, signal_quality), algorithms[algorithm].__module__)
 
 if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Estimate heart and breathing rates on the bundled datasets.')
+  parser.add_argument('--plots', choices=plotting.plot_modes, default='save', help="'headless' skips plotting entirely (default: save)")
+  parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', help='level of the diagnostic output of the algorithms')
+  parser.add_argument('--profile', metavar='PATH', help='record the time of every stage and write them as trace events (chrome://tracing, Perfetto)')
+  parser.add_argument('--profile-memory', action='store_true', help='also trace the bytes allocated by every stage, slows the run down')
+  parser.add_argument('--float32', action='store_true', help='load and process the recordings in single precision, halving memory')
+  parser.add_argument('--memo-mb', type=float, default=pipeline.default_max_bytes / 1e6,
+    help='memory of the preprocessing stages shared between the algorithms of a recording, 0 to share nothing')
+  parser.add_argument('--cache-dir', default=result_store.store_dir, help='directory of the stored rates and intermediate signals')
+  parser.add_argument('--cache-mb', type=float, default=result_store.default_budget_bytes / 1e6,
+    help='disk budget of the stored intermediate signals, 0 to store nothing and recompute everything')
+  parser.add_argument('--force', action='store_true', help='recompute every rate and intermediate signal, and store them again')
+  parser.add_argument('--dry-run', action='store_true', help='only list the (dataset, algorithm) pairs that would be recomputed')
+  parser.add_argument('--quality-gate', action='store_true',
+    help='estimate only the windows of sufficient signal quality (motion, saturation, band power), see quality.py')
+  args = parser.parse_args()
+  plotting.set_mode(args.plots)
+  logging.basicConfig(level=args.log_level, format='%(message)s', stream=sys.stdout)
+  if args.profile:
+    profiling.enable(memory=args.profile_memory)
+
+  dtype = np.float32 if args.float32 else np.float64
+  signal_quality = SignalQuality() if args.quality_gate else None
+  store = result_store.ResultStore(args.cache_dir, args.cache_mb * 1e6,
+    {f.name for make in default_estimators.values() for f in fields(make())}, refresh=args.force) if args.cache_mb > 0 else None
+
+  if args.dry_run:
+    for dataset, sampling_freq in sorted(input_dataset_csv.items()):
+      source_sha256 = result_store.source_hash(dataset, dtype)
+      for algo in sorted(algorithms):
+        stored = store is not None and store.result(result_key(store, source_sha256, dtype, algo, sampling_freq, signal_quality)) is not None
+        print("%-10s %s, %s" % ('stored' if stored else 'recompute', dataset, algo))
+    raise SystemExit(0)
+
   count = 1
   results = {}
+  timings = {}
+  memo_stats = {}
 
   for dataset, sampling_freq in sorted(input_dataset_csv.items()):
-    data = pd.read_csv(dataset).values
+    start = time.perf_counter()
+    data, metadata = ingest.load(dataset, sampling_freq, dtype)
     print('\nDataset %d: %s\n========='% (count, dataset))
     print("Number of records:", len(data))
 
     count = count + 1
     rates = []
-    
-    for algo, algo_fn in sorted(algorithms.items()):
+    # the algorithms never modify their input, they read the memory mapped cache directly, and
+    # share their common stages (normalization, ...) through the memo, whose filtered and
+    # denoised signals are also kept in the store
+    memo = pipeline.Memo(args.memo_mb * 1e6, store) if args.memo_mb > 0 else None
+    source = pipeline.source(data, memo)
+
+    for algo in sorted(algorithms):
       print('\n%s:\n' % algo)
-      hr, br = algo_fn(data.copy(), sampling_freq)
+      key = result_key(store, metadata['sha256'], dtype, algo, sampling_freq, signal_quality) if store is not None else None
+      stored = store.result(key) if store is not None else None
+      if stored is not None:
+        hr, br = stored['heart_rate'], stored['breathing_rate']
+        print("Stored result, computed in %.3f s" % stored['seconds'])
+      else:
+        algo_start = time.perf_counter()
+        hr, br = estimator(algo, sampling_freq, signal_quality).estimate(source)
+        if store is not None:
+          store.save_result(key, {'dataset': dataset, 'algorithm': algo, 'heart_rate': float(hr), 'breathing_rate': float(br),
+            'seconds': time.perf_counter() - algo_start})
       rates.append([hr, br])
     res = pd.DataFrame(rates, sorted(algorithms.keys()), measurements)
     results[dataset] = res
+    timings[dataset] = time.perf_counter() - start
+    if memo is not None:
+      memo_stats[dataset] = memo.stats()
     print(res)
 
   print('\nFinal Results\n=============')
   for ds, result in sorted(results.items()):
-    print("\nDataset: %s\n%s" %(ds, result))
+    print("\nDataset: %s (%.3f s)\n%s" %(ds, timings[ds], result))
+    if ds in memo_stats:
+      print("Shared stages: %(hits)d hits, %(misses)d misses" % memo_stats[ds])
+  if store is not None:
+    stats = store.stats()
+    print("\nStore %s: %d results, %d intermediate signals (%.1f of %.1f MB), %d read back" % (
+      args.cache_dir, stats['results'], stats['artifacts'], stats['artifact_bytes'] / 1e6, stats['budget_bytes'] / 1e6, stats['artifact_hits']))
+  plotting.flush()
+  if args.profile:
+    profiling.disable()
+    profiling.export_trace(args.profile)
+    print('\nStages\n======\n%s' % profiling.format_summary())
 
@@ -0,0 +1,345 @@
+import functools
+import time
+import tracemalloc
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+# Shared spectral peak search used by all three algorithms.
+# Works on a single axis of shape (N,) or on several axes at once (N, axes):
+# transforms run along axis 0 with a real FFT padded to a fast length.
+#
+# Given a resolution, the search instead evaluates the spectrum only on a grid
+# of that spacing over the band (band_spectrum): directly, as Goertzel would,
+# for a few bins, otherwise with a zoom FFT (chirp-z transform). Rates are then
+# resolved finer than the fs/N bins of the FFT without transforming the whole
+# zero-padded spectrum. Long data, whose FFT needs little padding to reach the
+# resolution, is still transformed whole (band_limited decides).
+
+direct_max_bins = 32 # bands of at most this many bins are evaluated directly
+direct_max_values = 1 << 20 # bins x samples of the direct evaluation, 16 MB of complex basis
+zoom_padding_ratio = 3 # the zoom FFT runs when the padded FFT would be this much longer than the data and band
+zoom_cache_size = 64
+band_dft_piece_rows = 1 << 16 # samples BandDFT transforms at once
+
+def fast_length(n):
+  return scipy.fft.next_fast_len(n, real=True)
+
+# FFT length of n samples, zero padded to bins of resolution Hz or finer when given
+def padded_length(n, fs, resolution=None):
+  return fast_length(max(n, int(np.ceil(fs / resolution)) if resolution else n, 1))
+
+# Floating type the algorithms work in: float32 stays float32, anything else becomes float64
+def float_dtype(dtype):
+  return np.result_type(dtype, np.float32)
+
+# Returns a flat work buffer large enough for spectrum() of n samples of the given number of columns
+def work_buffer(n, columns, dtype=np.float64):
+  return np.empty(fast_length(max(n, 1)) * columns, dtype=float_dtype(dtype))
+
+# Returns a shape view of the start of the flat work buffer, or a new array when the buffer is
+# missing, too small or of another type. Its content is undefined.
+def scratch(work, shape, dtype):
+  size = int(np.prod(shape))
+  if work is None or work.dtype != dtype or work.size < size:
+    return np.empty(shape, dtype=dtype)
+  return work[:size].reshape(shape)
+
+# Returns the frequency axis and amplitude spectrum of the given data, which is not modified.
+# The (detrended) copy is zero padded in the work buffer when one is given, and padded up to
+# bins of resolution Hz or finer when given, and to length samples or more when given.
+def spectrum(data, fs, detrend=False, work=None, resolution=None, length=None):
+  data = np.asarray(data)
+  dtype = float_dtype(data.dtype)
+  n = len(data)
+  n_fft = padded_length(max(n, length or 0), fs, resolution)
+  f = scipy.fft.rfftfreq(n_fft, 1/fs)
+  if n > 0:
+    padded = scratch(work, (n_fft,) + data.shape[1:], dtype)
+    padded[n:] = 0
+    if detrend:
+      detrend_into(data, padded[:n])
+    else:
+      padded[:n] = data
+    transform = scipy.fft.rfft(padded, axis=0, overwrite_x=True)
+  else:
+    transform = scipy.fft.rfft(data.astype(dtype, copy=False), n=n_fft, axis=0)
+  return f, np.abs(transform)
+
+# Writes the data minus its least squares line along axis 0 into out
+def detrend_into(data, out):
+  n = len(data)
+  # least squares line over t = 0..n-1, centred so slope and mean are independent
+  t = np.arange(n, dtype=out.dtype) - (n - 1) / 2
+  mean = data.mean(axis=0, dtype=out.dtype)
+  slope = np.tensordot(t, data, axes=(0, 0)) / max(np.dot(t, t), 1)
+  np.subtract(data, mean, out=out, dtype=out.dtype)
+  out -= np.expand_dims(t, tuple(range(1, data.ndim))) * slope
+  return out
+
+# True when evaluating only the band at the given resolution is cheaper than a zero-padded FFT of it
+def band_limited(n, fs, f_low, f_high, resolution):
+  bins = len(band_frequencies(f_low, f_high, resolution))
+  if bins <= direct_max_bins and bins * n <= direct_max_values:
+    return True
+  return padded_length(n, fs, resolution) > zoom_padding_ratio * (n + bins)
+
+# Frequencies f_low, f_low + resolution, ... up to f_high
+def band_frequencies(f_low, f_high, resolution):
+  bins = int(np.floor((f_high - f_low) / resolution + 1e-9)) + 1
+  return f_low + resolution * np.arange(max(bins, 0))
+
+@functools.lru_cache(maxsize=zoom_cache_size)
+def cached_zoom(n, f_low, f_last, bins, fs):
+  return scipy.signal.ZoomFFT(n, (f_low, f_last), bins, fs=fs, endpoint=True)
+
+# Returns the frequency grid of the given resolution over [f_low, f_high] and the amplitude
+# spectrum of the data on it, on the scale of spectrum(). The data is not modified, its
+# detrended copy goes to the work buffer when one is given.
+def band_spectrum(data, fs, f_low, f_high, resolution, detrend=False, work=None):
+  data = np.asarray(data)
+  dtype = float_dtype(data.dtype)
+  n = len(data)
+  f = band_frequencies(f_low, f_high, resolution)
+  if n == 0 or len(f) == 0:
+    return f, np.zeros((len(f),) + data.shape[1:], dtype=dtype)
+  x = detrend_into(data, scratch(work, data.shape, dtype)) if detrend else data.astype(dtype, copy=False)
+  return f, np.abs(band_transform(x, fs, f)).astype(dtype, copy=False)
+
+# Complex DFT of the data along axis 0 at the frequencies f, an evenly spaced grid
+def band_transform(x, fs, f):
+  n = len(x)
+  if len(f) <= direct_max_bins and len(f) * n <= direct_max_values:
+    # one correlation with a complex exponential per bin, what Goertzel's recurrence computes
+    basis = np.exp(-2j * np.pi * np.outer(f, np.arange(n)) / fs)
+    return np.tensordot(basis, x, axes=(1, 0))
+  if len(f) == 1:
+    return np.tensordot(np.exp(-2j * np.pi * f[0] * np.arange(n) / fs), x, axes=(0, 0))[None]
+  return cached_zoom(n, float(f[0]), float(f[-1]), len(f), float(fs))(x, axis=0)
+
+# Band spectrum of a recording given block by block, without keeping it: every block's DFT
+# on the grid is shifted to its position and summed, together with the DFT of a constant and
+# of a ramp and the sums fitting the least squares line, so that amplitude() equals
+# band_spectrum() of the whole recording. Samples are transformed in pieces of piece_rows, and
+# the rest once by amplitude(), so one cached zoom FFT serves blocks of any length.
+class BandDFT:
+  def __init__(self, fs, f_low, f_high, resolution, axes, detrend=False, piece_rows=band_dft_piece_rows):
+    self.fs = fs
+    self.detrend = detrend
+    self.piece_rows = piece_rows
+    self.pending = np.zeros((0, axes)) # samples not transformed yet
+    self.f = band_frequencies(f_low, f_high, resolution)
+    self.transform = np.zeros((len(self.f), axes), dtype=np.complex128)
+    self.ones_dft = np.zeros(len(self.f), dtype=np.complex128)
+    self.ramp_dft = np.zeros(len(self.f), dtype=np.complex128)
+    self.n = 0
+    self.sum = np.zeros(axes) # sum of the samples
+    self.weighted_sum = np.zeros(axes) # sum of the samples weighted by their index
+
+  def add(self, block):
+    self.pending = np.concatenate((self.pending, np.asarray(block, dtype=np.float64)))
+    while len(self.pending) >= self.piece_rows:
+      self.transform_piece(self.pending[:self.piece_rows])
+      self.pending = self.pending[self.piece_rows:]
+
+  def transform_piece(self, block):
+    n = len(block)
+    if n == 0 or len(self.f) == 0:
+      return
+    index = np.arange(n, dtype=np.float64)
+    local = band_transform(np.column_stack((block, np.ones(n), index)), self.fs, self.f)
+    shift = np.exp(-2j * np.pi * self.f * self.n / self.fs)
+    axes = block.shape[1]
+    self.transform += shift[:,None] * local[:,:axes]
+    self.ones_dft += shift * local[:,axes]
+    self.ramp_dft += shift * (self.n * local[:,axes] + local[:,axes+1])
+    self.sum += block.sum(axis=0)
+    self.weighted_sum += (self.n + index) @ block
+    self.n += n
+
+  # Returns the frequency grid and the amplitude spectrum of the samples added so far
+  def amplitude(self):
+    self.transform_piece(self.pending)
+    self.pending = self.pending[:0]
+    transform = self.transform
+    if self.detrend and self.n > 0:
+      # line mean + slope * (k - (n - 1) / 2), as detrend_into fits it
+      n = self.n
+      mean = self.sum / n
+      slope = (self.weighted_sum - (n - 1) / 2 * self.sum) / max(n * (n * n - 1) / 12, 1)
+      transform = transform - np.outer(self.ones_dft, mean - slope * (n - 1) / 2) - np.outer(self.ramp_dft, slope)
+    return self.f, np.abs(transform)
+
+# Returns amplitude and frequency of the highest peak within [f_low, f_high],
+# refined to sub-bin accuracy by fitting a parabola through the peak bin and
+# its two neighbours. A band holding no bins (data too short) gives NaN.
+def find_peak(f, amplitude, f_low, f_high):
+  amplitude = np.asarray(amplitude)
+  in_band = np.flatnonzero((f >= f_low) & (f <= f_high))
+  axes_shape = amplitude.shape[1:]
+  if len(in_band) == 0:
+    return np.full(axes_shape, np.nan), np.full(axes_shape, np.nan)
+
+  peak = in_band[0] + np.argmax(amplitude[in_band], axis=0)
+  peak_amp = np.take_along_axis(amplitude, np.expand_dims(peak, 0), axis=0)[0]
+
+  left = np.take_along_axis(amplitude, np.expand_dims(np.maximum(peak - 1, 0), 0), axis=0)[0]
+  right = np.take_along_axis(amplitude, np.expand_dims(np.minimum(peak + 1, len(f) - 1), 0), axis=0)[0]
+  curvature = left - 2 * peak_amp + right
+  interior = (peak > 0) & (peak < len(f) - 1) & (curvature < 0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    offset = np.where(interior, 0.5 * (left - right) / curvature, 0.0)
+  offset = np.clip(offset, -0.5, 0.5)
+
+  bin_width = f[1] - f[0] if len(f) > 1 else 0.0
+  peak_freq = f[peak] + offset * bin_width
+  peak_amp = peak_amp - 0.25 * (left - right) * offset
+  return peak_amp, peak_freq
+
+# Returns (amplitude, frequency, f, spectrum) of the spectral peak in [f_low, f_high], from
+# the FFT bins, or from a spectrum resolving resolution Hz when given
+def peak(data, fs, f_low, f_high, detrend=False, work=None, resolution=None):
+  if resolution and band_limited(len(data), fs, f_low, f_high, resolution):
+    f, amplitude = band_spectrum(data, fs, f_low, f_high, resolution, detrend, work)
+  else:
+    f, amplitude = spectrum(data, fs, detrend, work, resolution)
+  peak_amp, peak_freq = find_peak(f, amplitude, f_low, f_high)
+  return peak_amp, peak_freq, f, amplitude
+
+# peak() of the runs of a recording, a sequence of arrays such as the runs of accepted windows
+# (see quality). The spectrum is the root of the power summed over the spectra of every run,
+# each padded to the FFT length of the longest one or on the band grid of the resolution. Unlike
+# the spectrum of the runs joined end to end, it holds no power of the joins. One run gives peak().
+def runs_peak(runs, fs, f_low, f_high, detrend=False, work=None, resolution=None):
+  if len(runs) == 1:
+    return peak(runs[0], fs, f_low, f_high, detrend, work, resolution)
+  length = max(len(run) for run in runs)
+  band = resolution and band_limited(length, fs, f_low, f_high, resolution)
+  power = 0
+  for run in runs:
+    if band:
+      f, amplitude = band_spectrum(run, fs, f_low, f_high, resolution, detrend, work)
+    else:
+      f, amplitude = spectrum(run, fs, detrend, work, resolution, length)
+    power = power + np.square(amplitude)
+  amplitude = np.sqrt(power)
+  peak_amp, peak_freq = find_peak(f, amplitude, f_low, f_high)
+  return peak_amp, peak_freq, f, amplitude
+
+max_block_values = 1 << 23 # samples transformed at once by windowed_peaks, 64 MB of float64
+
+# Returns the start sample of every full window of window_size samples, one every hop samples
+def window_starts(n, window_size, hop):
+  if n < window_size or window_size < 1:
+    return np.zeros(0, dtype=np.intp)
+  return np.arange(0, n - window_size + 1, hop)
+
+# Share of the power within [f_low, f_high] held by the peak bin and its neighbours
+# on each side, from 0 (flat spectrum) to 1 (a single tone). NaN without power.
+def peak_confidence(f, amplitude, f_low, f_high, neighbours=1):
+  amplitude = np.asarray(amplitude)
+  in_band = np.flatnonzero((f >= f_low) & (f <= f_high))
+  if len(in_band) == 0:
+    return np.full(amplitude.shape[1:], np.nan)
+  power = np.square(amplitude[in_band])
+  total = power.sum(axis=0)
+  edge = np.zeros((neighbours,) + power.shape[1:])
+  padded = np.concatenate((edge, power, edge))
+  peak = np.expand_dims(np.argmax(power, axis=0), 0)
+  around_peak = sum(np.take_along_axis(padded, peak + offset, axis=0)[0] for offset in range(2 * neighbours + 1))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(total > 0, around_peak / total, np.nan)
+
+# Spectral peak of every window of the data, windows of window_seconds taken every hop_seconds.
+# The windows are a strided view of the data, transformed together in blocks of at most
+# max_block_values samples. Returns the window centre times (s) and, for each window
+# (and axis), the peak frequency, amplitude and confidence. With a resolution, the spectra
+# resolve it, and the confidence counts the bins within one unpadded FFT bin of the peak.
+# Given the boolean mask of the valid samples, the windows holding another sample are not
+# transformed and their peak is NaN.
+def windowed_peaks(data, fs, f_low, f_high, window_seconds, hop_seconds, detrend=False, resolution=None, valid=None):
+  data = np.asarray(data)
+  data = data.astype(float_dtype(data.dtype), copy=False)
+  window_size = int(round(window_seconds * fs))
+  hop = max(int(round(hop_seconds * fs)), 1)
+  starts = window_starts(len(data), window_size, hop)
+  band = bool(resolution) and band_limited(window_size, fs, f_low, f_high, resolution)
+  n_fft = window_size if band else padded_length(window_size, fs, resolution)
+  bin_width = resolution if band else fs / n_fft
+  neighbours = max(int(round(fs / max(window_size, 1) / bin_width)), 1)
+  shape = (len(starts),) + data.shape[1:]
+  peak_freq, peak_amp, confidence = np.full(shape, np.nan), np.full(shape, np.nan), np.full(shape, np.nan)
+  transformed = np.arange(len(starts))
+  if valid is not None:
+    invalid = np.concatenate(([0], np.cumsum(~np.asarray(valid, dtype=bool))))
+    transformed = transformed[invalid[starts + window_size] == invalid[starts]]
+  if len(transformed) > 0:
+    # (window_size, windows, axes) view, no data is copied
+    windows = np.moveaxis(np.lib.stride_tricks.sliding_window_view(data, window_size, axis=0)[::hop], -1, 0)
+    per_block = max(1, max_block_values // (n_fft * int(np.prod(data.shape[1:]))))
+    work = work_buffer(n_fft, min(per_block, len(transformed)) * int(np.prod(data.shape[1:])), data.dtype) # reused by every block
+    for first in range(0, len(transformed), per_block):
+      block = transformed[first:first + per_block]
+      if block[-1] - block[0] == len(block) - 1:
+        block = slice(block[0], block[-1] + 1) # consecutive windows stay a view
+      if band:
+        f, amplitude = band_spectrum(windows[:,block], fs, f_low, f_high, resolution, detrend, work)
+      else:
+        f, amplitude = spectrum(windows[:,block], fs, detrend, work, resolution)
+      peak_amp[block], peak_freq[block] = find_peak(f, amplitude, f_low, f_high)
+      confidence[block] = peak_confidence(f, amplitude, f_low, f_high, neighbours)
+  times = (starts + window_size / 2) / fs
+  return times, peak_freq, peak_amp, confidence
+
+# Compares the spectral peak search at a resolution with a zero-padded FFT of the same
+# resolution, on the bands of the algorithms: time, peak traced memory and the rates found
+if __name__ == '__main__':
+  fs = 50
+  resolution_bpm = 0.1
+  bands = [('heart rate', 0.66, 2.5), ('breathing rate', 0.13, 0.66)]
+  rng = np.random.default_rng(0)
+  repeats = 3
+
+  def measure(function):
+    times = []
+    for _ in range(repeats):
+      start = time.perf_counter()
+      function()
+      times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+      result = function()
+      return min(times), tracemalloc.get_traced_memory()[1], result
+    finally:
+      tracemalloc.stop()
+
+  def zero_padded_peak(data, f_low, f_high, resolution):
+    n_fft = padded_length(len(data), fs, resolution)
+    f = scipy.fft.rfftfreq(n_fft, 1/fs)
+    return find_peak(f, np.abs(scipy.fft.rfft(data, n=n_fft, axis=0)), f_low, f_high)[1]
+
+  def report(label, data, f_low, f_high, rate, zero_padded, resolved):
+    fft_time, fft_memory, fft_freq = measure(zero_padded)
+    time_, memory, freq = measure(resolved)
+    print("  %-24s zero-padded FFT: %7.4f s %7.1f MB  resolved: %7.4f s %7.1f MB  speedup %4.1fx  rates %.2f / %.2f bpm (true %.2f)" % (
+      label, fft_time, fft_memory / 1e6, time_, memory / 1e6, fft_time / time_, 60 * np.mean(fft_freq), 60 * np.mean(freq), 60 * rate))
+
+  resolution = resolution_bpm / 60
+  print("Resolution %g bpm at %d Hz (FFT bins of 30 s are %g bpm)" % (resolution_bpm, fs, 60 * fs / fast_length(30 * fs)))
+  for name, f_low, f_high in bands:
+    rate = (f_low + f_high) / 2 + 0.0123
+    print(name)
+    for seconds in [30, 60, 300, 3600]:
+      t = np.arange(int(seconds * fs)) / fs
+      data = np.sin(2 * np.pi * rate * t)[:,None] + 0.5 * rng.standard_normal((len(t), 3))
+      path = 'band' if band_limited(len(data), fs, f_low, f_high, resolution) else 'padded FFT'
+      report('%d s (%s)' % (seconds, path), data, f_low, f_high, rate, lambda: zero_padded_peak(data, f_low, f_high, resolution),
+        lambda: peak(data, fs, f_low, f_high, resolution=resolution)[1])
+
+    # windows of 30 s every 5 s, as estimate_windows takes them
+    windows, window_size, hop = 500, 30 * fs, 5 * fs
+    t = np.arange((windows - 1) * hop + window_size) / fs
+    data = np.sin(2 * np.pi * rate * t)[:,None] + 0.5 * rng.standard_normal((len(t), 3))
+    view = np.moveaxis(np.lib.stride_tricks.sliding_window_view(data, window_size, axis=0)[::hop], -1, 0)
+    report('%d windows of 30 s' % windows, data, f_low, f_high, rate, lambda: zero_padded_peak(view, f_low, f_high, resolution),
+      lambda: windowed_peaks(data, fs, f_low, f_high, 30, 5, resolution=resolution)[1])
@@ -0,0 +1,16 @@
+import os
+import pandas as pd
+import pytest
+import plotting
+
+datasets = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'datasets')
+
+# The estimates run by the tests never write plots
+@pytest.fixture(autouse=True)
+def headless():
+  plotting.set_mode('headless')
+
+# The UIC recording, (N, 3) at 50 Hz
+@pytest.fixture(scope='session')
+def uic():
+  return pd.read_csv(os.path.join(datasets, 'uic_dataset.csv')).values
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+import bio_watch
+from benchmark import synthetic_recording
+from bio_watch import BioWatch
+
+fs = 50
+
+@pytest.fixture(scope='module')
+def batch():
+  return np.stack([synthetic_recording(300, fs, heart_rate, breathing_rate, seed=seed)
+    for seed, (heart_rate, breathing_rate) in enumerate([(55, 12), (62, 15), (75, 18), (90, 22)])])
+
+@pytest.mark.parametrize('estimator', [BioWatch(fs), BioWatch(fs, multirate=False), BioWatch(fs, rate_resolution=0.1)])
+def test_estimate_batch_is_the_estimate_of_each_subject(batch, estimator):
+  hr, br = estimator.estimate_batch(batch)
+  np.testing.assert_allclose(np.column_stack((hr, br)), [estimator.estimate(subject) for subject in batch], rtol=1e-9)
+
+def test_estimate_batch_of_float32(batch):
+  batch = batch.astype(np.float32)
+  hr, br = bio_watch.bio_watch_batch(batch, fs)
+  np.testing.assert_allclose(np.column_stack((hr, br)), [bio_watch.bio_watch(subject, fs) for subject in batch], rtol=1e-5)
+
+def test_estimate_batch_leaves_the_batch_unchanged(batch):
+  copy = batch.copy()
+  BioWatch(fs).estimate_batch(batch)
+  np.testing.assert_array_equal(batch, copy)
+
+def test_estimate_batch_of_the_uic_recording(uic):
+  windows = np.stack([uic[start:start + 1000,0:3] for start in range(0, 3000, 1000)])
+  estimator = BioWatch(50)
+  np.testing.assert_allclose(np.column_stack(estimator.estimate_batch(windows)), [estimator.estimate(w) for w in windows], rtol=1e-9)
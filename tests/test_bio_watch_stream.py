@@ -0,0 +1,30 @@
+import numpy as np
+import bio_watch_stream
+from bio_watch_stream import parity, parity_tolerance, running_tolerance
+
+def test_stream_matches_batch_windows(uic):
+  streamed, batched = parity(uic, 50, recording_normalization=True)
+  assert len(streamed) > 0
+  np.testing.assert_array_equal(streamed[:,0], batched[:,0])
+  assert np.all(np.abs(streamed[:,1:] - batched[:,1:]) <= parity_tolerance)
+
+def test_running_normalization_median(uic):
+  streamed, batched = parity(uic, 50)
+  assert np.all(np.median(np.abs(streamed[:,1:] - batched[:,1:]), axis=0) <= running_tolerance)
+
+# the running statistics are updated chunk by chunk, fixed ones make chunking irrelevant
+def test_chunk_size_does_not_change_estimates(uic):
+  one, _ = parity(uic, 50, chunk_size=1, recording_normalization=True)
+  large, _ = parity(uic, 50, chunk_size=4000, recording_normalization=True)
+  np.testing.assert_allclose(one, large, atol=1e-6)
+
+def test_delayed_zero_phase_filter_is_filtfilt():
+  rng = np.random.default_rng(0)
+  data = rng.standard_normal((5000, 3))
+  zero_phase = bio_watch_stream.ZeroPhaseFilter(0.66, 2.5, 50, 2)
+  delayed = np.concatenate([zero_phase.update(data[start:start+123]) for start in range(0, len(data), 123)])
+  expected = bio_watch_stream.filters.filtfilt(data, (0.66, 2.5), 50, 2)
+  # away from the ends, where filtfilt pads the recording
+  middle = slice(1000, 4000)
+  shifted = slice(1000 + zero_phase.delay, 4000 + zero_phase.delay)
+  np.testing.assert_allclose(delayed[shifted], expected[middle], atol=1e-3 * np.abs(expected).max())
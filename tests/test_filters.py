@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+import filters
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+@pytest.mark.parametrize('band, btype, order', [(5.6, 'high', 2), (0.66, 'low', 2), ((4, 11), 'band', 2), ((0.66, 2.5), 'band', 5)])
+def test_filtfilt_in_place_is_filtfilt(dtype, band, btype, order, monkeypatch):
+  monkeypatch.setattr(filters, 'filter_block_rows', 1000) # several blocks, the last one partial
+  data = np.random.default_rng(0).standard_normal((4321, 3)).astype(dtype)
+  expected = filters.filtfilt(data, band, 50, order, btype)
+  filtered = filters.filtfilt_in_place(data, band, 50, order, btype)
+  assert filtered is data
+  np.testing.assert_array_equal(filtered, expected)
@@ -0,0 +1,35 @@
+import pytest
+import profiling
+from bio_watch import BioWatch
+from seismotracker import SeismoTracker
+from sleep_monitor import SleepMonitor
+
+@pytest.fixture
+def records():
+  profiling.reset()
+  profiling.enable()
+  yield profiling.records
+  profiling.disable()
+  profiling.reset()
+
+# The stages building pipeline nodes are recorded when the nodes compute, not in their place
+@pytest.mark.parametrize('estimator, stage, node_stage', [
+  (SleepMonitor(50), 'sleep_monitor.preprocess', 'pipeline.tv_filter'),
+  (SeismoTracker(50), 'seismotracker.apply_pass_filter', 'pipeline.pass_filter'),
+  (SeismoTracker(50), 'seismotracker.decimate', 'pipeline.decimate'),
+  (BioWatch(50), 'bio_watch.decimate', 'pipeline.decimate')])
+def test_node_compute_is_recorded_under_its_stage(uic, records, estimator, stage, node_stage):
+  estimator.estimate(uic)
+  stages = [r['stage'] for r in records]
+  assert stage in stages
+  assert node_stage not in stages
+  assert all(r['depth'] > 0 for r in records if r['stage'] == stage)
+
+# The smoothing both rates start from is not charged to the first rate computed
+def test_bio_watch_rates_exclude_the_shared_stages(uic, records):
+  BioWatch(50).estimate(uic)
+  first = {}
+  for r in records:
+    first.setdefault(r['stage'], r)
+  assert first['pipeline.normalize']['depth'] == 1
+  assert first['pipeline.average_filter']['depth'] == 1
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from dataclasses import replace
+
+import quality
+import spectral
+from benchmark import synthetic_recording
+from bio_watch import BioWatch
+from quality import SignalQuality
+from seismotracker import SeismoTracker
+
+fs = 50
+window = 30 * fs
+
+@pytest.fixture(scope='module')
+def recording():
+  return synthetic_recording(600, fs, motion_bursts_per_hour=0, seed=0)
+
+# The recording with motion in the given 30 s windows
+def corrupted(recording, windows):
+  data = recording.copy()
+  rng = np.random.default_rng(1)
+  for w in windows:
+    data[w*window:(w+1)*window] += 4 * rng.standard_normal((window, 3))
+  return data
+
+def test_accepted_runs():
+  bounds = quality.window_bounds(100, 10)
+  starts, ends = quality.accepted_runs(bounds, np.array([1, 1, 0, 0, 1, 0, 1, 1, 1, 0], dtype=bool))
+  np.testing.assert_array_equal(starts, [0, 40, 60])
+  np.testing.assert_array_equal(ends, [20, 50, 90])
+
+@pytest.mark.parametrize('estimator', [BioWatch, SeismoTracker])
+def test_gated_estimate_is_the_estimate_of_the_accepted_run(recording, estimator):
+  data = corrupted(recording, [0, 1, 2, 17, 18, 19])
+  gated = replace(estimator(fs), signal_quality=SignalQuality()).estimate(data)
+  np.testing.assert_array_equal(gated, estimator(fs).estimate(data[3*window:17*window]))
+
+@pytest.mark.parametrize('estimator', [BioWatch, SeismoTracker])
+def test_gated_estimate_filters_the_runs_on_their_own(recording, estimator):
+  runs = [recording[:8*window], recording[9*window:]]
+  joined = replace(estimator(fs), signal_quality=SignalQuality()).estimate(np.concatenate(runs))
+  gated = replace(estimator(fs), signal_quality=SignalQuality()).estimate(corrupted(recording, [8]))
+  assert not np.array_equal(gated, joined)
+  np.testing.assert_allclose(gated, estimator(fs).estimate(recording), atol=2)
+
+def test_runs_peak_sums_the_power_of_the_runs():
+  t = np.arange(3000) / fs
+  tone = np.sin(2 * np.pi * 1.2 * t)
+  runs = (tone[:1000], tone[1200:])
+  amp, freq, f, amplitude = spectral.runs_peak(runs, fs, 0.5, 3)
+  f_long, long_amplitude = spectral.spectrum(runs[1], fs)
+  f_short, short_amplitude = spectral.spectrum(runs[0], fs, length=len(runs[1]))
+  np.testing.assert_array_equal(f, f_long)
+  np.testing.assert_allclose(amplitude, np.sqrt(long_amplitude**2 + short_amplitude**2))
+  assert freq == pytest.approx(1.2, abs=0.01)
+  np.testing.assert_array_equal(spectral.runs_peak(runs[:1], fs, 0.5, 3)[1], spectral.peak(runs[0], fs, 0.5, 3)[1])
+
+def test_windowed_peaks_skips_windows_with_invalid_samples(recording):
+  valid = np.ones(len(recording), dtype=bool)
+  valid[4000:4100] = False
+  times, freq, amp, confidence = spectral.windowed_peaks(recording, fs, 0.1, 0.7, 30, 5, valid=valid)
+  all_times, all_freq, all_amp, all_confidence = spectral.windowed_peaks(recording, fs, 0.1, 0.7, 30, 5)
+  starts = np.arange(len(times)) * 5 * fs
+  masked = (starts < 4100) & (starts + window > 4000)
+  assert masked.any() and not masked.all()
+  assert np.isnan(freq[masked]).all()
+  np.testing.assert_array_equal(freq[~masked], all_freq[~masked])
+  np.testing.assert_array_equal(confidence[~masked], all_confidence[~masked])
+
+@pytest.mark.parametrize('estimator', [BioWatch, SeismoTracker])
+def test_gated_estimate_windows_has_nan_rates_in_rejected_windows(recording, estimator):
+  data = corrupted(recording, [10])
+  rates = replace(estimator(fs), signal_quality=SignalQuality()).estimate_windows(data)
+  everything = estimator(fs).estimate_windows(data)
+  start = rates['time'].to_numpy() - 15
+  rejected = (start < 11 * 30) & (start + 30 > 10 * 30)
+  assert rejected.any()
+  assert rates['heart_rate'][rejected].isna().all() and rates['breathing_rate'][rejected].isna().all()
+  np.testing.assert_array_equal(rates['heart_rate'][~rejected], everything['heart_rate'][~rejected])
+
+def test_gated_estimate_batch_is_the_estimate_of_each_subject(recording):
+  batch = np.stack([recording, corrupted(recording, [5]), corrupted(recording, range(20))])
+  estimator = replace(BioWatch(fs), signal_quality=SignalQuality())
+  hr, br = estimator.estimate_batch(batch)
+  np.testing.assert_allclose(np.column_stack((hr, br)), [estimator.estimate(subject) for subject in batch], rtol=1e-9)
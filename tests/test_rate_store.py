@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rate_store
+from rate_store import RateStore
+
+start_time = 1704067200 # 2024-01-01 00:00 UTC
+days = 3
+
+# Rows of two algorithms every 5 s over three days, appended out of time order in a few chunks,
+# with some missing rates, next to the DataFrame of the same rows as stored
+@pytest.fixture(scope='module')
+def stored(tmp_path_factory):
+  rng = np.random.default_rng(0)
+  store = RateStore(str(tmp_path_factory.mktemp('rates')))
+  frames = []
+  for algorithm in ['Bio Watch', 'SeismoTracker']:
+    times = start_time + np.arange(0, days * 86400, 5) + rng.uniform(0, 4)
+    heart_rate = rng.uniform(40, 120, len(times))
+    breathing_rate = rng.uniform(8, 30, len(times))
+    heart_rate[rng.random(len(times)) < 0.05] = np.nan
+    breathing_rate[rng.random(len(times)) < 0.05] = np.nan
+    confidence = rng.random(len(times))
+    for chunk in np.array_split(rng.permutation(len(times)), 4):
+      store.append('bed-1', algorithm, times[chunk], heart_rate[chunk], breathing_rate[chunk], confidence[chunk], confidence[chunk])
+    frames.append(pd.DataFrame({'time': times, 'algorithm': algorithm, 'heart_rate': heart_rate.astype(np.float32),
+      'breathing_rate': breathing_rate.astype(np.float32), 'heart_rate_confidence': confidence.astype(np.float32)}))
+  return store, pd.concat(frames, ignore_index=True)
+
+def expected_rows(frame, start, end, algorithm=None):
+  rows = frame[(frame['time'] >= start) & (frame['time'] < end)]
+  if algorithm is not None:
+    rows = rows[rows['algorithm'] == algorithm]
+  return rows.sort_values('time', kind='stable')
+
+def assert_rows(result, rows):
+  np.testing.assert_array_equal(result['time'], rows['time'])
+  np.testing.assert_array_equal(result['algorithm'], rows['algorithm'])
+  for name in ['heart_rate', 'breathing_rate', 'heart_rate_confidence']:
+    np.testing.assert_array_equal(result[name], rows[name])
+
+@pytest.mark.parametrize('start, end', [(0, 5400), (3600 * 20, 3600 * 30), (86400, 2 * 86400), (-100, days * 86400 + 100), (500, 500)])
+@pytest.mark.parametrize('algorithm', [None, 'SeismoTracker'])
+def test_query_is_the_rows_in_range(stored, start, end, algorithm):
+  store, frame = stored
+  result = store.query('bed-1', start_time + start, start_time + end, algorithm)
+  assert_rows(result, expected_rows(frame, start_time + start, start_time + end, algorithm))
+
+def test_query_of_unknown_device_or_algorithm(stored):
+  store, frame = stored
+  assert len(store.query('bed-2', start_time, start_time + 86400)['time']) == 0
+  assert len(store.query('bed-1', start_time, start_time + 86400, 'Sleep Monitor')['time']) == 0
+
+@pytest.mark.parametrize('resolution', ['minute', 'hour'])
+@pytest.mark.parametrize('start, end', [(0, days * 86400), (3600 * 20 + 30, 3600 * 30)])
+def test_aggregates_are_the_groupby_of_the_rows(stored, resolution, start, end):
+  store, frame = stored
+  bucket_seconds = rate_store.resolutions[resolution]
+  result = store.aggregates('bed-1', 'Bio Watch', start_time + start, start_time + end, resolution)
+  rows = frame[frame['algorithm'] == 'Bio Watch'].assign(bucket=lambda rows: rows['time'] // bucket_seconds * bucket_seconds)
+  rows = rows[(rows['bucket'] >= start_time + start) & (rows['bucket'] < start_time + end)]
+  expected = rows.groupby('bucket')[['heart_rate', 'breathing_rate']].agg(['count', 'min', 'mean', 'max'])
+  np.testing.assert_array_equal(result['time'], expected.index)
+  for measure in rate_store.measures:
+    np.testing.assert_array_equal(result[measure + '_count'], expected[(measure, 'count')])
+    np.testing.assert_array_equal(result[measure + '_min'], expected[(measure, 'min')])
+    np.testing.assert_array_equal(result[measure + '_max'], expected[(measure, 'max')])
+    np.testing.assert_allclose(result[measure + '_mean'], expected[(measure, 'mean')], rtol=1e-6)
+
+# An append interrupted before its index was saved leaves rows the index does not cover
+def test_query_completes_a_stale_index(stored, tmp_path):
+  _, frame = stored
+  store = RateStore(str(tmp_path))
+  rows = frame[frame['algorithm'] == 'Bio Watch'].iloc[:10000]
+  store.append('bed-1', 'Bio Watch', rows['time'].to_numpy(), rows['heart_rate'].to_numpy(), rows['breathing_rate'].to_numpy(),
+    rows['heart_rate_confidence'].to_numpy())
+  index_path = store.partition_path('bed-1', rate_store.day_of(start_time), '.index.npy')
+  np.save(index_path, np.load(index_path)[:1])
+  assert_rows(store.query('bed-1', start_time, start_time + 86400), expected_rows(rows, start_time, start_time + 86400))
@@ -0,0 +1,67 @@
+import os
+import shutil
+from dataclasses import replace
+import numpy as np
+import pytest
+import result_store
+from result_store import ResultStore
+from seismotracker import SeismoTracker
+from sleep_monitor import SleepMonitor
+
+source_sha256 = '0' * 64
+
+def key(store, estimator):
+  return store.result_key(source_sha256, np.float64, type(estimator).__name__, estimator, type(estimator).__module__)
+
+# A copy of the modules, whose code can be edited, as the store's source directory
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+  for name in os.listdir(result_store.source_dir):
+    if name.endswith('.py'):
+      shutil.copy(os.path.join(result_store.source_dir, name), tmp_path)
+  monkeypatch.setattr(result_store, 'source_dir', str(tmp_path))
+  result_store.code_version.cache_clear()
+  yield tmp_path
+  result_store.code_version.cache_clear()
+
+def test_result_key_changes_with_a_field(tmp_path):
+  store = ResultStore(str(tmp_path))
+  estimator = SleepMonitor(50)
+  assert key(store, estimator) == key(store, SleepMonitor(50))
+  assert key(store, estimator) != key(store, replace(estimator, tv_filter_lambda=6))
+  assert key(store, estimator) != key(store, replace(estimator, sampling_frequency=32))
+
+def test_result_key_ignores_the_defaults_and_comments(sources):
+  store = ResultStore(str(sources))
+  before = key(store, SleepMonitor(50))
+  path = sources / 'sleep_monitor.py'
+  path.write_text(path.read_text().replace('tv_filter_lambda = 5\n', 'tv_filter_lambda = 6 # changed\n'))
+  assert 'tv_filter_lambda = 6' in path.read_text()
+  result_store.code_version.cache_clear()
+  assert key(store, SleepMonitor(50)) == before
+
+@pytest.mark.parametrize('module', ['sleep_monitor', 'tv_filter', 'ingest'])
+def test_result_key_changes_with_the_code(sources, module):
+  store = ResultStore(str(sources))
+  before = key(store, SleepMonitor(50)), key(store, SeismoTracker(50))
+  with open(sources / (module + '.py'), 'a') as f:
+    f.write("\ndef added():\n  return 1\n")
+  result_store.code_version.cache_clear()
+  after = key(store, SleepMonitor(50)), key(store, SeismoTracker(50))
+  assert after[0] != before[0]
+  # SeismoTracker imports neither Sleep Monitor nor the TV filter, but reads recordings through ingest
+  assert (after[1] != before[1]) == (module == 'ingest')
+
+def test_refresh_reads_nothing_and_stores_again(tmp_path):
+  value = np.arange(10.0)
+  ResultStore(str(tmp_path)).save('node', 'tv_filter', ('tv_filter',), value)
+  ResultStore(str(tmp_path)).save_result('key', {'breathing_rate': 15.0})
+  np.testing.assert_array_equal(ResultStore(str(tmp_path)).load('node', 'tv_filter', ('tv_filter',)), value)
+
+  refreshing = ResultStore(str(tmp_path), refresh=True)
+  assert refreshing.result('key') is None
+  assert refreshing.load('node', 'tv_filter', ('tv_filter',)) is None
+  refreshing.save('node', 'tv_filter', ('tv_filter',), value + 1)
+  refreshing.save_result('key', {'breathing_rate': 16.0})
+  np.testing.assert_array_equal(ResultStore(str(tmp_path)).load('node', 'tv_filter', ('tv_filter',)), value + 1)
+  assert ResultStore(str(tmp_path)).result('key')['breathing_rate'] == 16.0
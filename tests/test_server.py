@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+import server
+
+def test_decode_packet_round_trip():
+  samples = np.arange(12, dtype=np.float64).reshape(4, 3)
+  device, sampling_rate, sent, decoded = server.decode_packet(server.encode_packet('device-1', 50, samples, sent=12.5))
+  assert (device, sampling_rate, sent) == ('device-1', 50, 12.5)
+  np.testing.assert_array_equal(decoded, samples)
+
+@pytest.mark.parametrize('sampling_rate', [float('nan'), float('inf'), -float('inf'), 0, -50, 1, 1e9])
+def test_decode_packet_rejects_sampling_rate(sampling_rate):
+  with pytest.raises(ValueError, match='sampling rate'):
+    server.decode_packet(server.encode_packet('device-1', sampling_rate, np.zeros((4, 3))))
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from sleep_monitor import SleepMonitor
+from sleep_monitor_chunked import SleepMonitorChunked
+from benchmark import synthetic_recording
+
+# A whole number of windows, which SleepMonitor.estimate then splits as the chunked estimator does
+@pytest.mark.parametrize('chunk_size', [777, 45000])
+def test_chunked_is_estimate(chunk_size):
+  data = synthetic_recording(3600, 50, breathing_rate=18, seed=1)
+  expected = SleepMonitor(50).estimate(data)
+  chunked = SleepMonitorChunked(SleepMonitor(50), block_seconds=600)
+  for start in range(0, len(data), chunk_size):
+    chunked.push(data[start:start + chunk_size])
+  assert chunked.finish() == pytest.approx(expected, rel=1e-9)
+
+def test_chunked_bounds_the_open_tv_solution():
+  chunked = SleepMonitorChunked(SleepMonitor(50), block_seconds=600)
+  assert chunked.denoiser.max_pending == chunked.block
+  assert chunked.block == 600 * 50
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import spectral
+from benchmark import synthetic_recording
+
+fs = 50
+
+@pytest.fixture(scope='module')
+def recording():
+  return synthetic_recording(1200, fs, seed=0)
+
+# Blocks of any size, shorter or longer than the pieces BandDFT transforms, give band_spectrum()
+# of the whole recording
+@pytest.mark.parametrize('detrend', [False, True])
+@pytest.mark.parametrize('block_rows, piece_rows', [(7000, spectral.band_dft_piece_rows), (7000, 3000), (1234, 5000), (60000, 60000)])
+def test_band_dft_is_band_spectrum(recording, detrend, block_rows, piece_rows):
+  expected_f, expected = spectral.band_spectrum(recording, fs, 0.13, 0.66, 0.1 / 60, detrend)
+  dft = spectral.BandDFT(fs, 0.13, 0.66, 0.1 / 60, 3, detrend, piece_rows)
+  for start in range(0, len(recording), block_rows):
+    dft.add(recording[start:start + block_rows])
+  f, amplitude = dft.amplitude()
+  np.testing.assert_array_equal(f, expected_f)
+  np.testing.assert_allclose(amplitude, expected, rtol=1e-7, atol=1e-7 * expected.max())
+
+# One zoom FFT plan is built for the pieces, whatever the block sizes
+def test_band_dft_reuses_one_zoom_plan(recording):
+  spectral.cached_zoom.cache_clear()
+  dft = spectral.BandDFT(fs, 0.13, 0.66, 0.1 / 60, 3, piece_rows=5000)
+  for size in [1000, 2345, 7000, 4321, 9999]:
+    dft.add(recording[:size])
+  assert spectral.cached_zoom.cache_info().currsize == 1
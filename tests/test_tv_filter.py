@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+import tv_filter
+from benchmark import synthetic_recording
+
+@pytest.fixture(scope='module')
+def recording():
+  return synthetic_recording(600, 50, seed=0)
+
+@pytest.mark.parametrize('block_size', [7, 1000, 30000])
+def test_streaming_denoiser_is_denoise_axes(recording, block_size):
+  expected = tv_filter.denoise_axes(recording, 5)
+  denoiser = tv_filter.StreamingDenoiser(5, 3)
+  parts = [denoiser.add(recording[start:start + block_size]) for start in range(0, len(recording), block_size)]
+  parts.append(denoiser.finish())
+  np.testing.assert_array_equal(np.concatenate(parts), expected)
+
+# Settling is forced past max_pending, which only bounds memory: the solution is left open
+# for far shorter than this on accelerometer data
+def test_streaming_denoiser_bounds_pending_samples(recording):
+  expected = tv_filter.denoise_axes(recording, 5)
+  denoiser = tv_filter.StreamingDenoiser(5, 3, max_pending=3000)
+  parts = []
+  for start in range(0, len(recording), 1000):
+    parts.append(denoiser.add(recording[start:start + 1000]))
+    assert max(len(pending) for pending in denoiser.pending) <= 3000
+  parts.append(denoiser.finish())
+  np.testing.assert_array_equal(np.concatenate(parts), expected)
+
+# A constant column never settles on its own
+def test_streaming_denoiser_forced_settling_keeps_the_length():
+  ramp = np.column_stack((np.linspace(0, 100, 5000), np.zeros(5000)))
+  denoiser = tv_filter.StreamingDenoiser(5, 2, max_pending=100)
+  parts = [denoiser.add(ramp[start:start + 250]) for start in range(0, len(ramp), 250)]
+  parts.append(denoiser.finish())
+  assert len(np.concatenate(parts)) == len(ramp)
+  assert max(len(pending) for pending in denoiser.pending) == 0
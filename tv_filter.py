@@ -0,0 +1,199 @@
+import numpy as np
+
+# Total variation denoising of 1-D signals.
+#
+# Both solvers minimize the cost used in the TV filtering lecture notes
+# (http://eeweb.poly.edu/iselesni/lecture_notes/TV_filtering.pdf):
+#
+#   J(x) = sum(|y - x|^2) + lambda_value * sum(|diff(x)|)
+#
+# 'direct' is Condat's exact O(N) algorithm ("A Direct Algorithm for 1D Total
+# Variation Denoising", 2013) and is the default. 'mm' is the iterative
+# clipping (majorization-minimization) scheme, which stops once the update
+# falls below tol or the iteration budget max_iter is spent.
+
+default_tolerance = 1e-6
+default_max_iterations = 10000
+
+def clip(x, b):
+  return np.clip(x, -b, b)
+
+# Transpose of the first order difference operator
+def diff_transpose(z):
+  return np.concatenate(([-z[0]], -np.diff(z), [z[-1]]))
+
+def cost(y, x, lambda_value):
+  return np.sum(np.square(np.abs(x - y))) + lambda_value * np.sum(np.abs(np.diff(x)))
+
+# Condat's taut-string style algorithm, works on python floats since every
+# step only touches a handful of scalars.
+#
+# The algorithm never revisits a sample before the last jump it found, so a long
+# signal can be denoised in parts: with partial, it stops on reaching the end of y
+# and returns the settled start of the solution, the number of samples settled and
+# the solver state: its positions relative to the first unsettled sample, its bounds
+# and the sign of the jump the settled samples end on (0 for none). Passing that state
+# resumes the scan where it stopped, on the unsettled rest of y followed by more
+# samples, so a signal given in parts costs as much as in one call. A part can also
+# start afresh after a jump of known sign, given as jump with no state.
+def denoise_direct(y, lambda_value, jump=0, partial=False, state=None):
+  if not isinstance(y, list):
+    y = np.asarray(y, dtype=np.float64).tolist()
+  N = len(y)
+  if N < 2 and state is None:
+    if partial:
+      return np.zeros(0), 0, None
+    return np.array(y, dtype=np.float64)
+
+  # J above equals 2 * (0.5*|y - x|^2 + (lambda_value/2)*|Dx|_1)
+  lam = lambda_value / 2
+  minus_lam = -lam
+  two_lam = 2 * lam
+  x = [0.0] * N
+  last = N - 1
+
+  if state is None:
+    k = k0 = k_minus = k_plus = 0
+    u_min = lam
+    u_max = minus_lam
+    # the state after a negative or positive jump, or at the start of a signal
+    v_min = y[0] if jump < 0 else y[0] - two_lam if jump > 0 else y[0] - lam
+    v_max = v_min + two_lam if jump else y[0] + lam
+  else:
+    k0 = 0
+    k, k_minus, k_plus, v_min, v_max, u_min, u_max, jump = state
+  while True:
+    if partial and k == last:
+      return np.array(x[:k0]), k0, (k - k0, k_minus - k0, k_plus - k0, v_min, v_max, u_min, u_max, jump)
+    # right boundary: close the remaining segments
+    while k == last:
+      if u_min < 0:
+        x[k0:k_minus + 1] = [v_min] * (k_minus + 1 - k0)
+        k = k0 = k_minus = k_minus + 1
+        v_min = y[k]
+        u_min = lam
+        u_max = v_min + u_min - v_max
+      elif u_max > 0:
+        x[k0:k_plus + 1] = [v_max] * (k_plus + 1 - k0)
+        k = k0 = k_plus = k_plus + 1
+        v_max = y[k]
+        u_max = minus_lam
+        u_min = v_max + u_max - v_min
+      else:
+        v_min += u_min / (k - k0 + 1)
+        x[k0:] = [v_min] * (N - k0)
+        return np.array(x)
+
+    u_min += y[k + 1] - v_min
+    if u_min < minus_lam:
+      # negative jump
+      x[k0:k_minus + 1] = [v_min] * (k_minus + 1 - k0)
+      k = k0 = k_minus = k_plus = k_minus + 1
+      jump = -1
+      v_min = y[k]
+      v_max = v_min + two_lam
+      u_min = lam
+      u_max = minus_lam
+      continue
+
+    u_max += y[k + 1] - v_max
+    if u_max > lam:
+      # positive jump
+      x[k0:k_plus + 1] = [v_max] * (k_plus + 1 - k0)
+      k = k0 = k_minus = k_plus = k_plus + 1
+      jump = 1
+      v_max = y[k]
+      v_min = v_max - two_lam
+      u_min = lam
+      u_max = minus_lam
+    else:
+      k += 1
+      if u_min >= lam:
+        k_minus = k
+        v_min += (u_min - lam) / (k_minus - k0 + 1)
+        u_min = lam
+      if u_max <= minus_lam:
+        k_plus = k
+        v_max += (u_max + lam) / (k_plus - k0 + 1)
+        u_max = minus_lam
+
+# Iterative clipping algorithm, stops when the largest change of x is below tol
+def denoise_mm(y, lambda_value, max_iter=default_max_iterations, tol=default_tolerance, return_cost=False):
+  y = np.asarray(y, dtype=np.float64)
+  N = len(y)
+  J = []
+  if N < 2:
+    return (y.copy(), np.array(J)) if return_cost else y.copy()
+
+  z = np.zeros(N - 1)
+  alpha = 4
+  T = lambda_value / 2
+  x = y.copy()
+  for k in range(0, max_iter):
+    x_prev = x
+    x = y - diff_transpose(z)
+    if return_cost:
+      J.append(cost(y, x, lambda_value))
+    if k > 0 and np.max(np.abs(x - x_prev)) < tol:
+      break
+    z = clip(z + (1/alpha) * np.diff(x), T)
+  if return_cost:
+    return x, np.array(J)
+  return x
+
+def denoise(y, lambda_value, method='direct', max_iter=default_max_iterations, tol=default_tolerance, return_cost=False):
+  if method == 'direct':
+    x = denoise_direct(y, lambda_value)
+    return (x, np.array([cost(y, x, lambda_value)])) if return_cost else x
+  if method == 'mm':
+    return denoise_mm(y, lambda_value, max_iter, tol, return_cost)
+  raise ValueError("Unknown TV denoising method: %s" % method)
+
+# Denoises every column of an (N, axes) array independently
+def denoise_axes(data, lambda_value, method='direct', max_iter=default_max_iterations, tol=default_tolerance):
+  denoised = np.empty(np.shape(data), dtype=np.float64)
+  for i in range(0, np.shape(data)[1]):
+    denoised[:,i] = denoise(data[:,i], lambda_value, method, max_iter, tol)
+  return denoised
+
+# Direct TV denoising of the columns of a signal given block by block. add() returns the
+# samples whose solution is settled, the same on every column, finish() the rest, together
+# equal to denoise_axes of the whole signal. Each column resumes the solver from its state
+# after the previous block, so every sample is scanned about once. Unsettled samples are
+# kept up to max_pending per column; past that, the oldest half is settled as if the
+# signal ended there.
+class StreamingDenoiser:
+  def __init__(self, lambda_value, axes, max_pending=None):
+    self.lambda_value = lambda_value
+    self.max_pending = max_pending
+    self.pending = [[] for _ in range(axes)] # samples of each column not settled yet
+    self.settled = [np.zeros(0)] * axes # settled solution of each column not returned yet
+    self.states = [None] * axes # solver state of each column, None before its first samples
+
+  def add(self, block):
+    block = np.asarray(block, dtype=np.float64)
+    for i in range(len(self.pending)):
+      y = self.pending[i] + block[:,i].tolist()
+      x, settled, self.states[i] = denoise_direct(y, self.lambda_value, partial=True, state=self.states[i])
+      if self.max_pending and len(y) - settled > self.max_pending:
+        forced = settled + (len(y) - settled) // 2
+        x = np.concatenate((x, denoise_direct(y[settled:forced], self.lambda_value, self.states[i][-1])))
+        # the rest starts afresh, its scan restarts once
+        rest, rest_settled, self.states[i] = denoise_direct(y[forced:], self.lambda_value, partial=True)
+        x, settled = np.concatenate((x, rest)), forced + rest_settled
+      self.pending[i] = y[settled:]
+      self.settled[i] = np.concatenate((self.settled[i], x))
+    return self.release(min(len(x) for x in self.settled))
+
+  def finish(self):
+    for i in range(len(self.pending)):
+      if len(self.pending[i]) > 0:
+        self.settled[i] = np.concatenate((self.settled[i], denoise_direct(self.pending[i], self.lambda_value, state=self.states[i])))
+      self.pending[i] = []
+      self.states[i] = None
+    return self.release(min(len(x) for x in self.settled))
+
+  def release(self, n):
+    out = np.column_stack([x[:n] for x in self.settled]) if n > 0 else np.zeros((0, len(self.settled)))
+    self.settled = [x[n:] for x in self.settled]
+    return out